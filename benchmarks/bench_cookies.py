@@ -0,0 +1,61 @@
+"""
+Cost of parsing a large Cookie header.
+
+The CSRF and session middlewares used to parse the header with SimpleCookie,
+three times per request between them.  spa.cookies parses it once with a
+simpler parser and caches the result in the environ.
+"""
+from six.moves.http_cookies import SimpleCookie
+from werkzeug.http import parse_cookie
+
+from spa.cookies import ENVIRON_KEY, get_cookies
+
+
+HEADER = '; '.join(
+    ['_ga%d=GA1.2.%d.1577836800' % (n, n * 7919) for n in range(80)] +
+    ['api_csrf=abcdefghijklmnopqrstuvwxyzABCDEF',
+     'session=eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.eyJpYXQiOjE1Nzc4MzY4MDB9.'
+     'c2lnbmF0dXJlc2lnbmF0dXJlc2lnbmF0dXJlc2ln']
+)
+
+
+def simplecookie_three_times():
+    def parse():
+        for _ in range(3):
+            SimpleCookie(HEADER)
+    return parse
+
+
+def werkzeug_parse_cookie():
+    environ = {'HTTP_COOKIE': HEADER}
+    return lambda: parse_cookie(environ)
+
+
+def get_cookies_three_times():
+    def parse():
+        environ = {'HTTP_COOKIE': HEADER}
+        for _ in range(3):
+            get_cookies(environ)
+    return parse
+
+
+def get_cookies_uncached():
+    environ = {'HTTP_COOKIE': HEADER}
+
+    def parse():
+        environ.pop(ENVIRON_KEY, None)
+        get_cookies(environ)
+    return parse
+
+
+CASES = {
+    'simplecookie_three_times': simplecookie_three_times,
+    'werkzeug_parse_cookie': werkzeug_parse_cookie,
+    'get_cookies_three_times': get_cookies_three_times,
+    'get_cookies_uncached': get_cookies_uncached,
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
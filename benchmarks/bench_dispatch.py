@@ -0,0 +1,98 @@
+"""
+Per-request cost of dispatching through App, for matched and unmatched paths.
+
+App matches the route before it builds a Request, and serves plain 404s from
+a page rendered once, so unmatched requests (like a scanner probing for
+/wp-login.php) skip both.  The "eager" cases emulate the old behavior.  "measured_matched" shows the cost of recording
+spa.metrics.
+
+Besides timings, running this script prints the memory allocated per request
+for each case, as measured by tracemalloc.
+"""
+from __future__ import print_function
+
+import tracemalloc
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+import spa
+from spa.metrics import Metrics
+
+
+class Hello(spa.Handler):
+    def get(self):
+        return spa.Response('hello')
+
+
+URLS = tuple(
+    ('/api/thing%d/' % i, 'thing%d' % i, Hello) for i in range(30)
+)
+
+
+class EagerApp(spa.App):
+    def __call__(self, environ, start_response):
+        try:
+            wsgi_app = self.get_handler(environ)
+            resp = wsgi_app(environ, start_response)
+        except HTTPException as e:
+            resp = e(environ, start_response)
+        return resp
+
+    def get_handler(self, environ):
+        req = self.request_class(environ)
+        route_name, params = self.router.match(environ)
+        cls, kwargs = self.handlers[route_name]
+        return cls(self, req, params, route_name, **kwargs)
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+class MeasuredApp(spa.App):
+    def __init__(self, urls):
+        super(MeasuredApp, self).__init__(urls, metrics=Metrics())
+
+
+def _case(app_class, path):
+    def setup():
+        app = app_class(URLS)
+        environ = EnvironBuilder(path).get_environ()
+
+        def call():
+            for chunk in app(environ.copy(), _start_response):
+                pass
+        return call
+    return setup
+
+
+CASES = {
+    'eager_not_found': _case(EagerApp, '/wp-login.php'),
+    'lazy_not_found': _case(spa.App, '/wp-login.php'),
+    'eager_matched': _case(EagerApp, '/api/thing10/'),
+    'lazy_matched': _case(spa.App, '/api/thing10/'),
+    'measured_matched': _case(MeasuredApp, '/api/thing10/'),
+}
+
+
+def allocated_per_call(setup, number=1000):
+    func = setup()
+    func()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    peak = 0
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        func()
+        peak += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak // number
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
+    print()
+    for name, setup in sorted(CASES.items()):
+        print('%-40s %10d bytes peak' % (name, allocated_per_call(setup)))
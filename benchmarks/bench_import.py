@@ -0,0 +1,60 @@
+"""
+Time taken to start Python and import spa, in a fresh interpreter each time.
+
+`import spa` loads each of its names on first use, and leaves gunicorn and
+pkg_resources until something needs them.  "import_eager" imports what
+`import spa` used to, for comparison, and "python_startup" is the floor: an
+interpreter that imports nothing.
+
+Running this script also prints the slowest imports behind `spa.App`, from
+python -X importtime.
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+EAGER = ('import spa.wrappers, spa.handler, spa.app, spa.utils, spa.static; '
+         'import gunicorn.app.base, pkg_resources, logging; '
+         'logging.basicConfig()')
+
+
+def _python(code):
+    def setup():
+        env = dict(os.environ, PYTHONPATH=root)
+        command = [sys.executable, '-c', code]
+        return lambda: subprocess.check_call(command, env=env)
+    return setup
+
+
+CASES = {
+    'python_startup': _python('pass'),
+    'import_spa': _python('import spa'),
+    'import_spa_app': _python('import spa; spa.App'),
+    'import_eager': _python(EAGER),
+}
+
+
+def slowest_imports(code, count=15):
+    env = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code], env=env,
+        stderr=subprocess.STDOUT).decode('utf-8')
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line.split('|')
+        rows.append((int(cumulative_us), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
+    print()
+    for cumulative_us, name in slowest_imports('import spa; spa.App'):
+        print('%10.1f ms %s' % (cumulative_us / 1000.0, name))
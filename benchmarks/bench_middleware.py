@@ -0,0 +1,54 @@
+"""
+Per-request cost of a stack of header-only middlewares.
+
+Nesting them means a call, an exclude regex match and a start_response
+closure per layer.  A Pipeline resolves which layers apply once per path, and
+runs all their response hooks from a single start_response wrapper.
+"""
+from werkzeug.test import EnvironBuilder
+
+from spa.middlewares import Middleware, Pipeline
+
+
+class AddHeader(Middleware):
+    def process_response(self, environ, status, headers):
+        headers.append(('X-Seen', '1'))
+
+
+def _app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def _layers():
+    return [AddHeader(exclude_pattern='^/static/') for _ in range(5)]
+
+
+def nested_middlewares():
+    app = _app
+    for layer in reversed(_layers()):
+        layer.app = app
+        app = layer
+    environ = EnvironBuilder('/api/things/').get_environ()
+    return lambda: app(environ, _start_response)
+
+
+def pipeline():
+    app = Pipeline(_app, _layers())
+    environ = EnvironBuilder('/api/things/').get_environ()
+    return lambda: app(environ, _start_response)
+
+
+CASES = {
+    'nested_middlewares': nested_middlewares,
+    'pipeline': pipeline,
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
@@ -0,0 +1,58 @@
+"""
+End-to-end cost of whole requests to the fixture app (see fixtures.py),
+called in-process as WSGI, with the response body read to the end.
+
+These cover the paths most requests take: routing, JSON responses, static
+files, SmartStatic's rewritten CSS, and the gzip and JWT session middlewares.
+"""
+from fixtures import (hashed_url, make_app, make_environ, make_stack,
+                      session_cookie)
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def _case(path, stack=False, **environ_kwargs):
+    def setup():
+        app = make_stack() if stack else make_app()
+        environ = make_environ(path, **environ_kwargs)
+
+        def call():
+            body = app(environ.copy(), _start_response)
+            try:
+                for chunk in body:
+                    pass
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        return call
+    return setup
+
+
+def _smart_css():
+    return _case(hashed_url('/css/test.css'))()
+
+
+def _not_found():
+    return _case('/wp-login.php')()
+
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+CASES = {
+    'request_hello': _case('/hello/'),
+    'request_not_found': _not_found,
+    'request_json': _case('/api/things/7/'),
+    'request_static_file': _case('/static/css/test.css'),
+    'request_smart_css': _smart_css,
+    'request_json_gzip': _case('/api/things/7/', stack=True, headers=GZIP),
+    'request_static_gzip': _case('/static/css/test.css', stack=True,
+                                 headers=GZIP),
+    'request_jwt_session': _case('/hello/', stack=True,
+                                 headers={'Cookie': session_cookie()}),
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
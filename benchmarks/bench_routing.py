@@ -0,0 +1,55 @@
+"""
+Per-request cost of matching a route.
+
+Werkzeug's matching binds a MapAdapter to the environ and runs the path past
+each rule's regex.  spa.app.Router looks up parameter-free paths in a dict, and
+reuses one adapter per host for the rest.
+"""
+from werkzeug.test import EnvironBuilder
+
+import spa
+from spa.app import build_rules
+
+
+URLS = tuple(
+    ('/api/thing%d/' % i, 'thing%d' % i, spa.Handler) for i in range(50)
+) + (
+    ('/api/users/<int:user_id>/', 'user', spa.Handler),
+)
+
+
+def werkzeug_static_path():
+    url_map, _ = build_rules(URLS)
+    environ = EnvironBuilder('/api/thing40/').get_environ()
+    return lambda: url_map.bind_to_environ(environ).match()
+
+
+def router_static_path():
+    router = spa.App(URLS).router
+    environ = EnvironBuilder('/api/thing40/').get_environ()
+    return lambda: router.match(environ)
+
+
+def werkzeug_dynamic_path():
+    url_map, _ = build_rules(URLS)
+    environ = EnvironBuilder('/api/users/12/').get_environ()
+    return lambda: url_map.bind_to_environ(environ).match()
+
+
+def router_dynamic_path():
+    router = spa.App(URLS).router
+    environ = EnvironBuilder('/api/users/12/').get_environ()
+    return lambda: router.match(environ)
+
+
+CASES = {
+    'werkzeug_static_path': werkzeug_static_path,
+    'router_static_path': router_static_path,
+    'werkzeug_dynamic_path': werkzeug_dynamic_path,
+    'router_dynamic_path': router_dynamic_path,
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
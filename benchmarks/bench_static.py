@@ -0,0 +1,48 @@
+"""
+Per-request cost of setting up static file handlers.
+
+Routing straight to StaticHandler resolves its directory, loader and disallow
+matcher on every request.  The Static and SmartStatic factories do that once
+and share the result with each handler they make.
+"""
+from werkzeug.test import EnvironBuilder
+
+import spa
+from spa.static import Static, SmartStatic, StaticHandler
+
+from util import static_folder
+
+
+def _request():
+    return spa.Request(EnvironBuilder('/css/test.css').get_environ())
+
+
+def static_handler_per_request():
+    req = _request()
+    kwargs = {'directory': static_folder, 'disallow': '*.secret'}
+    return lambda: StaticHandler(None, req, {'filepath': 'css/test.css'},
+                                 'static', **kwargs)
+
+
+def static_factory():
+    req = _request()
+    factory = Static(static_folder, disallow='*.secret')
+    return lambda: factory(None, req, {'filepath': 'css/test.css'}, 'static')
+
+
+def smart_static_factory():
+    req = _request()
+    factory = SmartStatic(static_folder, disallow='*.secret')
+    return lambda: factory(None, req, {'filepath': 'css/test.css'}, 'static')
+
+
+CASES = {
+    'static_handler_per_request': static_handler_per_request,
+    'static_factory': static_factory,
+    'smart_static_factory': smart_static_factory,
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
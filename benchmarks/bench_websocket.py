@@ -0,0 +1,74 @@
+"""
+Cost of sending websocket messages: fanning one message out to 100 sockets
+through a Hub, and sending 100 small messages on one socket, directly or
+through a BufferedWebSocket that writes them in one go.
+
+Sockets write to an in-memory stream, so this measures framing and
+bookkeeping, not the network.
+"""
+from gwebsocket.websocket import WebSocket
+
+from spa.hub import Hub
+from spa.websocket import BufferedWebSocket
+
+
+class NullStream(object):
+    def write(self, data):
+        pass
+
+    def read(self, n):
+        return b''
+
+
+class NullScheduler(object):
+    def call_later(self, delay, func):
+        pass
+
+
+def _socket():
+    return WebSocket({}, NullStream(), None)
+
+
+MESSAGE = {'price': 12.5, 'symbol': 'SPA', 'volume': 1000}
+
+
+def hub_fanout_100():
+    hub = Hub()
+    subscribers = [hub.subscribe(_socket(), 'ticker') for _ in range(100)]
+
+    def call():
+        hub.publish('ticker', MESSAGE)
+        for subscriber in subscribers:
+            subscriber.send_pending()
+    return call
+
+
+def send_100_direct():
+    ws = _socket()
+
+    def call():
+        for _ in range(100):
+            ws.send(u'{"price": 12.5}')
+    return call
+
+
+def send_100_buffered():
+    ws = BufferedWebSocket(_socket(), scheduler=NullScheduler())
+
+    def call():
+        for _ in range(100):
+            ws.send(u'{"price": 12.5}')
+        ws.flush()
+    return call
+
+
+CASES = {
+    'websocket_hub_fanout_100': hub_fanout_100,
+    'websocket_send_100_direct': send_100_direct,
+    'websocket_send_100_buffered': send_100_buffered,
+}
+
+
+if __name__ == '__main__':
+    from run import run_cases
+    run_cases(CASES)
@@ -0,0 +1,77 @@
+"""
+The fixed app used by the request benchmarks and the load generator, so runs
+on different machines and releases measure the same work.
+
+make_app() returns a spa.App with:
+
+    /hello/             a small text response
+    /api/things/<id>/   a JSON document of about 4 KB
+    /static/...         test/static through Static
+    /smart/...          test/static through SmartStatic, with a manifest
+
+make_stack() wraps it in the usual middlewares: JWT sessions and gzip.
+"""
+from werkzeug.test import EnvironBuilder
+
+import spa
+from spa.jwtcookie import JWTCookie, JWTSessionMiddleware
+from spa.middlewares import GzipMiddleware
+from spa.static import Static, SmartStatic
+from spa.static.smart import add_hash_to_filepath
+
+from util import static_folder
+
+SECRET_KEY = 'benchmark secret'
+
+THINGS = [{'id': i, 'name': 'thing %d' % i, 'tags': ['a', 'b', 'c'],
+           'price': i * 1.25, 'active': bool(i % 2)}
+          for i in range(50)]
+
+
+class Hello(spa.Handler):
+    def get(self):
+        return spa.Response('hello')
+
+
+class Thing(spa.JSONHandler):
+    def get(self, thing_id):
+        return {'id': thing_id, 'related': THINGS}
+
+
+smart_static = SmartStatic(static_folder, manifest=True,
+                           static_url_root='/smart/')
+
+
+def make_app():
+    return spa.App((
+        ('/hello/', 'hello', Hello),
+        ('/api/things/<int:thing_id>/', 'thing', Thing),
+        ('/static/<path:filepath>', 'static', Static(static_folder)),
+        ('/smart/<path:filepath>', 'smart', smart_static),
+    ))
+
+
+def make_stack(app=None):
+    app = app or make_app()
+    app = JWTSessionMiddleware(app, secret_key=SECRET_KEY)
+    return GzipMiddleware(app)
+
+
+def hashed_url(path):
+    """
+    The SmartStatic URL of a file in test/static, like '/css/test.css'.
+    """
+    return '/smart' + add_hash_to_filepath(
+        path, smart_static.get_path_hash(path))
+
+
+def session_cookie():
+    session = JWTCookie({'user_id': 42, 'name': 'benchmark'}, SECRET_KEY)
+    token = session.serialize()
+    if not isinstance(token, str):
+        token = token.decode('ascii')
+    return 'session=%s' % token
+
+
+def make_environ(path, **kwargs):
+    return EnvironBuilder(path, **kwargs).get_environ()
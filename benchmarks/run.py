@@ -0,0 +1,366 @@
+"""
+Run the benchmark suite, or put a real server under load.
+
+    python benchmarks/run.py                       # every case in bench_*.py
+    python benchmarks/run.py -k routing -k static  # cases matching either
+    python benchmarks/run.py --json results.json   # also save the results
+    python benchmarks/run.py --compare baseline.json
+
+With --compare, each case is checked against a saved run.  Cases more than
+--threshold slower than the baseline are reported as regressions, and the
+script exits with status 1, so it can gate a release.
+
+Cases are named module:case, like routing:router_static_path, from the CASES
+dicts of the bench_*.py modules here.  Each case's call count is calibrated
+to take at least --min-time seconds, and the best of --repeat runs is kept.
+
+    python benchmarks/run.py load --workers 2 --duration 10 --concurrency 16
+
+Load mode serves the fixture app (see fixtures.py) with spa.run on a free
+local port, and has --concurrency threads make keep-alive HTTP requests to it
+for --duration seconds, reporting throughput and latency percentiles per
+path.  The load generator shares the machine, and Python threads share the
+GIL, so treat its numbers as relative: compare them between releases on the
+same machine, not with other servers.
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import socket
+import sys
+import threading
+import time
+import timeit
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+
+LOAD_PATHS = ('/hello/', '/api/things/7/', '/static/css/test.css')
+
+
+def collect_cases(patterns=()):
+    """
+    Return a dict of 'module:case' names to setup functions, from every
+    bench_*.py module, keeping only those matching one of `patterns` (regexes)
+    if any are given.
+    """
+    cases = {}
+    for path in sorted(glob.glob(os.path.join(here, 'bench_*.py'))):
+        module_name = os.path.splitext(os.path.basename(path))[0]
+        module = importlib.import_module(module_name)
+        prefix = module_name[len('bench_'):]
+        for case_name, setup in module.CASES.items():
+            name = '%s:%s' % (prefix, case_name)
+            if not patterns or any(re.search(p, name) for p in patterns):
+                cases[name] = setup
+    return cases
+
+
+def calibrate(func, min_time):
+    """
+    Return how many calls of `func` take at least `min_time` seconds.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            return number
+        # Aim a little past min_time, so this usually converges in one step.
+        if elapsed > 0:
+            number = max(number * 2, int(number * min_time * 1.2 / elapsed))
+        else:
+            number *= 10
+
+
+def time_case(setup, repeat=5, min_time=0.2):
+    """
+    Time the callable made by `setup`, with a calibrated number of calls per
+    run, and return the best per-call time of `repeat` runs.
+    """
+    func = setup()
+    number = calibrate(func, min_time)
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    per_call = min(timings) / number
+    return {
+        'per_call_us': per_call * 1e6,
+        'ops_per_sec': 1.0 / per_call if per_call else None,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def environment():
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('spa').version
+    except Exception:
+        version = None
+    return {
+        'spa_version': version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def run_cases(cases, repeat=5, min_time=0.2):
+    """
+    Time each of `cases`, a dict of names to setup functions, and print the
+    results.  The bench_*.py modules use this when run on their own.
+    """
+    results = {}
+    for name in sorted(cases):
+        results[name] = result = time_case(cases[name], repeat, min_time)
+        print('%-50s %10.2f us %12.0f/s' % (name, result['per_call_us'],
+                                            result['ops_per_sec'] or 0))
+    return results
+
+
+def run_suite(args):
+    cases = collect_cases(args.k)
+    if not cases:
+        print('No cases match.', file=sys.stderr)
+        return {}
+    return run_cases(cases, args.repeat, args.min_time)
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how `results` differ from `baseline`, and return the names of cases
+    that got more than `threshold` (a fraction) slower.
+    """
+    regressions = []
+    print()
+    print('Compared with the baseline from %s:' %
+          baseline.get('environment', {}).get('time', 'an earlier run'))
+    old_cases = baseline.get('cases', {})
+    for name in sorted(results):
+        if name not in old_cases:
+            print('%-50s %10s' % (name, 'new'))
+            continue
+        old = old_cases[name]['per_call_us']
+        new = results[name]['per_call_us']
+        change = (new - old) / old if old else 0
+        if change > threshold:
+            verdict = 'SLOWER'
+            regressions.append(name)
+        elif change < -threshold:
+            verdict = 'faster'
+        else:
+            verdict = ''
+        print('%-50s %+9.1f%% %s' % (name, change * 100, verdict))
+    return regressions
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(port, workers):
+    from gevent.monkey import patch_all
+    patch_all()
+    import spa
+    from fixtures import make_app
+    spa.run(make_app(), port=port, gunicorn_config={
+        'bind': '127.0.0.1:%d' % port,
+        'workers': workers,
+        'accesslog': None,
+        'loglevel': 'warning',
+    })
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        sock = socket.socket()
+        try:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        finally:
+            sock.close()
+        time.sleep(0.2)
+    raise RuntimeError('Timed out waiting for the server to start')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def load_worker(port, paths, deadline, record):
+    try:
+        from http.client import HTTPConnection
+    except ImportError:
+        from httplib import HTTPConnection
+
+    conn = HTTPConnection('127.0.0.1', port, timeout=10)
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = timeit.default_timer()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 500
+        except Exception:
+            ok = False
+            conn.close()
+            conn = HTTPConnection('127.0.0.1', port, timeout=10)
+        record(path, timeit.default_timer() - start, ok)
+    conn.close()
+
+
+def generate_load(port, paths, duration, concurrency, warmup):
+    latencies = dict((path, []) for path in paths)
+    errors = dict((path, 0) for path in paths)
+    recording = [False]
+
+    def record(path, elapsed, ok):
+        if not recording[0]:
+            return
+        if ok:
+            latencies[path].append(elapsed)
+        else:
+            errors[path] += 1
+
+    deadline = time.time() + warmup + duration
+    threads = [threading.Thread(target=load_worker,
+                                args=(port, paths, deadline, record))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(warmup)
+    recording[0] = True
+    for thread in threads:
+        thread.join()
+
+    results = {}
+    for path in paths:
+        values = sorted(latencies[path])
+        results[path] = {
+            'requests': len(values),
+            'errors': errors[path],
+            'requests_per_sec': len(values) / float(duration),
+            'p50_ms': percentile(values, 0.5) * 1e3 if values else None,
+            'p90_ms': percentile(values, 0.9) * 1e3 if values else None,
+            'p99_ms': percentile(values, 0.99) * 1e3 if values else None,
+        }
+    return results
+
+
+def run_load(args):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, args.workers))
+    server.start()
+    try:
+        wait_for_port(port)
+        results = generate_load(port, args.path or LOAD_PATHS, args.duration,
+                                args.concurrency, args.warmup)
+    finally:
+        server.terminate()
+        server.join()
+
+    for path, result in sorted(results.items()):
+        times = tuple('%.2fms' % result[key] if result[key] is not None
+                      else '-' for key in ('p50_ms', 'p90_ms', 'p99_ms'))
+        print('%-30s %8.0f req/s  p50 %8s  p90 %8s  p99 %8s  errors %d' % (
+            (path, result['requests_per_sec']) + times +
+            (result['errors'],)))
+    return results
+
+
+def compare_load(results, baseline, threshold):
+    regressions = []
+    old_paths = baseline.get('load', {})
+    print()
+    print('Compared with the baseline from %s:' %
+          baseline.get('environment', {}).get('time', 'an earlier run'))
+    for path in sorted(results):
+        old = old_paths.get(path)
+        if not old or not old.get('requests_per_sec'):
+            print('%-30s %10s' % (path, 'new'))
+            continue
+        change = ((results[path]['requests_per_sec'] -
+                   old['requests_per_sec']) / old['requests_per_sec'])
+        verdict = ''
+        if change < -threshold:
+            verdict = 'SLOWER'
+            regressions.append(path)
+        elif change > threshold:
+            verdict = 'faster'
+        print('%-30s %+9.1f%% req/s %s' % (path, change * 100, verdict))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mode', nargs='?', default='suite',
+                        choices=('suite', 'load'))
+    parser.add_argument('-k', action='append', default=[],
+                        help='only run cases whose name matches this regex')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds each timed run should take at least')
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='compare with results saved by '
+                        '--json on an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction slower than the baseline that counts '
+                        'as a regression')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--path', action='append',
+                        help='path to request in load mode (default: %s)' %
+                        ', '.join(LOAD_PATHS))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = {'environment': environment()}
+    if args.mode == 'load':
+        output['load'] = results = run_load(args)
+        check = compare_load
+    else:
+        output['cases'] = results = run_suite(args)
+        check = compare
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = check(results, baseline, args.threshold)
+        if regressions:
+            print()
+            print('%d regression(s) beyond %.0f%%.' % (len(regressions),
+                                                       args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
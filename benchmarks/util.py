@@ -0,0 +1,11 @@
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+Each benchmark module defines a CASES dict mapping a case name to a setup
+function.  The setup function does any one-time preparation and returns a
+no-argument callable, which is what gets timed, by run.py's time_case.
+"""
+import os
+
+here = os.path.dirname(os.path.realpath(__file__))
+static_folder = os.path.join(here, '..', 'test', 'static')
@@ -0,0 +1,51 @@
+from gevent.monkey import patch_all; patch_all()
+
+import threading
+import time
+
+import spa
+from spa.broadcast import default_backend
+from spa.hub import Hub
+
+# Under spa.run, the default backend delivers messages published in any
+# worker to clients connected to all of them.
+hub = Hub(backend=default_backend())
+ticker_lock = threading.Lock()
+ticker = None
+
+
+def start_ticker():
+    # Started on first use, in each worker process, since threads don't
+    # survive gunicorn forking its workers.
+    global ticker
+    with ticker_lock:
+        if ticker is None:
+            ticker = threading.Thread(target=count)
+            ticker.daemon = True
+            ticker.start()
+
+
+class Counter(spa.Handler):
+    """
+    Like the simple_websocket example, but every client shares one counter,
+    which is encoded once per tick however many clients are connected.
+    """
+    def websocket(self):
+        start_ticker()
+        hub.subscribe(self.ws, 'counter').run()
+
+
+def count():
+    counter = 0
+    while True:
+        hub.publish('counter', {'count': counter})
+        counter += 1
+        time.sleep(1)
+
+
+routes = (
+    ('/', 'counter', Counter),
+)
+
+app = spa.App(routes)
+spa.run(app)
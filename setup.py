@@ -26,6 +26,11 @@ setup_params = dict(
         'utc>=0.0.3',
         'Werkzeug>=0.10.1',
     ],
+    entry_points={
+        'console_scripts': [
+            'spa-manifest = spa.static.manifest:main',
+        ],
+    },
     description=('A Python micro framework for REST APIs and single-page-applications.'),
 )
 
@@ -1,5 +1,52 @@
-from spa.wrappers import Request, Response, JSONResponse
-from spa.handler import Handler, JSONHandler
-from spa.app import App
-from spa.utils import run
-from spa.static import StaticHandler
+"""
+Spa's public API.  On Python 3.7 and later, each name is only imported when
+it's first used, so `import spa` stays cheap for scripts and tools that only
+need part of it.
+"""
+import importlib
+import sys
+
+# Where each public name lives.
+_exports = {
+    'Request': 'spa.wrappers',
+    'Response': 'spa.wrappers',
+    'JSONResponse': 'spa.wrappers',
+    'JSONStreamResponse': 'spa.wrappers',
+    'Handler': 'spa.handler',
+    'JSONHandler': 'spa.handler',
+    'App': 'spa.app',
+    'run': 'spa.utils',
+    'StaticHandler': 'spa.static',
+}
+
+__all__ = sorted(_exports)
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        module = _exports.get(name)
+        if module is None:
+            # Submodules, like spa.static, used to be loaded by `import spa`.
+            submodule = '%s.%s' % (__name__, name)
+            try:
+                return importlib.import_module(submodule)
+            except ImportError as e:
+                # Only a missing submodule means a missing attribute.  Other
+                # errors, like a dependency it needs, are real.
+                if e.name != submodule:
+                    raise
+                raise AttributeError('module %r has no attribute %r' %
+                                     (__name__, name))
+        value = getattr(importlib.import_module(module), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_exports))
+else:
+    from spa.wrappers import (Request, Response, JSONResponse,
+                              JSONStreamResponse)
+    from spa.handler import Handler, JSONHandler
+    from spa.app import App
+    from spa.utils import run
+    from spa.static import StaticHandler
@@ -1,37 +1,230 @@
-from werkzeug.exceptions import HTTPException
+from werkzeug._compat import wsgi_decoding_dance
+from werkzeug.exceptions import HTTPException, NotFound
 from werkzeug.routing import Map, Rule
 
+from spa.metrics import UNMATCHED, clock, measure_body
 from spa.wrappers import Request
 
 
 class App(object):
-    def __init__(self, urls, settings=None, request_class=None):
+    def __init__(self, urls, settings=None, request_class=None, metrics=None):
         self.urls = urls
         self.settings = settings
         self.map, self.handlers = build_rules(urls)
+        self.router = Router(self.map)
         self.request_class = request_class or Request
+        self._not_found = None
+
+        # A spa.metrics.Metrics, to record timings per route.
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_routes(self.handlers)
 
     def __call__(self, environ, start_response):
+        if self.metrics is not None:
+            return self.measured_call(environ, start_response)
+
         try:
             wsgi_app = self.get_handler(environ)
             resp = wsgi_app(environ, start_response)
         except HTTPException as e:
-            wsgi_app = e
-            resp = wsgi_app(environ, start_response)
+            resp = self.handle_http_exception(e, environ, start_response)
 
         return resp
 
+    def measured_call(self, environ, start_response):
+        """
+        Like __call__, but recording the request in self.metrics.
+        """
+        metrics = self.metrics
+        start = clock()
+        profiler = metrics.profiler
+        profile = profiler.start() if profiler is not None else None
+        route_name = UNMATCHED
+        try:
+            try:
+                route_name, params = self.router.match(environ)
+                wsgi_app = self.make_handler(environ, route_name, params)
+            except HTTPException as e:
+                route = metrics.get(UNMATCHED)
+                handler_start = clock()
+                route.match.observe(handler_start - start)
+                resp = self.handle_http_exception(e, environ, start_response)
+            else:
+                route = metrics.get(route_name)
+                handler_start = clock()
+                route.match.observe(handler_start - start)
+                try:
+                    resp = wsgi_app(environ, start_response)
+                except HTTPException as e:
+                    resp = self.handle_http_exception(e, environ,
+                                                      start_response)
+                except Exception:
+                    route.errors += 1
+                    raise
+            route.handler.observe(clock() - handler_start)
+        finally:
+            if profile is not None:
+                profiler.finish(profile, route_name)
+        return measure_body(resp, route, start, environ)
+
     def get_handler(self, environ):
-        req = self.request_class(environ)
-        adapter = self.map.bind_to_environ(environ)
-        route_name, params = adapter.match()
+        # Match first, so requests that don't match a route never pay for
+        # building a Request.
+        route_name, params = self.router.match(environ)
+        return self.make_handler(environ, route_name, params)
+
+    def make_handler(self, environ, route_name, params):
         cls, kwargs = self.handlers[route_name]
+        req = self.request_class(environ)
         return cls(self, req, params, route_name, **kwargs)
 
+    def handle_http_exception(self, e, environ, start_response):
+        if isinstance(e, NotFound):
+            return self.not_found(e, environ, start_response)
+        return e(environ, start_response)
+
+    def not_found(self, e, environ, start_response):
+        """
+        Respond with a 404.  Plain NotFound errors, like the ones raised by
+        routing, all get the same page, so it's rendered once and reused.
+        """
+        if type(e) is not NotFound or e.description != NotFound.description:
+            return e(environ, start_response)
+
+        if self._not_found is None:
+            body = e.get_body(environ).encode('utf-8')
+            headers = e.get_headers(environ)
+            headers.append(('Content-Length', str(len(body))))
+            status = '%d %s' % (e.code, e.name.upper())
+            self._not_found = status, headers, body
+
+        status, headers, body = self._not_found
+        start_response(status, list(headers))
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body]
+
+    def warm(self):
+        """
+        Do the work that would otherwise wait for the first requests: sort the
+        URL map's rules, and call warm() on route handler objects that have
+        it, like Static, SmartStatic and HomePage.  spa.run calls this in the
+        gunicorn master when preloading, so that workers start out warm.
+        """
+        self.map.update()
+        for handler, kwargs in self.handlers.values():
+            warm = getattr(handler, 'warm', None)
+            if warm is not None and not isinstance(handler, type):
+                warm()
+
+    def as_asgi(self, **kwargs):
+        """
+        Return an ASGI application serving this app.  See spa.asgi.
+        """
+        from spa.asgi import ASGIApp
+        return ASGIApp(self, **kwargs)
+
     def url(self, endpoint, **values):
         return self.map.bind('').build(endpoint, values=values)
 
 
+class Router(object):
+    """
+    Matches WSGI environs against a werkzeug Map.
+
+    Rules without any URL parameters are kept in a dict keyed by path, so
+    requests for them are matched with a single lookup, without running any
+    regexes.  Everything else goes through werkzeug's normal matching, using a
+    MapAdapter that's cached per host, scheme and script name instead of being
+    built for every request.
+    """
+
+    # Host headers come from the client, so don't let them grow the adapter
+    # cache without limit.
+    max_adapters = 64
+
+    def __init__(self, url_map):
+        self.map = url_map
+        self.static_routes = {}
+        if not url_map.host_matching:
+            for rule in url_map.iter_rules():
+                if is_static_rule(rule):
+                    self.static_routes.setdefault(rule.rule, rule.endpoint)
+        self.adapters = {}
+
+        self.static_matches = 0
+        self.dynamic_matches = 0
+        self.failed_matches = 0
+
+    def get_adapter(self, environ):
+        key = (
+            environ['wsgi.url_scheme'],
+            environ.get('HTTP_HOST'),
+            environ.get('SERVER_NAME'),
+            environ.get('SERVER_PORT'),
+            environ.get('SCRIPT_NAME'),
+        )
+        adapter = self.adapters.get(key)
+        if adapter is None:
+            if len(self.adapters) >= self.max_adapters:
+                self.adapters.clear()
+            adapter = self.adapters[key] = self.map.bind_to_environ(environ)
+        return adapter
+
+    def match(self, environ):
+        """
+        Return a (route_name, params) tuple for the request in `environ`, or
+        raise an HTTPException (like NotFound, or RequestRedirect for a missing
+        trailing slash) if it doesn't match a route.
+        """
+        path_info = environ.get('PATH_INFO', '')
+        route_name = self.static_routes.get(path_info)
+        if route_name is not None:
+            self.static_matches += 1
+            return route_name, {}
+
+        adapter = self.get_adapter(environ)
+        charset = self.map.charset
+        try:
+            match = adapter.match(
+                wsgi_decoding_dance(path_info, charset),
+                environ['REQUEST_METHOD'],
+                query_args=wsgi_decoding_dance(environ.get('QUERY_STRING', ''),
+                                               charset),
+            )
+        except HTTPException:
+            self.failed_matches += 1
+            raise
+        self.dynamic_matches += 1
+        return match
+
+    def stats(self):
+        return {
+            'static_routes': len(self.static_routes),
+            'static_matches': self.static_matches,
+            'dynamic_matches': self.dynamic_matches,
+            'failed_matches': self.failed_matches,
+            'cached_adapters': len(self.adapters),
+        }
+
+
+def is_static_rule(rule):
+    """
+    True if a request path that's exactly equal to `rule.rule` is sure to
+    match `rule`, with no URL parameters.
+    """
+    try:
+        rule.rule.encode('ascii')
+    except UnicodeError:
+        # Non-ASCII rules are compared against decoded paths by werkzeug, and
+        # PATH_INFO isn't decoded.
+        return False
+    return (not rule.arguments and not rule.methods and not rule.subdomain and
+            not rule.build_only and rule.redirect_to is None and
+            rule.rule.startswith('/'))
+
+
 def build_rules(rules_tuples):
     handlers = {}
     rules = []
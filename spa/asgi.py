@@ -0,0 +1,502 @@
+"""
+Run spa apps under an ASGI server, like uvicorn:
+
+    app = spa.App(routes)
+    asgi_app = app.as_asgi()
+
+    # then: uvicorn mymodule:asgi_app
+    # or:   spa.asgi.run_asgi(asgi_app)
+
+Handler methods (get, post, websocket, etc.) may be defined with `async def`.
+When the app handed to ASGIApp is a spa.App, or one wrapped only in spa
+Middlewares, those run straight on the event loop.  Everything else,
+including ordinary synchronous handlers, static files and apps wrapped in
+other WSGI middlewares, runs in a thread pool as plain WSGI.
+Async handler methods reached that way are run on the event loop, with the
+calling thread waiting for the result.
+
+Websocket handlers get a `self.ws` with the same receive(), send() and
+close() methods as gwebsocket's.  For `async def websocket` handlers they're
+coroutines.
+
+This module needs Python 3.5 or later.
+"""
+import asyncio
+import functools
+import inspect
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+from spa.app import App
+from spa.handler import Handler
+from spa.metrics import clock, measure_body
+from spa.middlewares import Pipeline, is_hook_layer
+from spa.utils import find_spa_app
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+
+# The environ key where the event loop is kept, for wait_for().
+LOOP_KEY = 'spa.asgi.loop'
+
+
+def wait_for(environ, awaitable):
+    """
+    Run `awaitable` to completion from synchronous code, and return its
+    result.  Under ASGIApp, it runs on the server's event loop while this
+    thread waits.  Otherwise it gets an event loop of its own.
+    """
+    async def run():
+        return await awaitable
+
+    loop = environ.get(LOOP_KEY)
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(run(), loop).result()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def build_environ(scope, body):
+    """
+    Make a WSGI environ from an ASGI connection scope and request body.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    scheme = scope.get('scheme', 'http')
+    if scheme in ('ws', 'wss'):
+        scheme = 'https' if scheme == 'wss' else 'http'
+
+    # WSGI wants paths as the latin-1 decoding of the raw bytes.
+    environ = {
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+                                                 .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scheme,
+        'wsgi.input': io.BytesIO(body),
+        # The whole body has been read, so it can be read to the end even
+        # without a Content-Length.
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            value = environ[key] + separator + value
+        environ[key] = value
+    return environ
+
+
+def call_wsgi(app, environ):
+    """
+    Call a WSGI app, and start iterating its response, so that start_response
+    has surely been called.  Returns (status, headers, first_chunk, rest,
+    body), where `rest` is an iterator over the remaining chunks and `body` is
+    the response iterable itself, for closing.
+    """
+    response = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and 'status' in response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response['status'] = status
+        response['headers'] = headers
+        return written.append
+
+    body = app(environ, start_response)
+    rest = iter(body)
+    first = b''
+    for chunk in rest:
+        if chunk:
+            first = chunk
+            break
+    if written:
+        first = b''.join(written) + first
+    return response['status'], response['headers'], first, rest, body
+
+
+class ASGIWebSocket(object):
+    """
+    A websocket on an ASGI connection, with coroutine versions of
+    gwebsocket's receive(), send() and close().
+    """
+
+    def __init__(self, receive, send, loop=None):
+        self._receive = receive
+        self._send = send
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.closed = False
+        self._close_callbacks = []
+        # The handler's spa.heartbeat.Heartbeat, told about every message.
+        self.heartbeat = None
+
+    def add_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def _set_closed(self):
+        if not self.closed:
+            self.closed = True
+            for callback in self._close_callbacks:
+                callback()
+
+    async def receive(self):
+        """
+        Return the next message, as text or bytes, or None once the socket is
+        closed.
+        """
+        while not self.closed:
+            message = await self._receive()
+            if self.heartbeat is not None:
+                self.heartbeat.touch(self)
+            if message['type'] == 'websocket.disconnect':
+                self._set_closed()
+            elif message['type'] == 'websocket.receive':
+                if message.get('text') is not None:
+                    return message['text']
+                return message.get('bytes')
+        return None
+
+    async def send(self, data):
+        if isinstance(data, bytes):
+            message = {'type': 'websocket.send', 'bytes': data}
+        else:
+            message = {'type': 'websocket.send', 'text': data}
+        await self._send(message)
+
+    async def close(self, code=1000, message=''):
+        if not self.closed:
+            await self._send({'type': 'websocket.close', 'code': code})
+            self._set_closed()
+
+    def close_threadsafe(self, code=1000, message=''):
+        """
+        Close the socket from another thread, like a Heartbeat's, without
+        waiting for it to be closed.
+        """
+        asyncio.run_coroutine_threadsafe(self.close(code, message), self.loop)
+
+
+class SyncWebSocket(object):
+    """
+    Blocking wrapper around an ASGIWebSocket, for synchronous websocket
+    handlers running in a worker thread.
+    """
+
+    def __init__(self, ws, loop):
+        self.ws = ws
+        self.loop = loop
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    def add_close_callback(self, callback):
+        self.ws.add_close_callback(callback)
+
+    def _wait(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def receive(self):
+        return self._wait(self.ws.receive())
+
+    def send(self, data):
+        return self._wait(self.ws.send(data))
+
+    def close(self, code=1000, message=''):
+        return self._wait(self.ws.close(code, message))
+
+
+def async_method(handler, name):
+    """
+    Return the handler's method called `name` if it's a coroutine function,
+    or None.
+    """
+    if not isinstance(handler, Handler):
+        return None
+    method = getattr(handler, name, None)
+    if inspect.iscoroutinefunction(method):
+        return method
+    return None
+
+
+def async_route_methods(app):
+    """
+    Map the names of `app`'s routes to Handler classes to the names of
+    their methods defined with `async def`, leaving out routes without any.
+    """
+    routes = {}
+    for route_name, (cls, kwargs) in app.handlers.items():
+        if not (isinstance(cls, type) and issubclass(cls, Handler)):
+            continue
+        names = set(method.lower() for method in cls.allowed_methods
+                    if inspect.iscoroutinefunction(
+                        getattr(cls, method.lower(), None)))
+        if names:
+            routes[route_name] = names
+    return routes
+
+
+def hook_layers(app):
+    """
+    Return the spa Middleware layers wrapped around the spa.App in `app`,
+    outermost first, and whether they're all that wraps it (False if some
+    other WSGI middleware does too).
+    """
+    layers = []
+    only_hooks = True
+    seen = set()
+    while (app is not None and not isinstance(app, App) and
+           id(app) not in seen):
+        seen.add(id(app))
+        if is_hook_layer(app):
+            layers.append(app)
+        elif isinstance(app, Pipeline):
+            layers.extend(app.middlewares)
+        else:
+            only_hooks = False
+        app = getattr(app, 'app', None)
+    return layers, only_hooks
+
+
+class ASGIApp(object):
+    """
+    ASGI application that serves a spa.App, or any WSGI app (like a spa.App
+    wrapped in middlewares).  Synchronous code runs in a thread pool of
+    `max_workers` threads.
+
+    spa Middlewares and Pipelines around the App have their hooks run here,
+    so async handlers behind them still run on the event loop, and websockets
+    get through them.  If any other WSGI middleware wraps the App, HTTP
+    requests go through the whole stack in the thread pool instead.
+    """
+
+    def __init__(self, app, max_workers=None):
+        self.app = app
+        self.spa_app = find_spa_app(app)
+        layers, only_hooks = hook_layers(app)
+        # Runs the hook layers' process_request and process_response, for
+        # requests that skip the WSGI stack.
+        self.pipeline = Pipeline(self.spa_app, layers)
+        self.native = self.spa_app is not None and only_hooks
+        self.async_routes = (async_route_methods(self.spa_app)
+                             if self.native else {})
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self.handle_websocket(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(scope, receive, send)
+
+    def run_sync(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    async def handle_http(self, scope, receive, send):
+        environ = build_environ(scope, await self.read_body(receive))
+        environ[LOOP_KEY] = asyncio.get_event_loop()
+
+        if not self.native:
+            await self.send_wsgi_response(self.app, environ, send)
+            return
+
+        wsgi_app, responders = self.pipeline.process_request(environ)
+        if wsgi_app is None and self.async_routes:
+            wsgi_app = await self.call_async_handler(environ)
+        await self.send_wsgi_response(wsgi_app or self.spa_app, environ, send,
+                                      responders)
+
+    async def call_async_handler(self, environ):
+        """
+        If the request is routed to an async handler method, run it here on
+        the event loop, and return a WSGI app that sends its response.
+        Otherwise return None, leaving the request to the App, which renders
+        errors (like its cached 404 page) and records metrics the same way
+        under ASGI as under WSGI.
+        """
+        app = self.spa_app
+        start = clock()
+        try:
+            route_name, params = app.router.match(environ)
+        except HTTPException:
+            return None
+        name = environ['REQUEST_METHOD'].lower()
+        if name not in self.async_routes.get(route_name, ()):
+            return None
+        handler = app.make_handler(environ, route_name, params)
+        if environ['REQUEST_METHOD'] not in handler.allowed_methods:
+            return None
+
+        route = None
+        if app.metrics is not None:
+            # The profiler only sees the thread that started it, so async
+            # handlers aren't sampled.
+            route = app.metrics.get(route_name)
+            handler_start = clock()
+            route.match.observe(handler_start - start)
+        try:
+            resp = await getattr(handler, name)(**params)
+            if hasattr(handler, 'to_response'):
+                resp = handler.to_response(resp)
+        except HTTPException as e:
+            resp = functools.partial(app.handle_http_exception, e)
+        except Exception:
+            if route is not None:
+                route.errors += 1
+            raise
+        if route is None:
+            return resp
+
+        route.handler.observe(clock() - handler_start)
+
+        def measured(environ, start_response):
+            return measure_body(resp(environ, start_response), route, start,
+                                environ)
+        return measured
+
+    async def send_wsgi_response(self, wsgi_app, environ, send,
+                                 responders=()):
+        """
+        Send `wsgi_app`'s response, after letting the middlewares in
+        `responders` (see Pipeline.process_request) change its headers.
+        """
+        status, headers, first, rest, body = await self.run_sync(
+            call_wsgi, wsgi_app, environ)
+        try:
+            Pipeline.process_response(responders, environ, status, headers)
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            await send({'type': 'http.response.body', 'body': first,
+                        'more_body': True})
+            if isinstance(body, (list, tuple)):
+                # Already in memory, so there's no need for a thread.
+                for chunk in rest:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            else:
+                # Generators and files might block.
+                while True:
+                    chunk = await self.run_sync(next, rest, None)
+                    if chunk is None:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(body, 'close'):
+                await self.run_sync(body.close)
+
+    async def handle_websocket(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        loop = asyncio.get_event_loop()
+        environ = build_environ(scope, b'')
+        environ[LOOP_KEY] = loop
+        ws = ASGIWebSocket(receive, send, loop)
+
+        # Websockets are only routed to spa Handlers, through the hooks of any
+        # spa Middlewares around the App.  Other WSGI middlewares are skipped.
+        handler = None
+        if self.spa_app is not None:
+            rejection, responders = self.pipeline.process_request(environ)
+            if rejection is not None:
+                # Policy violation.
+                await send({'type': 'websocket.close', 'code': 1008})
+                return
+            try:
+                handler = self.spa_app.get_handler(environ)
+            except HTTPException:
+                pass
+        if not isinstance(handler, Handler):
+            await send({'type': 'websocket.close', 'code': 1000})
+            return
+
+        is_async = async_method(handler, 'websocket') is not None
+        ws.heartbeat = handler.heartbeat
+        environ['wsgi.websocket'] = ws if is_async else SyncWebSocket(ws, loop)
+        accept = {'type': 'websocket.accept'}
+        headers = []
+        Pipeline.process_response(responders, environ,
+                                  '101 Switching Protocols', headers)
+        if headers:
+            accept['headers'] = [(name.lower().encode('latin-1'),
+                                  value.encode('latin-1'))
+                                 for name, value in headers]
+        await send(accept)
+        method = handler._get_handler()
+        try:
+            if is_async:
+                await method(**handler.params)
+            else:
+                await self.run_sync(lambda: method(**handler.params))
+        finally:
+            await ws.close()
+
+    async def handle_lifespan(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def run_asgi(app, host='0.0.0.0', port=8000, **kwargs):
+    """
+    Serve an ASGIApp (or a spa.App, which will be wrapped in one) with
+    uvicorn.  Extra kwargs are passed to uvicorn.run.
+    """
+    if uvicorn is None:
+        raise RuntimeError('run_asgi needs uvicorn installed')
+    if isinstance(app, App):
+        app = ASGIApp(app)
+    uvicorn.run(app, host=host, port=port, **kwargs)
@@ -0,0 +1,239 @@
+"""
+Backends for sending spa.hub messages between worker processes.
+
+A Hub on its own only reaches sockets held by its own process.  Give it a
+backend, and everything published in any worker is delivered to subscribers
+in all of them:
+
+    from spa.broadcast import default_backend
+    hub = Hub(backend=default_backend())
+
+Backends have a small, Redis-like interface: publish(channel, message) sends
+a spa.hub.Message to every process, and subscribe(callback) registers a
+callback(channel, message) to be called for each message that arrives,
+including ones published by this process.  The Hub calls start() before
+publishing or subscribing sockets, so backends can set themselves up in each
+worker after it's forked.
+
+UnixSocketBackend, the default under spa.run, sends each message as a
+datagram to a Unix socket per worker, in a directory set up by the gunicorn
+master and passed to workers in the SPA_BROADCAST_DIR environment variable.
+spa.run only sets that directory up if a UnixSocketBackend without a
+directory of its own has been made by then, so make the backend when the app
+is built, not in the workers.
+LocalBackend only delivers within the process, for running without gunicorn
+and for tests.
+"""
+import errno
+import glob
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+
+from spa.hub import Message
+
+ENV_VAR = 'SPA_BROADCAST_DIR'
+
+# The most a datagram can hold with default Linux socket buffer sizes, less
+# room for our header.
+MAX_MESSAGE_SIZE = 200 * 1024
+
+_header = struct.Struct('!BH')
+
+# Whether a UnixSocketBackend is waiting for SPA_BROADCAST_DIR.
+_directory_wanted = False
+
+
+def directory_wanted():
+    """
+    True if a UnixSocketBackend has been made without a directory, so it'll
+    look for one in SPA_BROADCAST_DIR.
+    """
+    return _directory_wanted
+
+
+def encode_packet(channel, message):
+    channel = channel.encode('utf-8')
+    return _header.pack(message.opcode, len(channel)) + channel + message.payload
+
+
+def decode_packet(packet):
+    opcode, channel_length = _header.unpack_from(packet)
+    start = _header.size
+    channel = packet[start:start + channel_length].decode('utf-8')
+    payload = packet[start + channel_length:]
+    return channel, Message.from_payload(payload, opcode)
+
+
+class LocalBackend(object):
+    """
+    Delivers messages to subscribers in this process only.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def start(self):
+        pass
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def publish(self, channel, message):
+        for callback in self.callbacks:
+            callback(channel, message)
+
+    def close(self):
+        pass
+
+
+class UnixSocketBackend(LocalBackend):
+    """
+    Delivers messages to every process with a UnixSocketBackend using the same
+    `directory` (by default, the one named by SPA_BROADCAST_DIR when the
+    backend starts).  With no directory, it only delivers within the process,
+    like LocalBackend.
+
+    Each process binds a datagram socket in the directory when the backend
+    starts, and listens on it in a background thread (a greenlet, under
+    gevent).  Publishing sends one datagram to every socket in
+    the directory.  If a worker's socket buffer is full, that worker misses
+    the message, rather than holding up the publisher; `dropped` counts those.
+
+    Messages can be at most MAX_MESSAGE_SIZE bytes.
+    """
+
+    # How often to look for sockets of newly started workers.
+    refresh_interval = 1.0
+
+    def __init__(self, directory=None):
+        global _directory_wanted
+        super(UnixSocketBackend, self).__init__()
+        self.directory = directory
+        if directory is None:
+            _directory_wanted = True
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Bind this process's socket and start listening, if that hasn't been
+        done since the process started (or forked).
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.socket = self.sender = None
+            self._peers = ()
+            self._peers_checked = 0
+            self.directory = self.directory or os.environ.get(ENV_VAR)
+            if not self.directory:
+                self._pid = os.getpid()
+                return
+
+            self.path = os.path.join(self.directory,
+                                     '%d-%s.sock' % (os.getpid(),
+                                                     uuid.uuid4().hex[:8]))
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(self.path)
+            self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sender.setblocking(False)
+
+            listener = threading.Thread(target=self._listen,
+                                        args=(self.socket,))
+            listener.daemon = True
+            listener.start()
+            self._pid = os.getpid()
+
+    def get_peers(self):
+        if self.socket is None:
+            return ()
+        now = time.time()
+        if now - self._peers_checked >= self.refresh_interval:
+            self._peers = tuple(
+                path for path in glob.glob(os.path.join(self.directory,
+                                                        '*.sock'))
+                if path != self.path
+            )
+            self._peers_checked = now
+        return self._peers
+
+    def publish(self, channel, message):
+        self.start()
+        packet = encode_packet(channel, message)
+        if len(packet) > MAX_MESSAGE_SIZE:
+            raise ValueError('Message is too big to broadcast (%d bytes)'
+                             % len(packet))
+
+        for path in self.get_peers():
+            try:
+                self.sender.sendto(packet, path)
+                self.sent += 1
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # That worker is gone.
+                    self._remove_peer(path)
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.ENOBUFS):
+                    self.dropped += 1
+                else:
+                    raise
+
+        # Deliver to our own subscribers directly.
+        super(UnixSocketBackend, self).publish(channel, message)
+
+    def _remove_peer(self, path):
+        self._peers = tuple(p for p in self._peers if p != path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _listen(self, sock):
+        while True:
+            try:
+                packet = sock.recv(MAX_MESSAGE_SIZE + 1024)
+            except socket.error:
+                return
+            try:
+                channel, message = decode_packet(packet)
+            except (struct.error, UnicodeError):
+                continue
+            self.received += 1
+            for callback in self.callbacks:
+                callback(channel, message)
+
+    def close(self):
+        if self._pid != os.getpid() or self.socket is None:
+            return
+        self._pid = None
+        try:
+            # Wakes up the listener.
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        for sock in (self.socket, self.sender):
+            sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def default_backend():
+    """
+    A backend that broadcasts between workers when running under spa.run (or
+    anything else that sets SPA_BROADCAST_DIR), and otherwise only within the
+    process.
+    """
+    return UnixSocketBackend()
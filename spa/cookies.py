@@ -0,0 +1,79 @@
+"""
+Parse-once access to request cookies.
+
+get_cookies(environ) parses the Cookie header the first time it's called for a
+request, and caches the result in the environ, so the session and CSRF
+middlewares and the Request object all share one parse.  The parser is a
+simple split on ';' and '=', which is much faster than SimpleCookie for long
+headers.
+"""
+import re
+
+import six
+
+ENVIRON_KEY = 'spa.cookies'
+
+_escape_re = re.compile(r'\\(?:([0-3][0-7][0-7])|(.))')
+
+
+def _unescape(match):
+    if match.group(1):
+        # chr() gives the native str type on both Python 2 and 3, matching
+        # the header.
+        return chr(int(match.group(1), 8))
+    return match.group(2)
+
+
+def unquote(value):
+    """
+    Strip the double quotes from a quoted cookie value, and undo backslash
+    escapes inside it, the way SimpleCookie does.
+    """
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return value
+    value = value[1:-1]
+    if '\\' in value:
+        value = _escape_re.sub(_unescape, value)
+    return value
+
+
+def parse_cookie_header(header):
+    """
+    Parse a Cookie header into a dict of names to values.  If a name appears
+    more than once, the first value wins, since browsers send the cookie with
+    the most specific path first.
+    """
+    cookies = {}
+    for part in header.split(';'):
+        name, sep, value = part.partition('=')
+        if not sep:
+            continue
+        name = name.strip()
+        if not name or name in cookies:
+            continue
+        cookies[name] = unquote(value.strip())
+    return cookies
+
+
+def get_cookies(environ):
+    """
+    Return a dict of the request's cookies, parsing the Cookie header only the
+    first time it's called for the request.  Treat the dict as read-only; it's
+    shared by everything handling the request.
+    """
+    header = environ.get('HTTP_COOKIE', '')
+    cached = environ.get(ENVIRON_KEY)
+    if cached is not None and cached[0] == header:
+        return cached[1]
+
+    text = header
+    if six.PY3:
+        # WSGI servers give us the header's bytes as latin-1.  Cookie values
+        # are conventionally UTF-8.
+        try:
+            text.encode('ascii')
+        except UnicodeError:
+            text = text.encode('latin-1').decode('utf-8', 'replace')
+    cookies = parse_cookie_header(text)
+    environ[ENVIRON_KEY] = (header, cookies)
+    return cookies
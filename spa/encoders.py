@@ -0,0 +1,160 @@
+"""
+Content codings (gzip, brotli, zstd) for compressing responses.
+
+gzip is always available.  Brotli needs the `brotli` package, and zstd the
+`zstandard` package; if they aren't installed, those encoders report themselves
+unavailable and are left out of the defaults.
+"""
+from spa import gzip_util
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Encoder(object):
+    """
+    Base class for encoders.  Subclasses set `name` to their content coding
+    token, and implement compressor(), which returns an object with compress(),
+    flush() and finish() methods, each returning bytes.
+
+    `min_size` is the smallest response, in bytes, worth compressing with this
+    encoder.
+    """
+    name = None
+    default_level = None
+    # Levels for compressing files once, ahead of time, where it's worth
+    # spending more CPU for smaller output.
+    static_level = None
+
+    def __init__(self, level=None, min_size=200):
+        self.level = self.default_level if level is None else level
+        self.min_size = min_size
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def compressor(self, level):
+        raise NotImplementedError
+
+    def compress_bytes(self, data, level=None):
+        """
+        Compress `data` all at once.
+        """
+        compressor = self.compressor(self.level if level is None else level)
+        return compressor.compress(data) + compressor.finish()
+
+    def compress(self, chunks, close=True, buffer_size=gzip_util.BUFFER_SIZE,
+                 flush_interval=None, flush_size=None):
+        """
+        Compress an iterable of byte chunks as a stream.  Buffering, flushing
+        and closing work as described for spa.gzip_util.compress_stream.
+        """
+        return gzip_util.compress_stream(self.compressor(self.level), chunks,
+                                         close=close, buffer_size=buffer_size,
+                                         flush_interval=flush_interval,
+                                         flush_size=flush_size)
+
+
+class GzipEncoder(Encoder):
+    name = 'gzip'
+    default_level = 6
+    static_level = 9
+
+    def compressor(self, level):
+        return gzip_util.GzipCompressor(level)
+
+
+class _BrotliCompressor(object):
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class BrotliEncoder(Encoder):
+    name = 'br'
+    # Brotli's own default, 11, is far too slow for compressing responses on
+    # the fly.  4 gives output about as small as gzip -9, faster than gzip -6.
+    default_level = 4
+    static_level = 11
+
+    @classmethod
+    def available(cls):
+        return brotli is not None
+
+    def compressor(self, level):
+        return _BrotliCompressor(level)
+
+
+class _ZstdCompressor(object):
+    def __init__(self, level):
+        self.compressobj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressobj.compress(data)
+
+    def flush(self):
+        return self.compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+class ZstdEncoder(Encoder):
+    name = 'zstd'
+    default_level = 3
+    static_level = 19
+
+    @classmethod
+    def available(cls):
+        return zstandard is not None
+
+    def compressor(self, level):
+        return _ZstdCompressor(level)
+
+
+ENCODERS = {
+    'br': BrotliEncoder,
+    'zstd': ZstdEncoder,
+    'gzip': GzipEncoder,
+}
+
+# All the content codings we know, in the order we prefer them when a client
+# likes more than one equally.
+PREFERENCE = ('br', 'zstd', 'gzip')
+
+
+def available_encodings():
+    return tuple(name for name in PREFERENCE if ENCODERS[name].available())
+
+
+def default_encoders(min_size=200):
+    return [ENCODERS[name](min_size=min_size) for name in available_encodings()]
+
+
+def compress_bytes(data, encoding):
+    """
+    Compress `data` with the named content coding, at the high compression
+    level used for static files.  Returns None if that encoding isn't
+    available.
+    """
+    encoder_class = ENCODERS.get(encoding)
+    if encoder_class is None or not encoder_class.available():
+        return None
+    encoder = encoder_class()
+    return encoder.compress_bytes(data, encoder.static_level)
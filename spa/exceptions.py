@@ -1,10 +1,11 @@
-import json
 import traceback
 
 from werkzeug.exceptions import HTTPException
 
 from werkzeug import exceptions
 
+from spa import jsonlib
+
 
 # Some freestanding methods for feeding into our dynamically-constructed
 # exception classes later.  They override the corresponding HTTPException
@@ -23,7 +24,7 @@ def get_body(self, environ=None):
     if self.traceback:
         tb = traceback.format_list(traceback.extract_tb(self.traceback))
         data['traceback'] = tb
-    return json.dumps(data)
+    return jsonlib.dumps(data).decode('utf-8')
 
 def get_headers(self, environ=None):
     return [('Content-Type', 'application/json')]
@@ -2,6 +2,22 @@ import zlib
 import struct
 import time
 
+
+COMPRESSABLE_MIMETYPES = (
+    'text/plain',
+    'text/html',
+    'text/css',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'text/xml',
+    'application/xml',
+    'application/xml+rss',
+    'text/javascript',
+    'application/x-ndjson',
+)
+
+
 def parse_encoding_header(header):
     """
     Break up the `HTTP_ACCEPT_ENCODING` header into a dict of the form,
@@ -10,16 +26,19 @@ def parse_encoding_header(header):
     encodings = {'identity':1.0}
 
     for encoding in header.split(","):
-        if(encoding.find(";") > -1):
-            encoding, qvalue = encoding.split(";")
-            encoding = encoding.strip()
-            qvalue = qvalue.split('=', 1)[1]
-            if(qvalue != ""):
-                encodings[encoding] = float(qvalue)
-            else:
-                encodings[encoding] = 1
-        else:
-            encodings[encoding] = 1
+        encoding, _, params = encoding.partition(";")
+        encoding = encoding.strip()
+        if not encoding:
+            continue
+        qvalue = 1
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == 'q' and value.strip():
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    pass
+        encodings[encoding] = qvalue
     return encodings
 
 
@@ -43,40 +62,144 @@ def gzip_requested(accept_encoding_header):
         return False
 
 
-# After much Googling and gnashing of teeth, this function stolen from
+def choose_encoding(accept_encoding_header, offered):
+    """
+    Return whichever of the `offered` content codings (like ('br', 'gzip')) the
+    client likes best, or None if it would rather have the response unencoded.
+    Ties go to whichever encoding comes first in `offered`.
+    """
+    encodings = parse_encoding_header(accept_encoding_header)
+    identity = encodings['identity']
+    wildcard = encodings.get('*', 0)
+
+    best, best_q = None, 0
+    for encoding in offered:
+        qvalue = encodings.get(encoding, wildcard)
+        if qvalue > best_q and qvalue >= identity:
+            best, best_q = encoding, qvalue
+    return best
+
+
+# How many bytes of compressed output compress_stream() collects before
+# yielding it.
+BUFFER_SIZE = 16 * 1024
+
+
+# After much Googling and gnashing of teeth, this approach stolen from
 # cherrypy.lib.encoding seems to be the most straightforward way to do gzip
 # encoding of a stream without loading the whole thing into memory at once.
-def compress(chunks, compress_level, close=True):
+class GzipCompressor(object):
     """
-    Compress 'chunks' at the given compress_level, where 'chunks' is an iterable
-    over chunks of bytes.  If close=True, then look for .close() method on chunks
-    and call that when done iterating.
+    Compresses a stream into gzip format: a raw deflate stream, with the gzip
+    header in front of the first output and the CRC and size trailer at the
+    end.  Has the same compress(), flush() and finish() methods as the
+    compressors of spa.encoders, each returning bytes.
     """
-    try:
+
+    def __init__(self, compress_level):
         # See http://www.gzip.org/zlib/rfc-gzip.html
-        yield b'\x1f\x8b'       # ID1 and ID2: gzip marker
-        yield b'\x08'           # CM: compression method
-        yield b'\x00'           # FLG: none set
-        # MTIME: 4 bytes
-        yield struct.pack("<L", int(time.time()) & int('FFFFFFFF', 16))
-        yield b'\x02'           # XFL: max compression, slowest algo
-        yield b'\xff'           # OS: unknown
-
-        crc = zlib.crc32(b"")
-        size = 0
-        zobj = zlib.compressobj(compress_level,
-                                zlib.DEFLATED, -zlib.MAX_WBITS,
-                                zlib.DEF_MEM_LEVEL, 0)
+        self.header = (
+            b'\x1f\x8b' +      # ID1 and ID2: gzip marker
+            b'\x08' +          # CM: compression method
+            b'\x00' +          # FLG: none set
+            # MTIME: 4 bytes
+            struct.pack("<L", int(time.time()) & int('FFFFFFFF', 16)) +
+            b'\x02' +          # XFL: max compression, slowest algo
+            b'\xff'            # OS: unknown
+        )
+        self.crc = zlib.crc32(b"")
+        self.size = 0
+        self.zobj = zlib.compressobj(compress_level,
+                                     zlib.DEFLATED, -zlib.MAX_WBITS,
+                                     zlib.DEF_MEM_LEVEL, 0)
+
+    def _with_header(self, out):
+        if self.header is None:
+            return out
+        out, self.header = self.header + out, None
+        return out
+
+    def compress(self, data):
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        out = self.zobj.compress(data)
+        if not out:
+            return out
+        return self._with_header(out)
+
+    def flush(self):
+        """
+        Return everything compressed so far, with a zlib sync flush.
+        """
+        return self._with_header(self.zobj.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self._with_header(
+            self.zobj.flush() +
+            # CRC32: 4 bytes
+            struct.pack("<L", self.crc & int('FFFFFFFF', 16)) +
+            # ISIZE: 4 bytes
+            struct.pack("<L", self.size & int('FFFFFFFF', 16))
+        )
+
+
+def compress_stream(compressor, chunks, close=True, buffer_size=BUFFER_SIZE,
+                    flush_interval=None, flush_size=None):
+    """
+    Compress 'chunks', an iterable over chunks of bytes, with `compressor`
+    (a GzipCompressor, or one made by a spa.encoders encoder).  If close=True,
+    then look for .close() method on chunks and call that when done iterating.
+
+    Compressed output is held back until there's at least `buffer_size` bytes
+    of it, so the server gets a few big writes instead of lots of tiny ones.
+    For responses that are streamed out over time, set `flush_interval` (in
+    seconds) and/or `flush_size` (in uncompressed bytes) to push out everything
+    compressed so far, with the compressor's flush(), at least that often.
+    Those limits are checked each time a chunk arrives from 'chunks'.
+    """
+    try:
+        buf, buffered = [], 0
+        flushing = flush_interval is not None or flush_size is not None
+        unflushed = 0
+        last_flush = time.time()
+
         for chunk in chunks:
-            size += len(chunk)
-            crc = zlib.crc32(chunk, crc)
-            yield zobj.compress(chunk)
-        yield zobj.flush()
-
-        # CRC32: 4 bytes
-        yield struct.pack("<L", crc & int('FFFFFFFF', 16))
-        # ISIZE: 4 bytes
-        yield struct.pack("<L", size & int('FFFFFFFF', 16))
+            out = compressor.compress(chunk)
+            if out:
+                buf.append(out)
+                buffered += len(out)
+
+            if flushing:
+                unflushed += len(chunk)
+                now = time.time()
+                if ((flush_size is not None and unflushed >= flush_size) or
+                        (flush_interval is not None and
+                         now - last_flush >= flush_interval)):
+                    buf.append(compressor.flush())
+                    yield b''.join(buf)
+                    buf, buffered = [], 0
+                    unflushed = 0
+                    last_flush = now
+                    continue
+
+            if buffered >= buffer_size:
+                yield b''.join(buf)
+                buf, buffered = [], 0
+
+        buf.append(compressor.finish())
+        yield b''.join(buf)
     finally:
         if close and hasattr(chunks, 'close'):
             chunks.close()
+
+
+def compress(chunks, compress_level, close=True, buffer_size=BUFFER_SIZE,
+             flush_interval=None, flush_size=None):
+    """
+    Gzip 'chunks' at the given compress_level.  See compress_stream for the
+    other arguments.
+    """
+    return compress_stream(GzipCompressor(compress_level), chunks,
+                           close=close, buffer_size=buffer_size,
+                           flush_interval=flush_interval,
+                           flush_size=flush_size)
@@ -1,8 +1,21 @@
 from __future__ import print_function
 
+import inspect
+
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+
 from werkzeug.exceptions import MethodNotAllowed
 
-from spa.wrappers import JSONResponse
+from spa.wrappers import JSONResponse, JSONStreamResponse
+
+
+def _is_coroutine_function(func):
+    check = getattr(inspect, 'iscoroutinefunction', None)
+    return check is not None and check(func)
+
 
 class Handler(object):
     """Baseclass for our handlers."""
@@ -11,6 +24,15 @@ class Handler(object):
                        'OPTIONS')
     get = post = delete = put = patch = options = NotImplemented
 
+    # Set to a dict of spa.websocket.BufferedWebSocket arguments to have
+    # self.ws buffer what's sent on it.  Doesn't apply to async websocket
+    # handlers.
+    websocket_buffering = None
+
+    # Set to a spa.heartbeat.Heartbeat to have it ping self.ws and close it
+    # when it goes quiet.
+    heartbeat = None
+
     def __init__(self, app, req, params, route_name, **kwargs):
         self.app = app
         self.request = req
@@ -19,7 +41,7 @@ class Handler(object):
         self.kwargs = kwargs
 
     def head(self, *args, **kwargs):
-        return self.get()
+        return self.get(*args, **kwargs)
 
     def websocket_close(self):
         pass
@@ -29,6 +51,13 @@ class Handler(object):
         if self.request.method == 'GET' and 'wsgi.websocket' in environ:
             self.ws = environ['wsgi.websocket']
             self.ws.add_close_callback(self.websocket_close)
+            if (self.websocket_buffering is not None and
+                    not _is_coroutine_function(self.ws.send)):
+                from spa.websocket import BufferedWebSocket
+                self.ws = BufferedWebSocket(self.ws,
+                                            **self.websocket_buffering)
+            if self.heartbeat is not None:
+                self.heartbeat.watch(self.ws)
 
             return self.websocket
         return getattr(self, self.request.method.lower())
@@ -42,7 +71,13 @@ class Handler(object):
         if handler == NotImplemented:
             return MethodNotAllowed()
 
-        return handler(**self.params)
+        resp = handler(**self.params)
+        if hasattr(resp, '__await__'):
+            # An async method, called from WSGI or from a worker thread under
+            # ASGI.
+            from spa.asgi import wait_for
+            resp = wait_for(environ, resp)
+        return resp
 
     def __call__(self, environ, start_response):
         resp = self._get_response(environ, start_response)
@@ -50,13 +85,24 @@ class Handler(object):
 
 
 class JSONHandler(Handler):
-    """Works the same as Handler, but allows you to reply with just a dict that
-    will then be turned into a JSONResponse for you."""
+    """Works the same as Handler, but allows you to reply with just a dict (or
+    list) that will then be turned into a JSONResponse for you.
+
+    You can also reply with a generator or other iterator of records, which
+    will be streamed as a JSON array, or as newline-delimited JSON if
+    `json_stream_format` is 'ndjson'."""
 
+    json_stream_format = 'array'
 
     def __call__(self, environ, start_response):
         resp = self._get_response(environ, start_response)
-
-        if isinstance(resp, dict):
-            resp = JSONResponse(resp)
+        resp = self.to_response(resp)
         return resp(environ, start_response)
+
+    def to_response(self, resp):
+        if isinstance(resp, (dict, list)):
+            return JSONResponse(resp)
+        if isinstance(resp, Iterator):
+            return JSONStreamResponse(
+                resp, ndjson=self.json_stream_format == 'ndjson')
+        return resp
@@ -0,0 +1,378 @@
+"""
+Pings and idle timeouts for websockets, run from one timer thread per worker.
+
+    heartbeat = Heartbeat(interval=30, timeout=75)
+
+    class Chat(spa.Handler):
+        heartbeat = heartbeat
+
+        def websocket(self):
+            while True:
+                msg = self.ws.receive()
+                ...
+
+A watched socket that hasn't received anything for `interval` seconds is sent
+a ping.  One that's received nothing, not even the pong, for `timeout` seconds
+is closed, which runs its close callbacks (Handler.websocket_close among
+them) and wakes up whatever is blocked reading from it.
+
+Every socket's checks live in a single TimerWheel, whose thread (a greenlet,
+under gevent) does all the checking.  Activity only updates a timestamp, so
+busy sockets cost nothing between checks, and there's no sleeping greenlet
+per connection.
+
+The wheel never writes to a socket itself, so a client that's stopped reading
+can't hold up the checks of all the others.  Pings are queued on the socket's
+FrameWriter, which every write to the connection goes through, and go out
+between the frames the handler sends, or from a short-lived thread if nothing
+is being sent.  Closing a timed out socket happens in a thread of its own too.
+
+gwebsocket connections are watched automatically: their class is switched to
+a subclass that notes when frames arrive.  So are sockets under spa.asgi,
+though those are never pinged here: pinging is left to the ASGI server.  For
+other sockets, call heartbeat.touch(ws) whenever something is received.
+Either way, pongs are only seen if something is reading from the socket, so
+handlers that only send (like Hub subscribers) need a reader too, or they'll
+be timed out.
+"""
+import os
+import socket
+import threading
+import time
+
+import six
+
+try:
+    from gwebsocket.websocket import WebSocket
+except ImportError:
+    WebSocket = None
+
+# A final, unmasked ping frame with no payload.
+PING_FRAME = b'\x89\x00'
+
+# Close code for sockets that timed out.
+GOING_AWAY = 1001
+
+OPCODE_CLOSE = 0x08
+
+
+def spawn(func, *args):
+    """
+    Run func(*args) in a new daemon thread (a greenlet, under gevent).
+    """
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class Timer(object):
+    __slots__ = ('func', 'rounds', 'cancelled')
+
+    def __init__(self, func, rounds):
+        self.func = func
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    A hashed timing wheel: `slots` lists of timers, one visited every `tick`
+    seconds by a single thread.  A timer due further away than one turn of
+    the wheel waits for as many turns as it needs.  Scheduling and cancelling
+    are O(1), and timers fire up to one tick late.
+
+    call_later(delay, func) returns a timer with a cancel() method.  Timers
+    all run on the wheel's thread, one after the other, so they mustn't
+    block: anything that might, like writing to a socket, should be handed
+    off to another thread.
+
+    The thread starts on first use in each process, so a wheel made before
+    gunicorn forks its workers still works in each of them.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.fired = 0
+
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for slot in self.slots:
+                del slot[:]
+            ticker = threading.Thread(target=self._run)
+            ticker.daemon = True
+            ticker.start()
+            self._pid = os.getpid()
+
+    def call_later(self, delay, func):
+        self.start()
+        ticks = max(1, int(-(-delay // self.tick)))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        timer = Timer(func, rounds)
+        with self._lock:
+            index = (self.position + 1 + offset) % len(self.slots)
+            self.slots[index].append(timer)
+        return timer
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def advance(self):
+        """
+        Move to the next slot and run the timers due there.
+        """
+        with self._lock:
+            self.position = (self.position + 1) % len(self.slots)
+            slot = self.slots[self.position]
+            due = [timer for timer in slot
+                   if not timer.rounds and not timer.cancelled]
+            waiting = [timer for timer in slot
+                       if timer.rounds and not timer.cancelled]
+            for timer in waiting:
+                timer.rounds -= 1
+            self.slots[self.position] = waiting
+
+        for timer in due:
+            try:
+                timer.func()
+            except Exception:
+                # One broken callback mustn't stop the wheel.
+                pass
+            self.fired += 1
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        while True:
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.advance()
+            next_tick += self.tick
+
+
+# Heartbeats of the gwebsocket connections being tracked, by id().
+_tracked = {}
+
+if WebSocket is not None:
+    class TrackedWebSocket(WebSocket):
+        """
+        A gwebsocket connection that tells its Heartbeat whenever a frame
+        arrives.  Connections are switched to this class rather than wrapped,
+        so everything holding them sees the change.
+        """
+        __slots__ = ()
+
+        def read_frame(self):
+            frame = super(TrackedWebSocket, self).read_frame()
+            heartbeat = _tracked.get(id(self))
+            if heartbeat is not None:
+                heartbeat.touch(self)
+            return frame
+else:
+    TrackedWebSocket = None
+
+
+class FrameWriter(object):
+    """
+    Takes the place of a gwebsocket connection's raw_write, so that every
+    frame written to it, by any thread, is written whole, with a lock held.
+    Control frames, like pings, can be queued with enqueue() to be written
+    before or after the next frame, without waiting for the lock.  At most
+    `max_pending` are kept; more are dropped.
+    """
+
+    def __init__(self, write, max_pending=1):
+        self.write = write
+        self.max_pending = max_pending
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data):
+        with self.lock:
+            self._drain()
+            self.write(data)
+            # Nothing may follow a close frame.
+            if six.indexbytes(data, 0) & 0x0f != OPCODE_CLOSE:
+                self._drain()
+
+    @property
+    def busy(self):
+        return self.lock.locked()
+
+    def enqueue(self, frame):
+        """
+        Queue a control frame.  Returns False if it was dropped because the
+        queue was full.
+        """
+        if len(self.pending) >= self.max_pending:
+            return False
+        self.pending.append(frame)
+        return True
+
+    def flush(self):
+        """
+        Write the queued control frames, waiting for any write in progress.
+        """
+        with self.lock:
+            self._drain()
+
+    def _drain(self):
+        while self.pending:
+            self.write(self.pending.pop(0))
+
+
+def _unwrap(ws):
+    # BufferedWebSocket, and spa.asgi's SyncWebSocket, keep the socket they
+    # wrap as .ws.
+    while getattr(ws, 'ws', None) is not None:
+        ws = ws.ws
+    return ws
+
+
+class Heartbeat(object):
+    """
+    Pings websockets that have been quiet for `interval` seconds, and closes
+    those quiet for `timeout` seconds.  See the module docstring.
+    """
+
+    def __init__(self, interval=30, timeout=75, wheel=None, spawn=spawn):
+        if timeout <= interval:
+            raise ValueError('timeout must be longer than interval')
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        # How writes and closes are run off the wheel's thread.
+        self.spawn = spawn
+
+        self.pings = 0
+        self.reaped = 0
+
+        # [socket, last activity] by id() of the (unwrapped) socket.
+        self._sockets = {}
+
+    def watch(self, ws):
+        """
+        Start checking on `ws`.  It's forgotten when it closes.
+        """
+        raw = _unwrap(ws)
+        key = id(raw)
+        if key in self._sockets:
+            return
+        entry = self._sockets[key] = [ws, time.time()]
+        if (TrackedWebSocket is not None and
+                type(raw) is WebSocket):
+            raw.__class__ = TrackedWebSocket
+            _tracked[key] = self
+        if (WebSocket is not None and isinstance(raw, WebSocket) and
+                not isinstance(raw.raw_write, FrameWriter)):
+            raw.raw_write = FrameWriter(raw.raw_write)
+        raw.add_close_callback(lambda: self.unwatch(ws))
+        self.wheel.call_later(self.interval, lambda: self.check(key, entry))
+
+    def unwatch(self, ws):
+        key = id(_unwrap(ws))
+        self._sockets.pop(key, None)
+        if _tracked.get(key) is self:
+            del _tracked[key]
+
+    def touch(self, ws):
+        """
+        Note that something was received on `ws`.
+        """
+        entry = self._sockets.get(id(_unwrap(ws)))
+        if entry is not None:
+            entry[1] = time.time()
+
+    def watching(self):
+        return len(self._sockets)
+
+    def check(self, key, entry):
+        # The id() may have been reused by a newer socket, with checks of its
+        # own.
+        if self._sockets.get(key) is not entry:
+            return
+        ws, last_seen = entry
+        if ws.closed:
+            self.unwatch(ws)
+            return
+
+        idle = time.time() - last_seen
+        if idle >= self.timeout:
+            self.reap(ws)
+            return
+        if idle >= self.interval:
+            self.ping(ws)
+            delay = min(self.interval, self.timeout - idle)
+        else:
+            delay = self.interval - idle
+        self.wheel.call_later(delay, lambda: self.check(key, entry))
+
+    def ping(self, ws):
+        """
+        Queue a ping on `ws`.  It's sent after the frame being written, if
+        there is one, or otherwise from a new thread, so the wheel's thread
+        never waits on a slow client.  If a ping is still waiting to go out,
+        this one is dropped.
+        """
+        writer = getattr(_unwrap(ws), 'raw_write', None)
+        if not isinstance(writer, FrameWriter):
+            # Nothing to ping with.  The timeout still applies.
+            return
+        if writer.enqueue(PING_FRAME):
+            self.pings += 1
+        if not writer.busy:
+            self.spawn(self._flush, ws, writer)
+
+    def _flush(self, ws, writer):
+        if ws.closed:
+            return
+        try:
+            writer.flush()
+        except Exception:
+            self.reap(ws)
+
+    def reap(self, ws):
+        """
+        Close `ws`, running its close callbacks, and shut down its connection
+        so that any reader blocked on it returns.  The closing happens in a
+        new thread.
+        """
+        self.unwatch(ws)
+        self.reaped += 1
+        self.spawn(self._close, ws)
+
+    def _close(self, ws):
+        raw = _unwrap(ws)
+        conn = getattr(getattr(raw, 'handler', None), 'socket', None)
+        writer = getattr(raw, 'raw_write', None)
+        if isinstance(writer, FrameWriter) and writer.busy:
+            # Stuck writing to a client that isn't reading.  Cut it off, so
+            # the write fails instead of holding up the close frame forever.
+            _shutdown(conn)
+        # An ASGI socket can only be closed from its event loop.
+        close = getattr(ws, 'close_threadsafe', ws.close)
+        try:
+            close(GOING_AWAY, 'idle timeout')
+        except Exception:
+            pass
+        _shutdown(conn)
+
+
+def _shutdown(conn):
+    if conn is not None:
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
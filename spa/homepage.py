@@ -68,9 +68,16 @@ class HomePage(object):
             filepath = filepath[1:]
 
         if self.hash_paths:
-            abs_path = os.path.join(self.static_handler.directory, filepath)
-            with open(abs_path, 'rb') as f:
-                file_hash = get_hash(f)
+            if hasattr(self.static_handler, 'get_path_hash'):
+                # SmartStatic keeps a cache of hashes (possibly preloaded from
+                # a manifest), so ask it rather than reading the file again.
+                file_hash = self.static_handler.get_path_hash(filepath)
+                if file_hash is None:
+                    raise IOError('No such static file: %s' % filepath)
+            else:
+                abs_path = os.path.join(self.static_handler.directory, filepath)
+                with open(abs_path, 'rb') as f:
+                    file_hash = get_hash(f)
 
             filepath = add_hash_to_filepath(filepath, file_hash)
         return posixpath.join(self.static_url, filepath)
@@ -114,5 +121,8 @@ class HomePage(object):
             )
         return self.rendered
 
+    def warm(self):
+        self.render()
+
     def __call__(self, app, req, params, route_name):
         return Response(self.render(), content_type=self.content_type)
@@ -0,0 +1,299 @@
+"""
+Publish/subscribe fan-out of messages to many websockets.
+
+    hub = Hub()
+
+    class Ticker(spa.Handler):
+        def websocket(self):
+            # Blocks, sending this socket everything published to 'ticker',
+            # until the socket closes.
+            hub.subscribe(self.ws, 'ticker').run()
+
+    # elsewhere, in any greenlet or thread:
+    hub.publish('ticker', {'price': 12.5})
+
+Each published message is encoded once (dicts and lists as JSON, text as
+UTF-8), and, for gwebsocket sockets, framed once, however many sockets it goes
+to.  Publishing never waits on a socket: messages go into a bounded queue per
+subscriber, which the subscriber's own handler drains in Subscriber.run().
+When a slow client's queue is full, the hub's `overflow` policy decides what
+happens: 'drop_oldest' (the default) or 'drop_newest' drops a message, and
+'close' closes the connection.
+"""
+import threading
+from collections import deque
+
+import six
+
+from spa import jsonlib
+
+try:
+    from gwebsocket.websocket import Header, WebSocket
+except ImportError:
+    Header = WebSocket = None
+
+OPCODE_TEXT = 0x01
+OPCODE_BINARY = 0x02
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'close')
+
+
+class Message(object):
+    """
+    A message encoded for sending to websockets.  Text is sent as a text
+    message, bytes as a binary message, and anything else is serialized with
+    spa.jsonlib and sent as text.
+    """
+    __slots__ = ('payload', 'opcode', '_frame')
+
+    def __init__(self, data):
+        if isinstance(data, six.text_type):
+            self.payload = data.encode('utf-8')
+            self.opcode = OPCODE_TEXT
+        elif isinstance(data, (bytes, bytearray)):
+            self.payload = bytes(data)
+            self.opcode = OPCODE_BINARY
+        else:
+            self.payload = jsonlib.dumps(data)
+            self.opcode = OPCODE_TEXT
+        self._frame = None
+
+    @classmethod
+    def from_payload(cls, payload, opcode):
+        """
+        Make a Message from an already encoded payload.
+        """
+        message = cls.__new__(cls)
+        message.payload = payload
+        message.opcode = opcode
+        message._frame = None
+        return message
+
+    @property
+    def frame(self):
+        """
+        The whole websocket frame, header and all, for writing straight to a
+        gwebsocket connection.
+        """
+        if self._frame is None:
+            header = Header.encode_header(True, self.opcode, b'',
+                                          len(self.payload), 0)
+            self._frame = header + self.payload
+        return self._frame
+
+    @property
+    def data(self):
+        """
+        The message as text or bytes, for sockets that do their own framing.
+        """
+        if self.opcode == OPCODE_TEXT:
+            return self.payload.decode('utf-8')
+        return self.payload
+
+
+def write_message(ws, message):
+    """
+    Send a Message on `ws`, reusing its pre-encoded frame if `ws` is a
+    gwebsocket connection.
+    """
+    if hasattr(ws, 'send_message'):
+        ws.send_message(message)
+    elif hasattr(ws, 'write_frame'):
+        ws.write_frame(message.frame)
+    elif WebSocket is not None and isinstance(ws, WebSocket):
+        ws.raw_write(message.frame)
+    else:
+        ws.send(message.data)
+
+
+class Subscriber(object):
+    """
+    A websocket's subscription to one or more channels of a Hub, with its
+    queue of messages waiting to be sent.
+    """
+
+    def __init__(self, hub, ws):
+        self.hub = hub
+        self.ws = ws
+        self.channels = set()
+        self.queue = deque()
+        self.closed = False
+        self.close_requested = False
+
+        self.sent = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def put(self, message):
+        with self._lock:
+            if self.closed:
+                return
+            if len(self.queue) >= self.hub.queue_size:
+                self.dropped += 1
+                policy = self.hub.overflow
+                if policy == 'drop_newest':
+                    return
+                elif policy == 'close':
+                    self.close_requested = True
+                    self._ready.set()
+                    return
+                self.queue.popleft()
+            self.queue.append(message)
+        self._ready.set()
+
+    def send_pending(self):
+        """
+        Send everything that's queued.  Returns False if the socket has been
+        closed and no more can be sent.
+        """
+        while True:
+            if self.close_requested:
+                self.close(1008)
+                return False
+            with self._lock:
+                if not self.queue:
+                    self._ready.clear()
+                    return not self.closed
+                message = self.queue.popleft()
+            if self.ws.closed:
+                self.hub.unsubscribe(self.ws)
+                return False
+            try:
+                write_message(self.ws, message)
+            except Exception:
+                # Dead sockets raise socket.error, gwebsocket's own errors, or
+                # worse if they're closed mid-write.
+                self.close()
+                return False
+            self.sent += 1
+
+    def run(self, timeout=None):
+        """
+        Send queued messages as they arrive, until the socket closes or is
+        unsubscribed.  If `timeout` is given, also return after that many
+        seconds with nothing to send.
+        """
+        while self.send_pending():
+            if not self._ready.wait(timeout) and timeout is not None:
+                return
+
+    def close(self, code=1000):
+        self.hub.unsubscribe(self.ws)
+        if not self.ws.closed:
+            try:
+                self.ws.close(code)
+            except Exception:
+                pass
+
+    def _stop(self):
+        with self._lock:
+            self.closed = True
+            self.queue.clear()
+        self._ready.set()
+
+
+class Hub(object):
+    """
+    Channels of websocket subscribers.  Each subscriber queues up to
+    `queue_size` messages, beyond which `overflow` decides what happens (see
+    the module docstring).
+
+    To deliver messages published in any worker process to subscribers in all
+    of them, pass a `backend` from spa.broadcast.
+    """
+
+    def __init__(self, queue_size=100, overflow='drop_oldest', backend=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s' %
+                             ', '.join(OVERFLOW_POLICIES))
+        self.queue_size = queue_size
+        self.overflow = overflow
+
+        self.published = 0
+
+        self._channels = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+        self.backend = backend
+        if backend is not None:
+            backend.subscribe(self.deliver)
+
+    def subscribe(self, ws, *channels):
+        """
+        Subscribe `ws` to `channels`, returning its Subscriber.  The socket is
+        unsubscribed from everything when it closes.
+        """
+        if self.backend is not None:
+            self.backend.start()
+        with self._lock:
+            subscriber = self._subscribers.get(id(ws))
+            if subscriber is None:
+                subscriber = self._subscribers[id(ws)] = Subscriber(self, ws)
+                new = True
+            else:
+                new = False
+            for channel in channels:
+                self._channels.setdefault(channel, set()).add(subscriber)
+                subscriber.channels.add(channel)
+        if new:
+            ws.add_close_callback(lambda: self.unsubscribe(ws))
+        return subscriber
+
+    def unsubscribe(self, ws, *channels):
+        """
+        Unsubscribe `ws` from `channels`, or from everything if none are
+        given.
+        """
+        with self._lock:
+            subscriber = self._subscribers.get(id(ws))
+            if subscriber is None:
+                return
+            for channel in channels or tuple(subscriber.channels):
+                members = self._channels.get(channel)
+                if members is not None:
+                    members.discard(subscriber)
+                    if not members:
+                        del self._channels[channel]
+                subscriber.channels.discard(channel)
+            if not subscriber.channels:
+                del self._subscribers[id(ws)]
+            else:
+                return
+        subscriber._stop()
+
+    def publish(self, channel, data):
+        """
+        Queue `data` (text, bytes, or anything spa.jsonlib can serialize) for
+        every subscriber to `channel`.  Returns how many subscribers in this
+        process it was queued for.
+        """
+        message = Message(data)
+        if self.backend is None:
+            return self.deliver(channel, message)
+        # The backend hands the message back to deliver(), along with the
+        # hubs in other processes.
+        self.backend.start()
+        self.backend.publish(channel, message)
+        return self.subscriber_count(channel)
+
+    def deliver(self, channel, message):
+        """
+        Queue an already encoded Message for every subscriber to `channel`.
+        """
+        members = self._channels.get(channel)
+        if not members:
+            return 0
+        with self._lock:
+            members = tuple(members)
+        for subscriber in members:
+            subscriber.put(message)
+        self.published += 1
+        return len(members)
+
+    def subscriber_count(self, channel=None):
+        if channel is None:
+            return len(self._subscribers)
+        return len(self._channels.get(channel, ()))
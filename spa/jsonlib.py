@@ -0,0 +1,154 @@
+"""
+JSON encoding and decoding for responses, requests and error pages.
+
+The fastest JSON library that's installed is used: orjson, then rapidjson,
+then ujson, falling back to the stdlib json module.  To pick one explicitly,
+call set_backend() once at startup:
+
+    from spa import jsonlib
+    jsonlib.set_backend('json')
+
+dumps() always returns UTF-8 encoded bytes, ready to be used as a response
+body, and loads() accepts bytes (or text), so request bodies needn't be
+decoded first.  Output is compact, with no indentation and unsorted keys,
+unless you ask for `indent` or `sort_keys`.
+"""
+import json
+import sys
+
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class StdlibBackend(object):
+    name = 'json'
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        separators = (',', ':') if indent is None else (',', ': ')
+        return json.dumps(obj, indent=indent, sort_keys=sort_keys,
+                          separators=separators,
+                          ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        if six.PY3 and sys.version_info < (3, 6) and isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonBackend(object):
+    name = 'orjson'
+
+    @classmethod
+    def available(cls):
+        return orjson is not None
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        # orjson only knows how to indent by 2 spaces, so any indent gets that.
+        option = orjson.OPT_NON_STR_KEYS
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class RapidjsonBackend(object):
+    name = 'rapidjson'
+
+    @classmethod
+    def available(cls):
+        return rapidjson is not None
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        return rapidjson.dumps(obj, indent=indent, sort_keys=sort_keys,
+                               ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return rapidjson.loads(data)
+
+
+class UjsonBackend(object):
+    name = 'ujson'
+
+    @classmethod
+    def available(cls):
+        return ujson is not None
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        return ujson.dumps(obj, indent=indent or 0, sort_keys=sort_keys,
+                           ensure_ascii=False,
+                           escape_forward_slashes=False).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+BACKENDS = {
+    'orjson': OrjsonBackend,
+    'rapidjson': RapidjsonBackend,
+    'ujson': UjsonBackend,
+    'json': StdlibBackend,
+}
+
+# The order backends are tried in when none has been chosen.
+PREFERENCE = ('orjson', 'rapidjson', 'ujson', 'json')
+
+
+def available_backends():
+    return tuple(name for name in PREFERENCE if BACKENDS[name].available())
+
+
+_backend = BACKENDS[available_backends()[0]]()
+
+
+def set_backend(name):
+    """
+    Use the named JSON library from now on.  Raises ValueError if it's unknown
+    or not installed.
+    """
+    global _backend
+    backend_class = BACKENDS.get(name)
+    if backend_class is None:
+        raise ValueError('Unknown JSON backend %r' % name)
+    if not backend_class.available():
+        raise ValueError('JSON backend %r is not installed' % name)
+    _backend = backend_class()
+
+
+def get_backend():
+    return _backend.name
+
+
+def dumps(obj, indent=None, sort_keys=False):
+    """
+    Serialize `obj` to UTF-8 encoded JSON bytes.
+    """
+    return _backend.dumps(obj, indent=indent, sort_keys=sort_keys)
+
+
+def loads(data):
+    """
+    Parse JSON from bytes or text.  Raises ValueError if it's invalid.
+    """
+    return _backend.loads(data)
@@ -109,10 +109,12 @@ r"""
 
 from __future__ import print_function
 
+import copy
 import datetime
-from six.moves.http_cookies import SimpleCookie
+from collections import OrderedDict
 from six.moves.urllib.parse import parse_qs
-import re
+import threading
+import time
 
 import jwt
 import utc
@@ -120,6 +122,9 @@ from werkzeug._compat import text_type
 from werkzeug.contrib.sessions import ModificationTrackingDict
 from werkzeug.http import dump_cookie
 
+from spa.cookies import get_cookies
+from spa.middlewares import Middleware
+
 
 class TokenTimestampError(Exception): pass
 
@@ -251,63 +256,200 @@ class JWTCookie(ModificationTrackingDict):
                                 httponly=httponly)
 
 
-class JWTSessionMiddleware(object):
-    def __init__(self, app, secret_key, cookie_name='session',
+class TokenCache(object):
+    """
+    A bounded LRU cache of verified session tokens, so that a token that
+    arrives over and over isn't verified and parsed every time.  Pass one to
+    JWTSessionMiddleware:
+
+        app = JWTSessionMiddleware(app, secret_key=SECRET,
+                                   token_cache=TokenCache())
+
+    Tokens are kept for at most `ttl` seconds, and never past the time they
+    expire, by their `exp` claim or the middleware's `expire_days`.  Holds at
+    most `max_size` tokens, dropping the least recently used.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """
+        Return a copy of the claims for `token`, or None if it isn't cached or
+        has expired.
+        """
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        claims, flat, expires_at = entry
+        if time.time() >= expires_at:
+            self.invalidate(token)
+            self.misses += 1
+            return None
+
+        with self._lock:
+            # Move it to the most recently used end, without
+            # OrderedDict.move_to_end, which is Python 3 only.
+            current = self._entries.pop(token, None)
+            if current is not None:
+                self._entries[token] = current
+        self.hits += 1
+        # Hand out copies, so handlers can't change the cached claims.
+        return dict(claims) if flat else copy.deepcopy(claims)
+
+    def set(self, token, claims, expires_at=None):
+        """
+        Cache the verified `claims` for `token`, until `expires_at` (a Unix
+        timestamp) or for `ttl` seconds, whichever is sooner.
+        """
+        deadline = time.time() + self.ttl
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        claims = dict(claims)
+        flat = not any(isinstance(v, (dict, list)) for v in claims.values())
+        with self._lock:
+            self._entries.pop(token, None)
+            self._entries[token] = (claims, flat, deadline)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token=None):
+        """
+        Drop `token` from the cache, or everything if no token is given.
+        """
+        with self._lock:
+            if token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(token, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class JWTSessionMiddleware(Middleware):
+    def __init__(self, app=None, secret_key=None, cookie_name='session',
                  wsgi_name='jwtsession', expire_days=1,
-                 algorithm='HS256', exclude_pattern=None):
-        self.app = app
+                 algorithm='HS256', exclude_pattern=None, token_cache=None,
+                 refresh_days=None, anonymous_cookie_ttl=60,
+                 include_pattern=None):
+        super(JWTSessionMiddleware, self).__init__(app, exclude_pattern,
+                                                   include_pattern)
         self.secret_key = secret_key
         self.cookie_name = cookie_name
         self.wsgi_name = wsgi_name
+        # Where the session data as loaded is kept, to tell if it changed.
+        self.original_name = wsgi_name + '.original'
         self.expire_days = expire_days
         self.algorithm = algorithm
-        if exclude_pattern:
-            self.exclude_pattern = re.compile(exclude_pattern)
-        else:
-            self.exclude_pattern = None
+        # An optional TokenCache, to skip verifying tokens we've seen recently.
+        self.token_cache = token_cache
+        # Unchanged sessions are re-signed once their token is this old, so
+        # active users don't hit expire_days.  None means never.
+        self.refresh_days = refresh_days
+        # Requests without a session all get the same signed empty session
+        # cookie, made again after this many seconds.
+        self.anonymous_cookie_ttl = anonymous_cookie_ttl
+        self._anonymous_cookie = None
+
+    def load_session(self, token):
+        """
+        Return a JWTCookie with the claims in `token`.  Raises one of the
+        jwt.InvalidTokenError exceptions, or TokenTimestampError, if the token
+        is bad or has expired.
+        """
+        cache = self.token_cache
+        if cache is not None:
+            claims = cache.get(token)
+            if claims is not None:
+                return JWTCookie(claims, self.secret_key, self.algorithm)
+
+        session = JWTCookie.unserialize(
+            token,
+            self.secret_key,
+            self.algorithm,
+            expire_days=self.expire_days,
+        )
+        if cache is not None:
+            cache.set(token, session, self.get_expiry(session))
+        return session
 
-    def __call__(self, environ, start_response):
-        if self.exclude_pattern and re.match(self.exclude_pattern,
-                                             environ['PATH_INFO']):
-            return self.app(environ, start_response)
+    def get_expiry(self, claims):
+        """
+        Return the Unix timestamp after which a token with these claims must
+        be rejected, or None if it never expires.
+        """
+        deadlines = []
+        if 'exp' in claims:
+            deadlines.append(claims['exp'])
+        if self.expire_days:
+            deadlines.append(claims['iat'] + self.expire_days * 86400)
+        return min(deadlines) if deadlines else None
 
+    def process_request(self, environ):
         # on the way in: if environ includes our cookie, then deserialize it and
         # stick it back into environ as jwtsession.  If environ doesn't include
         # one then make an empty one and stick that in.
-        if 'HTTP_COOKIE' in environ:
-            cookie = SimpleCookie(environ['HTTP_COOKIE'])
-            if self.cookie_name in cookie:
-                try:
-                    session = JWTCookie.unserialize(
-                        cookie[self.cookie_name].value,
-                        self.secret_key,
-                        self.algorithm,
-                        expire_days=self.expire_days,
-                    )
-                except (jwt.DecodeError, TokenTimestampError):
-                    session = JWTCookie({}, self.secret_key, self.algorithm)
-            else:
+        token = get_cookies(environ).get(self.cookie_name)
+        if token is not None:
+            try:
+                session = self.load_session(token)
+            except (jwt.InvalidTokenError, TokenTimestampError):
                 session = JWTCookie({}, self.secret_key, self.algorithm)
         else:
             session = JWTCookie({}, self.secret_key, self.algorithm)
         environ[self.wsgi_name] = session
+        environ[self.original_name] = dict(session)
 
-
+    def process_response(self, environ, status, headers):
         # on the way out: serialize jwtsession and stick it into headers as
-        # 'session'.
-        def session_start_response(status, headers, exc_info=None):
-            if session.should_save or session == {}:
-                # add our cookie to headers
-                c = dump_cookie(self.cookie_name,
-                                value=environ[self.wsgi_name].serialize(),
-                                max_age=datetime.timedelta(days=self.expire_days))
-                headers.append(('Set-Cookie', c))
-            return start_response(status, headers, exc_info=exc_info)
+        # 'session', if it's new, changed or due for a refresh.
+        c = self.get_session_cookie(environ[self.wsgi_name],
+                                    environ[self.original_name])
+        if c is not None:
+            headers.append(('Set-Cookie', c))
+
+    def get_session_cookie(self, session, original):
+        """
+        Return the Set-Cookie header value for `session`, or None if the
+        client's cookie can be kept.  `original` is the session data as it was
+        loaded from the request.
+        """
+        if not session:
+            return self.get_anonymous_cookie()
+        if session.should_save and dict(session) != original:
+            return self.make_cookie(session)
+        if self.refresh_days and 'iat' in session:
+            age = time.time() - session['iat']
+            if age >= self.refresh_days * 86400:
+                return self.make_cookie(session)
+        return None
+
+    def get_anonymous_cookie(self):
+        now = time.time()
+        cached = self._anonymous_cookie
+        if (cached is None or not self.anonymous_cookie_ttl or
+                now - cached[1] >= self.anonymous_cookie_ttl):
+            session = JWTCookie({}, self.secret_key, self.algorithm)
+            cached = self._anonymous_cookie = (self.make_cookie(session), now)
+        return cached[0]
 
-        return self.app(environ, session_start_response)
+    def make_cookie(self, session):
+        return dump_cookie(self.cookie_name,
+                           value=session.serialize(),
+                           max_age=datetime.timedelta(days=self.expire_days))
 
 
-class JWTSessionParamMiddleware(object):
+class JWTSessionParamMiddleware(Middleware):
     """
     This middleware supports setting session values from a query string
     parameter (signed as a JSON Web Token).
@@ -315,37 +457,39 @@ class JWTSessionParamMiddleware(object):
     This middleware must be used with some other middleware that actually
     provides the session functionality.
     """
-    def __init__(self, app, secret_key, expire_days=7, algorithm='HS256',
-                 qs_name='session_token', wsgi_name='jwtsession'):
-        self.app = app
+    def __init__(self, app=None, secret_key=None, expire_days=7,
+                 algorithm='HS256', qs_name='session_token',
+                 wsgi_name='jwtsession', exclude_pattern=None,
+                 include_pattern=None):
+        super(JWTSessionParamMiddleware, self).__init__(app, exclude_pattern,
+                                                        include_pattern)
         self.secret_key = secret_key
         self.expire_days = expire_days
         self.algorithm = algorithm
         self.qs_name = qs_name
         self.wsgi_name = wsgi_name
 
-    def __call__(self, environ, start_response):
+    def process_request(self, environ):
         qs_params = {k: v[0] for k, v in
                      parse_qs(environ['QUERY_STRING']).items()}
         if self.qs_name not in qs_params:
-            return self.app(environ, start_response)
+            return
         try:
             session_vals = jwt.decode(qs_params[self.qs_name], key=self.secret_key)
         except jwt.DecodeError:
             # silently drop malformed tokens
-            return self.app(environ, start_response)
+            return
 
         if self.expire_days:
             if 'iat' not in session_vals:
                 # We can't enforce token expiration if the token has no issued
                 # at claim.  So ignore the token.
-                return self.app(environ, start_response)
+                return
 
             issued_at = utc.fromtimestamp(session_vals['iat'])
             if (utc.now() - issued_at).days > self.expire_days:
                 # Token has an issued at claim, but it's too old.  Ignore the
                 # token.
-                return self.app(environ, start_response)
+                return
 
         environ[self.wsgi_name].update(session_vals)
-        return self.app(environ, start_response)
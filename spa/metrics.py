@@ -0,0 +1,327 @@
+"""
+Per-route request metrics for spa apps.
+
+    metrics = Metrics()
+    app = spa.App(routes, metrics=metrics)
+
+For every request, the app then records, under its route name:
+
+    - how long routing took (matching the URL and building the handler),
+    - how long the handler took to return its response,
+    - the time to first byte: from the start of the request until the first
+      non-empty chunk of the body was produced,
+    - and how many bytes of body were produced.
+
+Requests that don't match any route are recorded under UNMATCHED.  Each
+measurement goes into a Histogram with fixed buckets, allocated up front for
+every route in the app, so recording is a few list increments.
+
+metrics.export() renders everything with the metrics' exporter, which by
+default is a PrometheusExporter.  To serve that, add a route to MetricsHandler:
+
+    ('/metrics', 'metrics', MetricsHandler)
+
+Pass a SamplingProfiler as `profiler` to run cProfile on a random fraction of
+requests, and collect the results per route.
+
+Counters aren't locked, so with threaded workers an increment can
+occasionally be lost.  That's the price of keeping them cheap.
+"""
+import bisect
+import random
+import threading
+import time
+
+import six
+
+from spa.handler import Handler
+from spa.wrappers import Response
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# The route name for requests that don't match a route.
+UNMATCHED = '(unmatched)'
+
+# Seconds, from 0.5 ms to 10 s.
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Bytes, from 100 B to 10 MB.
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class Histogram(object):
+    """
+    Counts of observed values falling at or under each of `buckets` (sorted
+    upper bounds), plus an overflow bucket, and their sum.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        (upper bound, count of values at or under it) pairs, ending with
+        infinity.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class RouteMetrics(object):
+    """
+    The histograms for one route.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS):
+        self.match = Histogram(time_buckets)
+        self.handler = Histogram(time_buckets)
+        self.ttfb = Histogram(time_buckets)
+        self.bytes = Histogram(size_buckets)
+        self.errors = 0
+
+
+class Metrics(object):
+    """
+    Metrics for every route of an app.  See the module docstring.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS,
+                 exporter=None, profiler=None):
+        self.time_buckets = time_buckets
+        self.size_buckets = size_buckets
+        if exporter is None:
+            exporter = PrometheusExporter()
+        self.exporter = exporter
+        self.profiler = profiler
+        self.routes = {}
+        self._lock = threading.Lock()
+        self.add_routes([UNMATCHED])
+
+    def add_routes(self, route_names):
+        with self._lock:
+            for name in route_names:
+                if name not in self.routes:
+                    self.routes[name] = RouteMetrics(self.time_buckets,
+                                                     self.size_buckets)
+
+    def get(self, route_name):
+        route = self.routes.get(route_name)
+        if route is None:
+            self.add_routes([route_name])
+            route = self.routes[route_name]
+        return route
+
+    def export(self):
+        return self.exporter.export(self)
+
+
+class MeasuredBody(object):
+    """
+    Wraps a response body to record its time to first byte and size once
+    it's been sent.
+    """
+
+    def __init__(self, body, route, start):
+        self.body = body
+        self.route = route
+        self.start = start
+        self.first_byte = None
+        self.size = 0
+        self.recorded = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            if chunk:
+                if self.first_byte is None:
+                    self.first_byte = clock()
+                self.size += len(chunk)
+            yield chunk
+        self.record()
+
+    def record(self):
+        if self.recorded:
+            return
+        self.recorded = True
+        if self.first_byte is not None:
+            self.route.ttfb.observe(self.first_byte - self.start)
+        self.route.bytes.observe(self.size)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            # For bodies that weren't sent to the end.
+            self.record()
+
+
+def measure_body(body, route, start, environ):
+    """
+    Record the time to first byte and size of `body`, right away if it's a
+    list, or otherwise once it's been sent.  Bodies from wsgi.file_wrapper
+    are passed through untouched, so the server can still use sendfile, and
+    are only counted in the time to first byte.
+    """
+    if isinstance(body, (list, tuple)):
+        size = sum(len(chunk) for chunk in body)
+        if size:
+            route.ttfb.observe(clock() - start)
+        route.bytes.observe(size)
+        return body
+
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+        route.ttfb.observe(clock() - start)
+        return body
+    return MeasuredBody(body, route, start)
+
+
+class SamplingProfiler(object):
+    """
+    Profiles a random `rate` fraction of requests with cProfile, from routing
+    until the handler returns its response, and adds the results up per
+    route.  report(route_name) prints the `limit` most expensive functions.
+
+    cProfile only sees the thread that enabled it, and can only have one
+    profile running at a time, so while a request is being profiled, others
+    aren't.
+    """
+
+    def __init__(self, rate=0.01, sort='cumulative', limit=30):
+        self.rate = rate
+        self.sort = sort
+        self.limit = limit
+        self.stats = {}
+        self.samples = {}
+        self._active = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Return a running cProfile.Profile if this request was picked, or None.
+        """
+        if self._active or random.random() >= self.rate:
+            return None
+        with self._lock:
+            if self._active:
+                return None
+            self._active = True
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this thread.
+            self._active = False
+            return None
+        return profile
+
+    def finish(self, profile, route_name):
+        import pstats
+        profile.disable()
+        self._active = False
+        with self._lock:
+            stats = self.stats.get(route_name)
+            if stats is None:
+                self.stats[route_name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self.samples[route_name] = self.samples.get(route_name, 0) + 1
+
+    def report(self, route_name):
+        stats = self.stats.get(route_name)
+        if stats is None:
+            return ''
+        out = six.StringIO()
+        stats.stream = out
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        return out.getvalue()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class PrometheusExporter(object):
+    """
+    Renders Metrics in Prometheus' text exposition format, with each metric
+    name starting with `prefix`.  Any other exporter just needs an
+    export(metrics) method and a content_type.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    histograms = (
+        ('match', 'route_match_seconds',
+         'Time spent matching the route and building the handler.'),
+        ('handler', 'handler_seconds',
+         'Time spent in the handler, until it returned a response.'),
+        ('ttfb', 'time_to_first_byte_seconds',
+         'Time from the start of the request to the first byte of body.'),
+        ('bytes', 'response_bytes', 'Bytes of response body.'),
+    )
+
+    def __init__(self, prefix='spa'):
+        self.prefix = prefix
+
+    def export(self, metrics):
+        lines = []
+        routes = sorted(metrics.routes.items())
+        for attr, name, description in self.histograms:
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s histogram' % name)
+            for route_name, route in routes:
+                histogram = getattr(route, attr)
+                label = 'route="%s"' % _escape_label(route_name)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        name, label, _format_value(bound), count))
+                lines.append('%s_sum{%s} %s' % (name, label,
+                                                _format_value(histogram.sum)))
+                lines.append('%s_count{%s} %d' % (name, label,
+                                                  histogram.count))
+
+        name = '%s_handler_errors_total' % self.prefix
+        lines.append('# HELP %s Requests whose handler raised an exception.'
+                     % name)
+        lines.append('# TYPE %s counter' % name)
+        for route_name, route in routes:
+            lines.append('%s{route="%s"} %d' % (
+                name, _escape_label(route_name), route.errors))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(Handler):
+    """
+    Serves the app's metrics, as rendered by their exporter.
+    """
+
+    def get(self):
+        metrics = self.app.metrics
+        if metrics is None:
+            return Response('Metrics are not enabled.\n', status=404,
+                            mimetype='text/plain')
+        return Response(metrics.export(),
+                        content_type=metrics.exporter.content_type)
@@ -2,44 +2,90 @@ import logging
 import re
 import string
 import random
-from six.moves.http_cookies import SimpleCookie
 
 from werkzeug.http import dump_cookie
 from werkzeug import exceptions
 
+from spa import encoders as spa_encoders
+from spa.cookies import get_cookies
 from spa import gzip_util
+from spa.encoders import GzipEncoder
+from spa.gzip_util import COMPRESSABLE_MIMETYPES
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-COMPRESSABLE_MIMETYPES = (
-    'text/plain',
-    'text/html',
-    'text/css',
-    'application/json',
-    'application/javascript',
-    'application/x-javascript',
-    'text/xml',
-    'application/xml',
-    'application/xml+rss',
-    'text/javascript'
-)
+class CompressionMiddleware(object):
+    """
+    Compresses responses with compressable content types, using whichever of
+    `encoders` (see spa.encoders) the client's Accept-Encoding header likes
+    best.  By default that's brotli, zstd and gzip, in that order of
+    preference, leaving out any whose libraries aren't installed.
 
+    Responses smaller than the chosen encoder's `min_size` are left alone,
+    since compressing them costs more CPU than it saves on the wire.  (A
+    response's size is known if it has a Content-Length header, or its body is
+    a list of chunks.)
 
-class GzipMiddleware(object):
-    def __init__(self, app, compress_level=6,
-                 compressable_mimetypes=COMPRESSABLE_MIMETYPES):
+    `buffer_size`, `flush_interval` and `flush_size` control how compressed
+    output is buffered; see spa.gzip_util.compress_stream.  Set one of the
+    flush limits if you stream responses that the client should see before
+    they're finished.
+    """
+
+    # How many distinct Accept-Encoding headers to remember our choice for.
+    max_cached_choices = 256
+
+    def __init__(self, app, encoders=None,
+                 compressable_mimetypes=COMPRESSABLE_MIMETYPES,
+                 buffer_size=gzip_util.BUFFER_SIZE, flush_interval=None,
+                 flush_size=None):
         self.app = app
-        self.compress_level = compress_level
+        if encoders is None:
+            encoders = spa_encoders.default_encoders()
+        self.encoders = dict((e.name, e) for e in encoders)
+        self.encoding_names = tuple(e.name for e in encoders)
         self.compressable_mimetypes = compressable_mimetypes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._choices = {}
+
+    def choose_encoder(self, accept_encoding):
+        """
+        Return the encoder to use for a request with the given Accept-Encoding
+        header, or None.  Clients send the same few headers over and over, so
+        the choice is cached per header value.
+        """
+        try:
+            name = self._choices[accept_encoding]
+        except KeyError:
+            name = gzip_util.choose_encoding(accept_encoding,
+                                             self.encoding_names)
+            if len(self._choices) >= self.max_cached_choices:
+                self._choices.clear()
+            self._choices[accept_encoding] = name
+        if name is None:
+            return None
+        return self.encoders[name]
+
+    def is_too_small(self, encoder, headers, data):
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    return int(value) < encoder.min_size
+                except ValueError:
+                    return False
+        if isinstance(data, (list, tuple)):
+            return sum(len(chunk) for chunk in data) < encoder.min_size
+        return False
 
     def __call__(self, environ, start_response):
-        encode_header = environ.get('HTTP_ACCEPT_ENCODING', '')
-        if not gzip_util.gzip_requested(encode_header):
+        encoder = self.choose_encoder(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoder is None:
             return self.app(environ, start_response)
 
-        buffer = {'to_gzip': False, 'body': ''}
+        buffer = {'to_compress': False, 'body': ''}
 
         def _write(body):
             # for WSGI compliance
@@ -53,7 +99,7 @@ class GzipMiddleware(object):
                 field = header[0].lower()
                 if field == 'content-encoding':
                     # if the content is already encoded, don't compress
-                    buffer['to_gzip'] = False
+                    buffer['to_compress'] = False
                     break
                 elif field == 'content-type':
                     ctype = header[1].split(';')[0]
@@ -61,7 +107,7 @@ class GzipMiddleware(object):
                     if ctype in self.compressable_mimetypes and not(
                             'msie' in user_agent
                             and 'javascript' in ctype):
-                        buffer['to_gzip'] = True
+                        buffer['to_compress'] = True
 
             buffer['status'] = status
             buffer['headers'] = headers
@@ -69,18 +115,21 @@ class GzipMiddleware(object):
             return _write
 
         data = self.app(environ, _start_response_wrapper)
-        if buffer['status'].startswith('200 ') and buffer['to_gzip']:
-            data = gzip_util.compress(data, self.compress_level)
+        if (buffer['status'].startswith('200 ') and buffer['to_compress'] and
+                not self.is_too_small(encoder, buffer['headers'], data)):
+            data = encoder.compress(data, buffer_size=self.buffer_size,
+                                    flush_interval=self.flush_interval,
+                                    flush_size=self.flush_size)
             headers = buffer['headers']
-            headers.append(('Content-Encoding', 'gzip'))
+            headers.append(('Content-Encoding', encoder.name))
             headers.append(('Vary', 'Accept-Encoding'))
             for i, header in enumerate(headers):
-                if header[0] == 'Content-Length':
+                if header[0].lower() == 'content-length':
                     # Old content-length header is no longer accurate.
-                    # And since we're streaming the gzipped data back bit by bit
-                    # instead of gzipping it all at once, we can't actually
-                    # compute a new content length.  So we just won't have that
-                    # header.
+                    # And since we're streaming the compressed data back bit by
+                    # bit instead of compressing it all at once, we can't
+                    # actually compute a new content length.  So we just won't
+                    # have that header.
                     headers.pop(i)
                     break
 
@@ -93,6 +142,183 @@ class GzipMiddleware(object):
         return data
 
 
+class GzipMiddleware(CompressionMiddleware):
+    """
+    A CompressionMiddleware that only does gzip.  Responses smaller than
+    `min_size` bytes aren't compressed.
+    """
+
+    def __init__(self, app, compress_level=6,
+                 compressable_mimetypes=COMPRESSABLE_MIMETYPES, min_size=200,
+                 buffer_size=gzip_util.BUFFER_SIZE, flush_interval=None,
+                 flush_size=None):
+        self.compress_level = compress_level
+        self.min_size = min_size
+        super(GzipMiddleware, self).__init__(
+            app,
+            encoders=[GzipEncoder(compress_level, min_size)],
+            compressable_mimetypes=compressable_mimetypes,
+            buffer_size=buffer_size,
+            flush_interval=flush_interval,
+            flush_size=flush_size,
+        )
+
+
+class Middleware(object):
+    """
+    Base class for middlewares that work by looking at the request on the way
+    in and changing response headers on the way out, without touching the
+    body.  Subclasses override either or both of:
+
+    - process_request(environ), which can return a WSGI app (like an
+      HTTPException) to respond with instead of the wrapped app.
+    - process_response(environ, status, headers), which can change `headers`
+      in place.
+
+    A Middleware works on its own, wrapping `app`, or as one of the layers in
+    a Pipeline, in which case `app` isn't needed.
+
+    Paths matching `exclude_pattern` are passed straight through.  If
+    `include_pattern` is set, only paths matching it are handled.
+    """
+
+    def __init__(self, app=None, exclude_pattern=None, include_pattern=None):
+        self.app = app
+        self.exclude_pattern = compile_pattern(exclude_pattern)
+        self.include_pattern = compile_pattern(include_pattern)
+
+    def applies_to(self, path):
+        if self.include_pattern and not self.include_pattern.match(path):
+            return False
+        if self.exclude_pattern and self.exclude_pattern.match(path):
+            return False
+        return True
+
+    def process_request(self, environ):
+        return None
+
+    def process_response(self, environ, status, headers):
+        pass
+
+    def __call__(self, environ, start_response):
+        if not self.applies_to(environ['PATH_INFO']):
+            return self.app(environ, start_response)
+
+        response = self.process_request(environ)
+        if response is not None:
+            return response(environ, start_response)
+
+        def middleware_start_response(status, headers, exc_info=None):
+            self.process_response(environ, status, headers)
+            return start_response(status, headers, exc_info)
+        return self.app(environ, middleware_start_response)
+
+
+def compile_pattern(pattern):
+    if pattern is None or hasattr(pattern, 'match'):
+        return pattern
+    return re.compile(pattern)
+
+
+def is_hook_layer(app):
+    """
+    True if `app` is a Middleware that does all its work in its hooks, so it
+    can be run as a layer of a Pipeline.
+    """
+    return (isinstance(app, Middleware) and
+            getattr(type(app), '__call__') is getattr(Middleware, '__call__'))
+
+
+def overrides(middleware, method_name):
+    return (getattr(type(middleware), method_name) is not
+            getattr(Middleware, method_name))
+
+
+class Pipeline(object):
+    """
+    Runs a stack of Middleware layers around `app`, as if each wrapped the
+    next, but without each one adding its own call and start_response
+    wrapper:
+
+        app = Pipeline(app, [
+            JWTSessionMiddleware(secret_key=SECRET, exclude_pattern='^/static/'),
+            JWTSessionParamMiddleware(secret_key=SECRET),
+            ApiCSRFMiddleware(exclude_pattern='^/static/'),
+        ])
+
+    Layers are listed outermost first.  Their process_request hooks run in
+    that order, and their process_response hooks in reverse order, all from
+    one start_response wrapper.  If a layer's process_request returns a
+    response, the layers inside it are skipped, as they would be if it
+    returned early from __call__.
+
+    Which layers apply to a path, and which of them have hooks to run, is
+    worked out once per path and cached.
+    """
+
+    # Paths come from clients, so don't let them grow the cache without limit.
+    max_cached_paths = 1024
+
+    def __init__(self, app, middlewares):
+        self.app = app
+        self.middlewares = tuple(middlewares)
+        self._plans = {}
+
+    def get_plan(self, path):
+        """
+        Return a tuple of (middleware, runs_on_request, runs_on_response)
+        triples for the layers that apply to `path`.
+        """
+        try:
+            return self._plans[path]
+        except KeyError:
+            pass
+        plan = tuple(
+            (m, overrides(m, 'process_request'),
+             overrides(m, 'process_response'))
+            for m in self.middlewares if m.applies_to(path)
+        )
+        if len(self._plans) >= self.max_cached_paths:
+            self._plans.clear()
+        self._plans[path] = plan
+        return plan
+
+    def process_request(self, environ):
+        """
+        Run the process_request hooks of the layers that apply to the request.
+        Returns a tuple of the response a layer returned (or None), and the
+        layers whose process_response hooks should then run, innermost first.
+        """
+        response = None
+        responders = []
+        for middleware, on_request, on_response in self.get_plan(
+                environ['PATH_INFO']):
+            if on_request:
+                response = middleware.process_request(environ)
+                if response is not None:
+                    break
+            if on_response:
+                responders.append(middleware)
+        responders.reverse()
+        return response, responders
+
+    @staticmethod
+    def process_response(responders, environ, status, headers):
+        for middleware in responders:
+            middleware.process_response(environ, status, headers)
+
+    def __call__(self, environ, start_response):
+        response, responders = self.process_request(environ)
+        app = self.app if response is None else response
+        if not responders:
+            return app(environ, start_response)
+
+        def pipeline_start_response(status, headers, exc_info=None):
+            self.process_response(responders, environ, status, headers)
+            return start_response(status, headers, exc_info)
+        return app(environ, pipeline_start_response)
+
+
 def make_csrf_cookie(name, tok_length):
 
     tok = ''.join(
@@ -101,61 +327,44 @@ def make_csrf_cookie(name, tok_length):
     return dump_cookie(name, value=tok)
 
 
-class ApiCSRFMiddleware(object):
+class ApiCSRFMiddleware(Middleware):
     """Middleware that sets a api_csrf cookie on responses, if not already set.
     On POST, PUT, PATCH, and DELETE requests, requires that a X-Api-CSRF header
     be set equal to the cookie value.  If not set, return """
 
     protected_methods = set(['POST', 'PUT', 'PATCH', 'DELETE'])
 
-    def __init__(self, app, cookie_name='api_csrf', header_name='X-Api-CSRF',
-                 tok_length=32, exclude_pattern=None):
-        self.app = app
+    def __init__(self, app=None, cookie_name='api_csrf',
+                 header_name='X-Api-CSRF', tok_length=32, exclude_pattern=None,
+                 include_pattern=None):
+        super(ApiCSRFMiddleware, self).__init__(app, exclude_pattern,
+                                                include_pattern)
         self.cookie_name = cookie_name
         self.header_name = header_name
+        self.environ_header = 'HTTP_' + header_name.replace('-', '_').upper()
         self.tok_length = tok_length
-        if exclude_pattern:
-            self.exclude_pattern = re.compile(exclude_pattern)
-        else:
-            self.exclude_pattern = None
 
-    def __call__(self, environ, start_response):
-        if self.exclude_pattern and re.match(self.exclude_pattern,
-                                             environ['PATH_INFO']):
-            return self.app(environ, start_response)
+    def process_request(self, environ):
         if environ['REQUEST_METHOD'] in self.protected_methods:
             cookieheader = environ.get('HTTP_COOKIE')
             if not cookieheader:
                 logger.info('No cookie header')
-                return exceptions.Forbidden()(environ, start_response)
+                return exceptions.Forbidden()
 
-            cookie = SimpleCookie(environ['HTTP_COOKIE']).get(
-                self.cookie_name
-            )
+            cookie = get_cookies(environ).get(self.cookie_name)
             if not cookie:
                 logger.info('No CSRF cookie')
-                return exceptions.Forbidden()(environ, start_response)
+                return exceptions.Forbidden()
 
-            headername = 'HTTP_' + self.header_name.replace('-', '_').upper()
-            if headername not in environ:
+            if self.environ_header not in environ:
                 logger.info('No CSRF header')
-                return exceptions.Forbidden()(environ, start_response)
+                return exceptions.Forbidden()
 
-            if cookie.value != environ[headername]:
+            if cookie != environ[self.environ_header]:
                 logger.info('Mismatched CSRF cookie and header')
-                return exceptions.Forbidden()(environ, start_response)
-
-
-        def start_response_wrapper(status, headers, exc_info=None):
-
-            if 'HTTP_COOKIE' in environ:
-                cookie = SimpleCookie(environ['HTTP_COOKIE'])
-                if self.cookie_name not in cookie:
-                    headers.append(('Set-Cookie',
-                                    make_csrf_cookie(self.cookie_name,
-                                                     self.tok_length)))
-            else:
-                headers.append(('Set-Cookie', make_csrf_cookie(self.cookie_name,
-                                                               self.tok_length)))
-            return start_response(status, headers, exc_info=exc_info)
-        return self.app(environ, start_response_wrapper)
+                return exceptions.Forbidden()
+
+    def process_response(self, environ, status, headers):
+        if self.cookie_name not in get_cookies(environ):
+            headers.append(('Set-Cookie', make_csrf_cookie(self.cookie_name,
+                                                           self.tok_length)))
@@ -0,0 +1,57 @@
+"""
+Serving spa apps with gunicorn.  Most people will want spa.run, which uses
+this.  It's kept out of spa.utils so that gunicorn is only imported when
+it's needed.
+"""
+import os
+
+from gunicorn.app.base import Application as GunicornApplication
+
+from spa.utils import (GWEBSOCKET_WORKER, cpu_count, environment_config,
+                       worker_config)
+
+
+class SpaGunicornApplication(GunicornApplication):
+    """
+    Wrapper around gunicorn so we can start app from a console entry point
+    instead of a big ugly gunicorn line.
+
+    With a `profile` (see worker_config), the worker class and count are
+    tuned for the app.  Without one, every app gets gwebsocket workers, two
+    per usable CPU.  Either way, GUNICORN_* environment variables override
+    the choice, and `gunicorn_config` overrides everything.
+    """
+
+    default_gunicorn_config = dict(
+        worker_class=GWEBSOCKET_WORKER,
+        accesslog = '-',
+        errorlog = '-',
+        workers=cpu_count() * 2,
+        # Heroku/Velociraptor-friendly PORT handling.
+        bind='0.0.0.0:%s' % os.getenv('PORT', 8000),
+        graceful_timeout = int(os.getenv('GUNICORN_WORKER_GRACETIME', 30)),
+        timeout = int(os.getenv('GUNICORN_TIMEOUT', 10)),
+        loglevel = 'info',
+    )
+
+    def __init__(self, wsgi_app, port=None, gunicorn_config=None,
+                 profile=None):
+        self.app = wsgi_app
+        self.gunicorn_config = dict(self.default_gunicorn_config)
+        profile = profile or os.getenv('SPA_WORKER_PROFILE')
+        if profile:
+            self.gunicorn_config.update(worker_config(profile, wsgi_app))
+        self.gunicorn_config.update(environment_config())
+
+        gunicorn_config = dict(gunicorn_config or {})
+        if port is not None and 'bind' not in gunicorn_config:
+            gunicorn_config['bind'] = '0.0.0.0:%s' % port
+        self.gunicorn_config.update(gunicorn_config)
+        super(GunicornApplication, self).__init__()
+
+    def load_config(self):
+        for k, v in self.gunicorn_config.items():
+            self.cfg.set(k, v)
+
+    def load(self):
+        return self.app
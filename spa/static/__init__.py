@@ -1,2 +1,3 @@
 from spa.static.handlers import Static, StaticHandler, StaticFileHandler
 from spa.static.smart import SmartStatic
+from spa.static.cache import FileCache
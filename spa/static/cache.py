@@ -0,0 +1,152 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from io import BytesIO
+from time import time
+
+
+class CachedFile(namedtuple('CachedFile', ('data', 'name', 'mtime', 'size',
+                                           'mimetype', 'etag',
+                                           'last_modified'))):
+    """
+    A static file held in memory by a FileCache.  It has the same fields as
+    spa.static.handlers.File, plus the etag and Last-Modified header values,
+    which are computed once when the file is cached.
+    """
+    __slots__ = ()
+
+    @property
+    def handle(self):
+        # For code that wants to read the file like it came off disk.
+        return BytesIO(self.data)
+
+
+_Entry = namedtuple('_Entry', ('file', 'source', 'st_mtime', 'st_size'))
+
+
+class FileCache(object):
+    """
+    An in-memory, size-bounded LRU cache of static file contents, for sharing
+    between StaticHandler instances.  Pass one in the handler's kwargs:
+
+        cache = FileCache(max_bytes=64 * 1024 * 1024)
+        routes = (
+            ('/static/<path:filepath>', 'static', Static('static',
+                                                         file_cache=cache)),
+        )
+
+    Files bigger than `max_file_size` are never cached.  When the total size of
+    cached files goes over `max_bytes`, the least recently used files are
+    evicted.
+
+    Cached files are checked against the filesystem at most once every
+    `check_interval` seconds.  If the file's mtime or size has changed (or it's
+    been deleted), it's dropped from the cache and read from disk again.  Set
+    `check_interval` to None to never check, which is appropriate when files
+    don't change while the app is running.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_size=1024 * 1024,
+                 check_interval=5):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def accepts(self, file_size):
+        return file_size <= self.max_file_size
+
+    def get(self, path):
+        """
+        Return the CachedFile for the file at `path`, or None if there isn't one
+        or it has gone stale.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if self.check_interval is not None:
+            now = time()
+            if now - self._checked.get(path, 0) >= self.check_interval:
+                if self._is_stale(entry):
+                    self.invalidate(path)
+                    self.misses += 1
+                    return None
+                self._checked[path] = now
+
+        with self._lock:
+            # Move it to the most recently used end.  (OrderedDict.move_to_end
+            # is Python 3 only.)
+            current = self._entries.pop(path, None)
+            if current is not None:
+                self._entries[path] = current
+        self.hits += 1
+        return entry.file
+
+    def set(self, path, cached_file, source=None):
+        """
+        Store `cached_file`, which was read from `path` on disk.  If the cached
+        data was derived from some other file (like a compressed copy made in
+        memory), pass that file's path as `source`, and it will be the one
+        checked for changes.  `path` is then just a key, and needn't be a path.
+        """
+        if not self.accepts(cached_file.size):
+            return
+
+        source = source or path
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return
+        entry = _Entry(cached_file, source, stat.st_mtime, stat.st_size)
+
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old.file.size
+            self._entries[path] = entry
+            self._checked[path] = time()
+            self.size += cached_file.size
+
+            while self.size > self.max_bytes and self._entries:
+                old_path, old = self._entries.popitem(last=False)
+                self._checked.pop(old_path, None)
+                self.size -= old.file.size
+                self.evictions += 1
+
+    def invalidate(self, path=None):
+        """
+        Drop `path` from the cache, or everything if no path is given.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._checked.clear()
+                self.size = 0
+                return
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._checked.pop(path, None)
+                self.size -= entry.file.size
+
+    def _is_stale(self, entry):
+        try:
+            stat = os.stat(entry.source)
+        except OSError:
+            return True
+        return stat.st_mtime != entry.st_mtime or stat.st_size != entry.st_size
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
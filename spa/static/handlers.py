@@ -1,45 +1,258 @@
+import fnmatch
 import mimetypes
+import mmap
 import os
+import re
 import sys
+import uuid
 from zlib import adler32
 from time import time, mktime
 from datetime import datetime
 from collections import namedtuple
-from pkg_resources import resource_filename
 
 from spa.handler import Handler
 from werkzeug.exceptions import NotFound
-from werkzeug.wsgi import wrap_file
 from werkzeug._compat import iteritems, string_types
-from werkzeug.http import is_resource_modified, http_date
+from werkzeug.http import (is_resource_modified, http_date, parse_range_header,
+                           parse_if_range_header)
 
+from spa import encoders, gzip_util
+from spa.static.cache import CachedFile
 from spa.utils import clean_path
 
 
 File = namedtuple('File', ('handle', 'name', 'mtime', 'size', 'mimetype'))
 
+# Requests for more ranges than this get the whole file instead.
+MAX_RANGES = 16
 
-class StaticHandler(Handler):
-    def __init__(self, app, req, params, route_name, directory, disallow=None, cache=True,
-                 cache_timeout=60 * 60 * 12, fallback_mimetype='text/plain'):
-        super(StaticHandler, self).__init__(app, req, params, route_name)
+# File extensions for precompressed copies of static files, by content coding.
+ENCODING_EXTENSIONS = {
+    'gzip': '.gz',
+    'br': '.br',
+    'zstd': '.zst',
+}
+
+
+def resolve_directory(directory):
+    """
+    Turn a directory setting into an absolute filesystem path.  `directory` may
+    be a path string, or a (package, resource) tuple to be passed to
+    pkg_resources.resource_filename.
+    """
+    if isinstance(directory, tuple):
+        # pkg_resources is slow to import, and rarely needed.
+        from pkg_resources import resource_filename
+        directory = resource_filename(*directory)
+
+    if not isinstance(directory, string_types):
+        raise TypeError('unknown def %r' % directory)
+    return os.path.realpath(directory)
+
+
+def write_compressed_copies(directory, encodings=None):
+    """
+    Walk `directory`, and next to each compressable file write a compressed
+    copy in each of `encodings` (like app.js.gz and app.js.br for app.js), for
+    StaticHandler to serve when it's been set up with `precompressed`.  Copies
+    that are already newer than their originals are left alone.  Returns the
+    number of files written.
+    """
+    directory = resolve_directory(directory)
+    if encodings is None:
+        encodings = encoders.available_encodings()
+    extensions = tuple(ENCODING_EXTENSIONS.values())
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        for filename in filenames:
+            mimetype = mimetypes.guess_type(filename)[0]
+            if (filename.endswith(extensions) or
+                    mimetype not in gzip_util.COMPRESSABLE_MIMETYPES):
+                continue
+            path = os.path.join(dirpath, filename)
+            data = None
+            for encoding in encodings:
+                variant_path = path + ENCODING_EXTENSIONS[encoding]
+                if (os.path.exists(variant_path) and
+                        os.path.getmtime(variant_path) >= os.path.getmtime(path)):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                with open(variant_path, 'wb') as f:
+                    f.write(encoders.compress_bytes(data, encoding))
+                written += 1
+    return written
+
+
+def _opener(filename):
+    return lambda: (
+        open(filename, 'rb'),
+        datetime.utcfromtimestamp(os.path.getmtime(filename)),
+        int(os.path.getsize(filename))
+    )
+
+
+def make_directory_loader(directory):
+    def loader(path):
+        if path is not None:
+            path = os.path.join(directory, path)
+        else:
+            path = directory
+        if os.path.isfile(path):
+            return os.path.basename(path), _opener(path)
+        return None, None
+    return loader
+
+
+class StaticConfig(object):
+    """
+    The settings for StaticHandler, with the directory, loader, disallow matcher
+    and mimetype lookups all worked out ahead of time.  Static and SmartStatic
+    make one of these when they're created, and share it with every handler
+    they make, so that none of that work is repeated per request.
+    """
+
+    def __init__(self, directory, disallow=None, cache=True,
+                 cache_timeout=60 * 60 * 12, fallback_mimetype='text/plain',
+                 file_cache=None, precompressed=None):
+        self.directory = resolve_directory(directory)
+        self.loader = make_directory_loader(self.directory)
         self.cache = cache
         self.cache_timeout = cache_timeout
+        self.fallback_mimetype = fallback_mimetype
+        # An optional spa.static.cache.FileCache, for keeping file contents in
+        # memory between requests.
+        self.file_cache = file_cache
+        # Content codings, like ('br', 'gzip'), that we should look for
+        # precompressed copies of, in order of our preference.
+        self.precompressed = tuple(precompressed or ())
+
+        self.is_allowed = None
+        if disallow is not None:
+            match = re.compile(fnmatch.translate(os.path.normcase(disallow))).match
+            self.is_allowed = lambda x: match(os.path.normcase(x)) is None
 
-        if isinstance(directory, tuple):
-            directory = resource_filename(*directory)
+        # Guessed mimetypes, by filename.  Only files that have actually been
+        # found get looked up, so this can't grow past the number of files in
+        # the directory.
+        self.mimetypes = {}
 
-        if not isinstance(directory, string_types):
-            raise TypeError('unknown def %r' % directory)
-        loader = self.get_directory_loader(directory)
-        self.loader = loader
+    def guess_mimetype(self, filename):
+        mimetype = self.mimetypes.get(filename)
+        if mimetype is None:
+            guessed_type = mimetypes.guess_type(filename)
+            mimetype = guessed_type[0] or self.fallback_mimetype
+            self.mimetypes[filename] = mimetype
+        return mimetype
 
-        self.directory = os.path.realpath(directory)
 
-        if disallow is not None:
-            from fnmatch import fnmatch
-            self.is_allowed = lambda x: not fnmatch(x, disallow)
-        self.fallback_mimetype = fallback_mimetype
+def get_byte_ranges(range_header, size):
+    """
+    Given a Range header and the size of a file, return a list of (start, stop)
+    byte offsets for the parts of the file that were asked for.  Returns an
+    empty list if none of the ranges can be satisfied, and None if the header
+    is invalid or should be ignored, in which case the whole file should be
+    sent.
+    """
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    if len(parsed.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            # A suffix range, like 'bytes=-500' for the last 500 bytes.
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def make_part_header(boundary, mimetype, start, stop, size):
+    return (
+        '\r\n--%s\r\n'
+        'Content-Type: %s\r\n'
+        'Content-Range: bytes %d-%d/%d\r\n'
+        '\r\n' % (boundary, mimetype, start, stop - 1, size)
+    ).encode('latin-1')
+
+
+class FileChunks(object):
+    """
+    Iterates over `length` bytes of an open file, starting at `start`, in
+    chunks of at most `chunk_size` bytes.  The file is mmapped where possible,
+    so each chunk costs one copy and no read() call.  The file is closed when
+    the server calls our close() method.
+    """
+
+    def __init__(self, handle, start, length, chunk_size=64 * 1024):
+        self.handle = handle
+        self.start = start
+        self.length = length
+        self.chunk_size = chunk_size
+        self.mmap = None
+        if length:
+            try:
+                self.mmap = mmap.mmap(handle.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except (AttributeError, EnvironmentError, ValueError):
+                # Not a real file, or one that can't be mapped.
+                pass
+
+    def iter_range(self, start, length):
+        stop = start + length
+        if self.mmap is not None:
+            for offset in range(start, stop, self.chunk_size):
+                yield self.mmap[offset:min(offset + self.chunk_size, stop)]
+            return
+
+        self.handle.seek(start)
+        while length > 0:
+            chunk = self.handle.read(min(self.chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def __iter__(self):
+        return self.iter_range(self.start, self.length)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.handle.close()
+
+
+class StaticHandler(Handler):
+    # How many bytes at a time to send of files that aren't cached in memory.
+    block_size = 64 * 1024
+
+    def __init__(self, app, req, params, route_name, directory=None,
+                 config=None, **kwargs):
+        """
+        Either pass a `directory` and any other StaticConfig arguments, or a
+        ready-made StaticConfig as `config`.
+        """
+        super(StaticHandler, self).__init__(app, req, params, route_name)
+        if config is None:
+            config = StaticConfig(directory, **kwargs)
+        self.config = config
+
+        self.directory = config.directory
+        self.loader = config.loader
+        self.cache = config.cache
+        self.cache_timeout = config.cache_timeout
+        self.fallback_mimetype = config.fallback_mimetype
+        self.file_cache = config.file_cache
+        self.precompressed = config.precompressed
+        if config.is_allowed is not None:
+            self.is_allowed = config.is_allowed
 
     def is_allowed(self, filename):
         """Subclasses can override this method to disallow the access to
@@ -48,23 +261,8 @@ class StaticHandler(Handler):
         """
         return True
 
-    def _opener(self, filename):
-        return lambda: (
-            open(filename, 'rb'),
-            datetime.utcfromtimestamp(os.path.getmtime(filename)),
-            int(os.path.getsize(filename))
-        )
-
     def get_directory_loader(self, directory):
-        def loader(path):
-            if path is not None:
-                path = os.path.join(directory, path)
-            else:
-                path = directory
-            if os.path.isfile(path):
-                return os.path.basename(path), self._opener(path)
-            return None, None
-        return loader
+        return make_directory_loader(directory)
 
     def generate_etag(self, mtime, file_size, real_filename):
         if not isinstance(real_filename, bytes):
@@ -95,47 +293,268 @@ class StaticHandler(Handler):
     def get_file(self, path):
         path = clean_path(path)
 
+        if self.file_cache is not None:
+            real_path = os.path.join(self.directory, path[1:])
+            cached = self.file_cache.get(real_path)
+            if cached is not None:
+                return cached
+
         real_filename, file_loader = self.get_filename_and_loader(path)
         if file_loader is None or not self.is_allowed(real_filename):
             return None
 
-        guessed_type = mimetypes.guess_type(real_filename)
-        mimetype = guessed_type[0] or self.fallback_mimetype
+        mimetype = self.config.guess_mimetype(real_filename)
         f, mtime, file_size = file_loader()
-        return File(f, real_filename, mtime, file_size, mimetype)
+        file = File(f, real_filename, mtime, file_size, mimetype)
+
+        if self.file_cache is not None and self.file_cache.accepts(file_size):
+            file = self.cache_file(real_path, file)
+        return file
+
+    def cache_file(self, path, file):
+        """
+        Read `file`, found at `path` on disk, into memory and store it in our
+        FileCache.  Return the resulting CachedFile.
+        """
+        try:
+            data = file.handle.read()
+        finally:
+            file.handle.close()
+        cached = CachedFile(
+            data, file.name, file.mtime, len(data), file.mimetype,
+            self.generate_etag(file.mtime, len(data), file.name),
+            http_date(file.mtime),
+        )
+        self.file_cache.set(path, cached)
+        return cached
+
+    def get_encoded_file(self, path, file):
+        """
+        Look for a precompressed copy of `file` (found at `path`) in one of our
+        `precompressed` encodings that the client accepts.  Return a tuple of
+        (encoding, file), where encoding is None if the original file should be
+        served as is.
+        """
+        header = self.request.environ.get('HTTP_ACCEPT_ENCODING', '')
+        offered = self.precompressed
+        while offered:
+            encoding = gzip_util.choose_encoding(header, offered)
+            if encoding is None:
+                break
+            variant = self.get_file_variant(path, file, encoding)
+            if variant is not None:
+                if not isinstance(file, CachedFile):
+                    file.handle.close()
+                return encoding, variant
+            offered = tuple(e for e in offered if e != encoding)
+        return None, file
+
+    def get_file_variant(self, path, file, encoding):
+        """
+        Return a copy of `file` compressed with `encoding`, or None if there
+        isn't one.  Compressed copies are looked for next to the original file
+        on disk (like app.js.gz for app.js).  If there's no such file, and we
+        have a FileCache, then the copy is made in memory and kept in the cache.
+        """
+        if self.file_cache is not None:
+            # A copy made in memory by an earlier request.
+            variant = self.file_cache.get(self.variant_key(path, encoding))
+            if variant is not None:
+                return variant
+
+        variant_path = path + ENCODING_EXTENSIONS[encoding]
+        variant = self.get_file(variant_path)
+        if variant is not None:
+            if variant.mtime < file.mtime:
+                # Left over from an older version of the file.
+                if not isinstance(variant, CachedFile):
+                    variant.handle.close()
+                return None
+            return variant._replace(mimetype=file.mimetype)
+
+        if self.file_cache is not None:
+            return self.compress_file(path, file, encoding)
+        return None
+
+    def variant_key(self, path, encoding):
+        """
+        The FileCache key for a compressed copy of the file at `path` made in
+        memory.  It's a (real path, encoding) tuple rather than a path, so
+        get_file() can never serve the copy as if it were a file on disk.
+        """
+        return os.path.join(self.directory, clean_path(path)[1:]), encoding
+
+    def compress_file(self, path, file, encoding):
+        if (file.mimetype not in gzip_util.COMPRESSABLE_MIMETYPES or
+                not self.file_cache.accepts(file.size)):
+            return None
+
+        cache_key = self.variant_key(path, encoding)
+        source = cache_key[0]
+
+        if isinstance(file, CachedFile):
+            data = file.data
+        else:
+            data = file.handle.read()
+            file.handle.seek(0)
+        data = encoders.compress_bytes(data, encoding)
+        if data is None:
+            return None
+
+        name = file.name + ENCODING_EXTENSIONS[encoding]
+        cached = CachedFile(
+            data, name, file.mtime, len(data), file.mimetype,
+            self.generate_etag(file.mtime, len(data), name),
+            http_date(file.mtime),
+        )
+        self.file_cache.set(cache_key, cached, source=source)
+        return cached
+
+    def make_response(self, file, encoding=None):
+        in_memory = isinstance(file, CachedFile)
 
-    def make_response(self, file):
         def resp(environ, start_response):
-            headers = [('Date', http_date())]
+            headers = [('Date', http_date()), ('Accept-Ranges', 'bytes')]
+            if self.precompressed:
+                headers.append(('Vary', 'Accept-Encoding'))
+            etag = None
             if self.cache:
                 timeout = self.cache_timeout
-                etag = self.generate_etag(file.mtime, file.size, file.name)
+                if in_memory:
+                    etag = file.etag
+                else:
+                    etag = self.generate_etag(file.mtime, file.size, file.name)
                 headers += [
                     ('Etag', '"%s"' % etag),
                     ('Cache-Control', 'max-age=%d, public' % timeout)
                 ]
                 if not is_resource_modified(environ, etag, last_modified=file.mtime):
-                    file.handle.close()
+                    if not in_memory:
+                        file.handle.close()
                     start_response('304 Not Modified', headers)
                     return []
                 headers.append(('Expires', http_date(time() + timeout)))
             else:
                 headers.append(('Cache-Control', 'public'))
 
-            headers.extend((
-                ('Content-Type', file.mimetype),
-                ('Content-Length', str(file.size)),
-                ('Last-Modified', http_date(file.mtime))
-            ))
-            start_response('200 OK', headers)
-            return wrap_file(environ, file.handle)
+            headers.append(('Last-Modified', file.last_modified if in_memory
+                            else http_date(file.mtime)))
+            if encoding is not None:
+                headers.append(('Content-Encoding', encoding))
+
+            ranges = None
+            if 'HTTP_RANGE' in environ and self.range_is_current(environ, file, etag):
+                ranges = get_byte_ranges(environ['HTTP_RANGE'], file.size)
+
+            if ranges is None:
+                status = '200 OK'
+                headers.extend((
+                    ('Content-Type', file.mimetype),
+                    ('Content-Length', str(file.size)),
+                ))
+                body = self.iter_file(environ, file, 0, file.size)
+            elif not ranges:
+                if not in_memory:
+                    file.handle.close()
+                headers.append(('Content-Range', 'bytes */%d' % file.size))
+                start_response('416 Requested Range Not Satisfiable', headers)
+                return []
+            elif len(ranges) == 1:
+                status = '206 Partial Content'
+                start, stop = ranges[0]
+                headers.extend((
+                    ('Content-Type', file.mimetype),
+                    ('Content-Length', str(stop - start)),
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1,
+                                                          file.size)),
+                ))
+                body = self.iter_file(environ, file, start, stop - start)
+            else:
+                status = '206 Partial Content'
+                boundary = uuid.uuid4().hex
+                parts = [(make_part_header(boundary, file.mimetype, start,
+                                           stop, file.size), start, stop)
+                         for start, stop in ranges]
+                closing = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+                length = sum(len(part_header) + stop - start
+                             for part_header, start, stop in parts)
+                headers.extend((
+                    ('Content-Type',
+                     'multipart/byteranges; boundary=%s' % boundary),
+                    ('Content-Length', str(length + len(closing))),
+                ))
+                body = self.iter_multipart(file, parts, closing)
+
+            start_response(status, headers)
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                if hasattr(body, 'close'):
+                    body.close()
+                if not in_memory:
+                    file.handle.close()
+                return []
+            return body
         return resp
 
+    def range_is_current(self, environ, file, etag):
+        """
+        Return False if the request's If-Range header says its Range is for
+        some other version of the file, in which case the whole file should be
+        sent instead.
+        """
+        if 'HTTP_IF_RANGE' not in environ:
+            return True
+        if_range = parse_if_range_header(environ['HTTP_IF_RANGE'])
+        if if_range.etag is not None:
+            return if_range.etag == etag
+        if if_range.date is not None:
+            return if_range.date == file.mtime.replace(microsecond=0)
+        return False
+
+    def iter_file(self, environ, file, start, length):
+        """
+        Return an iterable over `length` bytes of `file`, starting at `start`.
+        When sending the whole file, a server's wsgi.file_wrapper gets the
+        open file, so it can use sendfile() or the like.  File wrappers send
+        everything up to the end of the file, and servers needn't stop at the
+        Content-Length, so ranges, like files without a file wrapper, are read
+        through an mmap instead.
+        """
+        if isinstance(file, CachedFile):
+            if start == 0 and length == file.size:
+                return [file.data]
+            return [file.data[start:start + length]]
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and start == 0 and length == file.size:
+            return file_wrapper(file.handle, self.block_size)
+        return FileChunks(file.handle, start, length, self.block_size)
+
+    def iter_multipart(self, file, parts, closing):
+        if isinstance(file, CachedFile):
+            for part_header, start, stop in parts:
+                yield part_header
+                yield file.data[start:stop]
+            yield closing
+            return
+
+        chunks = FileChunks(file.handle, 0, file.size, self.block_size)
+        try:
+            for part_header, start, stop in parts:
+                yield part_header
+                for chunk in chunks.iter_range(start, stop - start):
+                    yield chunk
+            yield closing
+        finally:
+            chunks.close()
+
     def get(self, filepath):
         file = self.get_file(filepath)
         if file is None:
             return NotFound()
 
+        if self.precompressed:
+            encoding, file = self.get_encoded_file(filepath, file)
+            return self.make_response(file, encoding)
         return self.make_response(file)
 
     def __call__(self, environ, start_response):
@@ -168,9 +587,28 @@ class Static(object):
     def __init__(self, directory, **kwargs):
         self.directory = directory
         self.kwargs = kwargs
+        self.config = StaticConfig(directory, **kwargs)
+        # Configs for routes that were given their own extra kwargs.
+        self.route_configs = {}
+
+    def get_config(self, route_name, kwargs):
+        if not kwargs:
+            return self.config
+        config = self.route_configs.get(route_name)
+        if config is None:
+            new_kwargs = dict(self.kwargs)
+            new_kwargs.update(kwargs)
+            config = StaticConfig(self.directory, **new_kwargs)
+            self.route_configs[route_name] = config
+        return config
+
+    def warm(self):
+        """
+        Load the mimetypes database, which would otherwise be read on the
+        first request.
+        """
+        mimetypes.init()
 
     def __call__(self, app, req, params, route_name, **kwargs):
-        new_kwargs = dict(self.kwargs)
-        new_kwargs.update(kwargs)
-        return StaticHandler(app, req, params, route_name, directory=self.directory,
-                             **new_kwargs)
+        return StaticHandler(app, req, params, route_name,
+                             config=self.get_config(route_name, kwargs))
@@ -0,0 +1,54 @@
+"""
+Command line tool for building a SmartStatic manifest ahead of time, so that
+app processes can load file hashes from disk instead of computing them:
+
+    spa-manifest path/to/static -o static-manifest.json
+
+Add --compress to also write gzipped (and, if the brotli or zstandard packages
+are installed, brotli or zstd) copies of compressable files, for serving with
+StaticHandler's `precompressed` option.
+
+Then in your app:
+
+    SmartStatic(directory='path/to/static', manifest='static-manifest.json')
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+from spa import encoders
+from spa.static.handlers import write_compressed_copies
+from spa.static.smart import build_manifest, save_manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Hash every file in a static directory and write a '
+                    'manifest that SmartStatic can load at startup.'
+    )
+    parser.add_argument('directory', help='The static files directory.')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Where to write the JSON manifest.  Defaults '
+                             'to stdout.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Also write compressed copies of compressable '
+                             'files (%s).' %
+                             ', '.join(encoders.available_encodings()))
+    args = parser.parse_args(argv)
+
+    manifest = build_manifest(args.directory)
+    if args.compress:
+        written = write_compressed_copies(args.directory)
+        print('Wrote %s compressed files' % written, file=sys.stderr)
+    if args.output == '-':
+        print(json.dumps(manifest, indent=2, sort_keys=True))
+    else:
+        save_manifest(manifest, args.output)
+        print('Wrote %s entries to %s' % (len(manifest), args.output),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import hashlib
+import json
 import mimetypes
 import os
 import posixpath
@@ -6,10 +7,13 @@ import re
 from time import time
 from six.moves.urllib.parse import urlsplit, urlunsplit
 
+from werkzeug._compat import string_types
 from werkzeug.exceptions import NotFound
 from werkzeug.http import is_resource_modified, http_date
 
-from spa.static.handlers import StaticHandler
+from spa import encoders, gzip_util
+from spa.static.handlers import (Static, StaticHandler, ENCODING_EXTENSIONS,
+                                 resolve_directory)
 from spa.utils import clean_path
 
 
@@ -24,6 +28,12 @@ class HashCache(object):
     def set_path_hash(self, path, path_hash):
         self.path_hashes[path] = path_hash
 
+    def load_path_hashes(self, path_hashes):
+        """
+        Bulk load a manifest of {path: hash} pairs, as made by build_manifest.
+        """
+        self.path_hashes.update(path_hashes)
+
     def get_contents(self, path):
         return self.contents.get(path)
 
@@ -40,9 +50,10 @@ class CacheBustingStaticHandler(StaticHandler):
          """@import url("{hashed_url}")"""),
     )
 
-    def __init__(self, app, req, params, route_name, directory, hash_cache,
-                 hash_paths=True, static_url_root='/static/', **kwargs):
-        self.hash_cache = hash_cache
+    def __init__(self, app, req, params, route_name, directory=None,
+                 hash_cache=None, hash_paths=True, static_url_root='/static/',
+                 **kwargs):
+        self.hash_cache = hash_cache if hash_cache is not None else HashCache()
         self.hash_paths = hash_paths
         self.static_url_root = static_url_root
         return super(CacheBustingStaticHandler, self).__init__(
@@ -51,17 +62,19 @@ class CacheBustingStaticHandler(StaticHandler):
 
 
     def get_path_hash(self, unhashed_path):
-        if self.hash_cache.get_path_hash(unhashed_path) is None:
+        unhashed_path = clean_path(unhashed_path)
+        path_hash = self.hash_cache.get_path_hash(unhashed_path)
+        if path_hash is None:
             # compute hash, and cache it.
             file = self.get_file(unhashed_path)
             if file is None:
                 return None
             try:
-                hash_str = get_hash(file.handle)
-                self.hash_cache.set_path_hash(unhashed_path, hash_str)
+                path_hash = get_hash(file.handle)
+                self.hash_cache.set_path_hash(unhashed_path, path_hash)
             finally:
                 file.handle.close()
-        return self.hash_cache.get_path_hash(unhashed_path)
+        return path_hash
 
 
     def get(self, filepath):
@@ -94,9 +107,19 @@ class CacheBustingStaticHandler(StaticHandler):
             file = self.get_file(filepath)
             try:
                 headers = [('Date', http_date())]
+                encoding = None
+                if self.precompressed:
+                    headers.append(('Vary', 'Accept-Encoding'))
+                    encoding = gzip_util.choose_encoding(
+                        environ.get('HTTP_ACCEPT_ENCODING', ''),
+                        [e for e in self.precompressed
+                         if e in encoders.available_encodings()]
+                    )
                 if self.cache:
                     timeout = self.cache_timeout
                     etag = self.generate_etag(file.mtime, file.size, file.name)
+                    if encoding is not None:
+                        etag += '-' + encoding
                     headers += [
                         ('Etag', '"%s"' % etag),
                         ('Cache-Control', 'max-age=%d, public' % timeout)
@@ -116,15 +139,28 @@ class CacheBustingStaticHandler(StaticHandler):
                         converter = self.get_converter(tpl)
                         contents = pat.sub(converter, contents)
                     self.hash_cache.set_contents(filepath, contents)
+                body = contents.encode('utf-8')
+
+                if encoding is not None:
+                    # Compressed copies of the rewritten CSS are cached too.
+                    # They're keyed by (path, encoding), so they can't be
+                    # mistaken for the contents of a file with that name.
+                    encoded_key = (filepath, encoding)
+                    encoded = self.hash_cache.get_contents(encoded_key)
+                    if encoded is None:
+                        encoded = encoders.compress_bytes(body, encoding)
+                        self.hash_cache.set_contents(encoded_key, encoded)
+                    body = encoded
+                    headers.append(('Content-Encoding', encoding))
 
                 headers.extend((
                     ('Content-Type', file.mimetype),
-                    ('Content-Length', len(contents)),
+                    ('Content-Length', str(len(body))),
                     ('Last-Modified', http_date(file.mtime))
                 ))
                 start_response('200 OK', headers)
 
-                return [contents.encode('utf-8')]
+                return [body]
             finally:
                 file.handle.close()
         return resp
@@ -154,15 +190,9 @@ class CacheBustingStaticHandler(StaticHandler):
         _, _, content_filepath = abs_url_path.partition(prefix)
         content_filepath = clean_path(content_filepath)
 
-        content_file_hash = self.hash_cache.get_path_hash(content_filepath)
+        content_file_hash = self.get_path_hash(content_filepath)
         if content_file_hash is None:
-            content_file = self.get_file(content_filepath)
-            if content_file is None:
-                return 'NOT FOUND: "%s"' % url_path
-            try:
-                content_file_hash = get_hash(content_file.handle)
-            finally:
-                content_file.handle.close()
+            return 'NOT FOUND: "%s"' % url_path
         parts = list(split_url)
         parts[2] = add_hash_to_filepath(url_path, content_file_hash)
 
@@ -238,23 +268,107 @@ def get_hash(f, hash_len=12):
     return md5.hexdigest()[:hash_len]
 
 
-class SmartStatic(object):
+def build_manifest(directory, hash_len=12):
+    """
+    Walk `directory` and return a dict mapping the path of every file in it
+    (relative to `directory`, with a leading slash, like '/css/app.css') to
+    the hash that SmartStatic would compute for it.
+    """
+    directory = resolve_directory(directory)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        for filename in filenames:
+            abs_path = os.path.join(dirpath, filename)
+            with open(abs_path, 'rb') as f:
+                file_hash = get_hash(f, hash_len)
+            manifest[clean_path(os.path.relpath(abs_path, directory))] = file_hash
+    return manifest
+
+
+def save_manifest(manifest, filename):
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def load_manifest(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+class SmartStatic(Static):
     """
     A factory for making CacheBustingStaticHandler instances that share a cache
     instance.
+
+    By default file hashes are computed lazily, the first time each file is
+    requested.  Pass a `manifest` to skip that work:
+
+        - manifest=True walks the directory and hashes every file right away,
+          so if you build your SmartStatic at import time and preload your app
+          in the gunicorn master, all the workers share the hashes.
+        - manifest='/path/to/manifest.json' loads a manifest previously
+          written by the spa-manifest command line tool.
+        - manifest={'/css/app.css': 'deadbeef1234'} uses the dict you give.
+
+    Files missing from the manifest are still hashed lazily on first request.
     """
 
-    def __init__(self, directory, hash_paths=True, **kwargs):
-        self.directory = directory
+    def __init__(self, directory, hash_paths=True, manifest=None,
+                 static_url_root='/static/', **kwargs):
+        super(SmartStatic, self).__init__(directory, **kwargs)
         self.hash_paths = hash_paths
+        self.static_url_root = static_url_root
         self.hash_cache = HashCache()
-        self.kwargs = kwargs or {}
+
+        if manifest is True:
+            self.build_manifest()
+        elif isinstance(manifest, string_types):
+            self.hash_cache.load_path_hashes(load_manifest(manifest))
+        elif manifest:
+            self.hash_cache.load_path_hashes(manifest)
+
+    def build_manifest(self):
+        """
+        Hash every file in our directory and load the results into our cache.
+        Returns the manifest dict.
+        """
+        manifest = build_manifest(self.config.directory)
+        self.hash_cache.load_path_hashes(manifest)
+        return manifest
+
+    def warm(self):
+        """
+        Hash every file up front, unless a manifest was given.
+        """
+        super(SmartStatic, self).warm()
+        if not self.hash_cache.path_hashes:
+            self.build_manifest()
+
+    def get_path_hash(self, path):
+        """
+        Return the hash for the file at `path` (relative to our directory),
+        computing and caching it if it's not already known.  Returns None if
+        there is no such file.
+        """
+        path = clean_path(path)
+        path_hash = self.hash_cache.get_path_hash(path)
+        if path_hash is None:
+            abs_path = os.path.join(self.config.directory, path[1:])
+            if not os.path.isfile(abs_path):
+                return None
+            with open(abs_path, 'rb') as f:
+                path_hash = get_hash(f)
+            self.hash_cache.set_path_hash(path, path_hash)
+        return path_hash
 
     def __call__(self, app, req, params, route_name, **kwargs):
-        newkwargs = dict(self.kwargs)
-        newkwargs.update(kwargs)
+        # Route kwargs for the handler itself override ours.  The rest are
+        # StaticConfig's.
+        hash_paths = kwargs.pop('hash_paths', self.hash_paths)
+        static_url_root = kwargs.pop('static_url_root', self.static_url_root)
         return CacheBustingStaticHandler(app, req, params, route_name,
-                                         directory=self.directory,
-                                         hash_paths=self.hash_paths,
+                                         config=self.get_config(route_name,
+                                                                kwargs),
+                                         hash_paths=hash_paths,
                                          hash_cache=self.hash_cache,
-                                         **newkwargs)
+                                         static_url_root=static_url_root)
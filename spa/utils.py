@@ -1,8 +1,12 @@
+import atexit
+import gc
+import math
 import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
 
-from gunicorn.app.base import Application as GunicornApplication
 from werkzeug._compat import PY2
 
 
@@ -15,44 +19,247 @@ def import_class(path):
         raise ImportError(e)
 
 
-class SpaGunicornApplication(GunicornApplication):
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+GWEBSOCKET_WORKER = 'gwebsocket.gunicorn.GWebSocketWorker'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpu_quota(root=CGROUP_ROOT, proc_cgroup='/proc/self/cgroup'):
+    """
+    Return how many CPUs' worth of time this process's cgroup may use (like
+    2.0 for a container limited to 2 CPUs), or None if it isn't limited.
+    Handles both cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us).
+    """
+    # Our own cgroup's directory, if it's visible, then the root of the
+    # hierarchy, which is our own cgroup inside most containers.
+    paths = []
+    for line in (_read(proc_cgroup) or '').splitlines():
+        parts = line.split(':', 2)
+        if len(parts) == 3 and parts[0] == '0' and parts[2] != '/':
+            paths.append(os.path.join(root, parts[2].lstrip('/')))
+    paths.append(root)
+
+    for path in paths:
+        cpu_max = _read(os.path.join(path, 'cpu.max'))
+        if cpu_max:
+            quota, _, period = cpu_max.partition(' ')
+            if quota == 'max':
+                return None
+            try:
+                return float(quota) / float(period or 100000)
+            except ValueError:
+                return None
+
+    for v1_dir in ('cpu,cpuacct', 'cpu'):
+        quota = _read(os.path.join(root, v1_dir, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(root, v1_dir, 'cpu.cfs_period_us'))
+        if quota and period:
+            try:
+                quota, period = int(quota), int(period)
+            except ValueError:
+                return None
+            if quota <= 0 or period <= 0:
+                return None
+            return float(quota) / period
+    return None
+
+
+def cpu_count():
+    """
+    The number of CPUs this process can actually use: the ones it's allowed
+    to run on, further limited by any cgroup CPU quota, as in a container.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = multiprocessing.cpu_count()
+    quota = cgroup_cpu_quota()
+    if quota:
+        count = min(count, int(math.ceil(quota)))
+    return max(1, count)
+
+
+def find_spa_app(app):
+    """
+    Return the spa.App inside `app`, looking through middlewares' .app
+    attributes, or None.
+    """
+    from spa.app import App
+    seen = set()
+    while app is not None and id(app) not in seen:
+        if isinstance(app, App):
+            return app
+        seen.add(id(app))
+        app = getattr(app, 'app', None)
+    return None
+
+
+def route_mix(app):
+    """
+    Count an app's routes by kind: 'websocket' for handlers with a websocket
+    method, 'static' for static file handlers, and 'sync' for the rest.
+    """
+    from spa.static import Static, StaticHandler
+    mix = {'sync': 0, 'websocket': 0, 'static': 0}
+    spa_app = find_spa_app(app)
+    if spa_app is None:
+        return mix
+    for handler, kwargs in spa_app.handlers.values():
+        if isinstance(handler, Static) or (
+                isinstance(handler, type) and
+                issubclass(handler, StaticHandler)):
+            mix['static'] += 1
+        elif getattr(handler, 'websocket', None) is not None:
+            mix['websocket'] += 1
+        else:
+            mix['sync'] += 1
+    return mix
+
+
+def _websocket_profile(cpus):
+    # One gevent worker per CPU can hold thousands of mostly idle sockets.
+    return {'worker_class': GWEBSOCKET_WORKER, 'workers': cpus,
+            'worker_connections': 10000}
+
+
+def _sync_profile(cpus):
+    # Gunicorn's rule of thumb for blocking workers.
+    return {'worker_class': 'sync', 'workers': cpus * 2 + 1, 'threads': 1}
+
+
+def _static_profile(cpus):
+    # File reads block, but only briefly, and sendfile does the rest.
+    return {'worker_class': 'gthread', 'workers': cpus, 'threads': 8}
+
+
+PROFILES = {
+    'websocket': _websocket_profile,
+    'sync': _sync_profile,
+    'static': _static_profile,
+}
+
+
+def choose_profile(app):
+    """
+    Pick a profile name for `app` from its route mix: 'websocket' if it has
+    any websocket routes (only the gwebsocket worker can serve those),
+    'static' if most routes serve static files, and otherwise 'sync'.
     """
-    Wrapper around gunicorn so we can start app from a console entry point
-    instead of a big ugly gunicorn line.
+    mix = route_mix(app)
+    if find_spa_app(app) is None or mix['websocket']:
+        return 'websocket'
+    if mix['static'] > mix['sync']:
+        return 'static'
+    return 'sync'
+
+
+def worker_config(profile, app=None, cpus=None):
     """
+    Return the gunicorn settings (worker_class, workers, and
+    worker_connections or threads) for a profile: 'websocket', 'sync',
+    'static', or 'auto' to choose one from the app's routes.
+    """
+    if profile == 'auto':
+        profile = choose_profile(app)
+    if profile not in PROFILES:
+        raise ValueError('Unknown worker profile %r. Choose from auto, %s.' %
+                         (profile, ', '.join(sorted(PROFILES))))
+    return PROFILES[profile](cpus or cpu_count())
 
-    default_gunicorn_config = dict(
-        worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gwebsocket.gunicorn.GWebSocketWorker'),
-        accesslog = '-',
-        errorlog = '-',
-        workers=os.getenv('GUNICORN_WORKER_COUNT', multiprocessing.cpu_count() * 2),
-        # Heroku/Velociraptor-friendly PORT handling.
-        bind='0.0.0.0:%s' % os.getenv('PORT', 8000),
-        graceful_timeout = int(os.getenv('GUNICORN_WORKER_GRACETIME', 30)),
-        timeout = int(os.getenv('GUNICORN_TIMEOUT', 10)),
-        loglevel = 'info',
-    )
 
-    def __init__(self, wsgi_app, port=None, gunicorn_config=None):
-        self.app = wsgi_app
-        self.gunicorn_config = dict(self.default_gunicorn_config)
+def environment_config():
+    """
+    Gunicorn settings given in GUNICORN_* environment variables.
+    """
+    config = {}
+    if os.getenv('GUNICORN_WORKER_CLASS'):
+        config['worker_class'] = os.getenv('GUNICORN_WORKER_CLASS')
+    if os.getenv('GUNICORN_WORKER_COUNT'):
+        config['workers'] = int(os.getenv('GUNICORN_WORKER_COUNT'))
+    if os.getenv('GUNICORN_WORKER_CONNECTIONS'):
+        config['worker_connections'] = int(
+            os.getenv('GUNICORN_WORKER_CONNECTIONS'))
+    if os.getenv('GUNICORN_THREADS'):
+        config['threads'] = int(os.getenv('GUNICORN_THREADS'))
+    return config
 
-        gunicorn_config = gunicorn_config or {}
-        if port is not None and 'bind' not in gunicorn_config:
-            gunicorn_config['bind'] = '0.0.0.0:%s' % port
-        self.gunicorn_config.update(gunicorn_config)
-        super(GunicornApplication, self).__init__()
 
-    def load_config(self):
-        for k, v in self.gunicorn_config.items():
-            self.cfg.set(k, v)
+def setup_broadcast_dir():
+    """
+    Make a directory for spa.broadcast's worker sockets, and put its path in
+    the environment for workers to find.  It's removed when this process (the
+    gunicorn master) exits.
+    """
+    from spa.broadcast import ENV_VAR
+    if os.environ.get(ENV_VAR):
+        return
+    path = tempfile.mkdtemp(prefix='spa-broadcast-')
+    os.environ[ENV_VAR] = path
+    master_pid = os.getpid()
 
-    def load(self):
-        return self.app
+    def cleanup():
+        # Workers inherit this atexit handler when they're forked.
+        if os.getpid() == master_pid:
+            shutil.rmtree(path, ignore_errors=True)
+    atexit.register(cleanup)
 
 
-def run(app, port=None, gunicorn_config=None):
-    gunicorn_app = SpaGunicornApplication(app, port, gunicorn_config)
+def warm(app):
+    """
+    Warm up `app` and any middlewares around it, by calling the warm()
+    method of each that has one (like spa.App.warm).
+    """
+    seen = set()
+    while app is not None and id(app) not in seen:
+        seen.add(id(app))
+        if callable(getattr(app, 'warm', None)):
+            app.warm()
+        app = getattr(app, 'app', None)
+
+
+def preload(app):
+    """
+    Warm up `app` in the gunicorn master, before workers are forked, so that
+    they share the results and serve their first requests warm.  Everything
+    allocated so far is then moved out of the garbage collector's sight
+    (on Python 3.7+), so collections in the workers don't write to, and so
+    copy, the memory pages they share with the master.
+    """
+    warm(app)
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def run(app, port=None, gunicorn_config=None, profile=None, preload_app=None):
+    """
+    Serve `app` with gunicorn.  `profile` can be 'auto', 'websocket', 'sync'
+    or 'static' to tune the workers for the app; see worker_config.
+
+    With `preload_app` (or the SPA_PRELOAD environment variable set), the app
+    is warmed up once in the master before workers are forked; see preload.
+    """
+    # Apps with a UnixSocketBackend have imported spa.broadcast to make it.
+    broadcast = sys.modules.get('spa.broadcast')
+    if broadcast is not None and broadcast.directory_wanted():
+        setup_broadcast_dir()
+    if preload_app is None:
+        preload_app = os.getenv('SPA_PRELOAD', '').lower() in ('1', 'true',
+                                                               'yes')
+    if preload_app:
+        preload(app)
+        gunicorn_config = dict(gunicorn_config or {}, preload_app=True)
+    # Imported here so that gunicorn is only loaded when serving.
+    from spa.server import SpaGunicornApplication
+    gunicorn_app = SpaGunicornApplication(app, port, gunicorn_config, profile)
     gunicorn_app.run()
 
 
@@ -67,3 +274,15 @@ def clean_path(path):
     path = '/' + '/'.join(x for x in path.split('/')
                           if x and x != '..')
     return path
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # SpaGunicornApplication used to live here.
+        if name == 'SpaGunicornApplication':
+            from spa.server import SpaGunicornApplication
+            return SpaGunicornApplication
+        raise AttributeError('module %r has no attribute %r' % (__name__,
+                                                                name))
+else:
+    from spa.server import SpaGunicornApplication
@@ -0,0 +1,256 @@
+"""
+Buffered sending for websockets.
+
+BufferedWebSocket wraps a gwebsocket connection (environ['wsgi.websocket'])
+and coalesces the frames of messages sent within `window` seconds of each
+other into a single socket write.  Message boundaries are kept, so clients
+see the same messages, with fewer syscalls and TCP packets between them.
+
+It also bounds how much can pile up for a slow client.  Once `high_water`
+bytes are waiting to be written, further sends either block until the
+backlog has been written ('block', the default) or are dropped ('drop').
+With 'drop', sends never wait for a write that's already in progress: what
+they queue is written once it's done.
+
+Handlers can have their self.ws wrapped automatically by setting
+`websocket_buffering` to a dict of BufferedWebSocket arguments:
+
+    class Ticker(spa.Handler):
+        websocket_buffering = {'window': 0.05, 'overflow': 'drop'}
+
+gwebsocket doesn't negotiate extensions during the handshake, so
+permessage-deflate isn't available.  Compress large payloads before sending
+them if bandwidth matters.
+"""
+import socket
+import threading
+
+import six
+
+try:
+    from gwebsocket.exceptions import SocketDeadError
+    from gwebsocket.websocket import MSG_SOCKET_DEAD, Header, WebSocket
+except ImportError:
+    Header = WebSocket = None
+
+OPCODE_TEXT = 0x01
+OPCODE_BINARY = 0x02
+
+OVERFLOW_POLICIES = ('block', 'drop')
+
+
+def encode_frame(message, binary=None):
+    if binary is None:
+        binary = not isinstance(message, six.text_type)
+    if not binary:
+        payload, opcode = message.encode('utf-8'), OPCODE_TEXT
+    else:
+        payload, opcode = bytes(message), OPCODE_BINARY
+    return Header.encode_header(True, opcode, b'', len(payload), 0) + payload
+
+
+class TimerScheduler(object):
+    """
+    Runs a function after a delay, in a new thread (or greenlet, under
+    gevent).  BufferedWebSocket uses this to flush its buffer unless it's
+    given something else with the same call_later(delay, func) method.
+    """
+
+    def call_later(self, delay, func):
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+default_scheduler = TimerScheduler()
+
+
+class BufferedWebSocket(object):
+    """
+    Wraps a gwebsocket WebSocket to buffer what's sent on it.  See the module
+    docstring.
+
+    `window` is how long, in seconds, a sent message may wait for others to
+    be written with it.  With a window of 0, every send is written
+    immediately.  The buffer is also written as soon as it holds
+    `max_batch_bytes`.
+
+    Anything that isn't about sending, like receive() and closed, is passed
+    through to the wrapped socket.
+    """
+
+    def __init__(self, ws, window=0.01, max_batch_bytes=64 * 1024,
+                 high_water=1024 * 1024, overflow='block', scheduler=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s' %
+                             ', '.join(OVERFLOW_POLICIES))
+        self.ws = ws
+        self.window = window
+        self.max_batch_bytes = max_batch_bytes
+        self.high_water = high_water
+        self.overflow = overflow
+        self.scheduler = (scheduler if scheduler is not None
+                          else default_scheduler)
+
+        # Only gwebsocket connections can have raw frames written to them.
+        # Anything else just gets its messages passed along one by one.
+        self.raw = WebSocket is not None and isinstance(ws, WebSocket)
+
+        self.messages = 0
+        self.writes = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.max_queued_bytes = 0
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        # Bytes taken from the buffer by a write that hasn't finished.
+        self._writing_bytes = 0
+        self._flush_scheduled = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+    @property
+    def queued_bytes(self):
+        return self._buffered_bytes + self._writing_bytes
+
+    def send(self, message, binary=None):
+        """
+        Queue a message to be sent.  Returns False if it was dropped.
+        """
+        if not self.raw:
+            return self._queue((message, binary), 0)
+        return self.write_frame(encode_frame(message, binary))
+
+    def write_frame(self, frame):
+        """
+        Queue an already encoded frame.  Only gwebsocket connections can take
+        these.
+        """
+        if not self.raw:
+            raise TypeError('%r does not take raw frames' % self.ws)
+        return self._queue(frame, len(frame))
+
+    def send_message(self, message):
+        """
+        Queue a spa.hub.Message, reusing its encoded frame if possible.
+        """
+        if self.raw:
+            return self.write_frame(message.frame)
+        return self._queue((message.data, None), 0)
+
+    def _queue(self, item, size):
+        if self.ws.closed:
+            return False
+        if self.queued_bytes >= self.high_water:
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return False
+            # Block until what's already queued has been written.
+            self.flush()
+
+        with self._lock:
+            self._buffer.append(item)
+            self._buffered_bytes += size
+            self.messages += 1
+            self.max_queued_bytes = max(self.max_queued_bytes,
+                                        self.queued_bytes)
+            flush_now = (not self.raw or not self.window or
+                         self._buffered_bytes >= self.max_batch_bytes)
+            schedule = not flush_now and not self._flush_scheduled
+            if schedule:
+                self._flush_scheduled = True
+
+        if flush_now:
+            if self.overflow == 'block':
+                self.flush()
+            elif not self.flush(blocking=False):
+                # Another write, perhaps stuck on a slow client, is in
+                # progress.  Leave this one for later instead of waiting.
+                self._schedule_flush()
+        elif schedule:
+            self.scheduler.call_later(self.window, self._scheduled_flush)
+        return True
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.scheduler.call_later(self.window, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            # There's nobody to raise to from here.  The handler will find out
+            # the socket is dead the next time it uses it.
+            pass
+        # Anything queued while that write was going on needs another.
+        with self._lock:
+            self._flush_scheduled = False
+            pending = bool(self._buffer)
+        if pending and not self.ws.closed:
+            self._schedule_flush()
+
+    def flush(self, blocking=True):
+        """
+        Write everything buffered so far, waiting for any write already in
+        progress to finish first.  With `blocking` False, returns False
+        instead of waiting.
+        """
+        if not self._write_lock.acquire(blocking):
+            return False
+        try:
+            with self._lock:
+                items, self._buffer = self._buffer, []
+                size = self._buffered_bytes
+                self._buffered_bytes = 0
+                self._writing_bytes = size
+            if not items:
+                return True
+            try:
+                if self.raw:
+                    data = b''.join(items)
+                    if not self.ws.closed:
+                        try:
+                            self.ws.raw_write(data)
+                        except socket.error:
+                            # As WebSocket.send would.
+                            raise SocketDeadError(MSG_SOCKET_DEAD)
+                        self.writes += 1
+                        self.bytes_sent += len(data)
+                else:
+                    for message, binary in items:
+                        if binary is None:
+                            self.ws.send(message)
+                        else:
+                            self.ws.send(message, binary)
+                        self.writes += 1
+            finally:
+                self._writing_bytes = 0
+        finally:
+            self._write_lock.release()
+        return True
+
+    def close(self, code=1000, message=''):
+        if not self.ws.closed:
+            try:
+                self.flush()
+            except Exception:
+                pass
+        return self.ws.close(code, message)
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'writes': self.writes,
+            'bytes_sent': self.bytes_sent,
+            'dropped': self.dropped,
+            'queued_bytes': self.queued_bytes,
+            'max_queued_bytes': self.max_queued_bytes,
+        }
@@ -1,14 +1,74 @@
-import json
-
-import six
-
+from werkzeug.utils import cached_property
 from werkzeug.wrappers import Response, Request as WRequest
 
+from spa import jsonlib
+from spa.cookies import get_cookies
+
 
 class JSONResponse(Response):
+    """
+    Response with `data` serialized as JSON by spa.jsonlib.  Output is compact
+    unless you pass `indent` or `sort_keys`.
+    """
     def __init__(self, data, *args, **kwargs):
+        indent = kwargs.pop('indent', None)
+        sort_keys = kwargs.pop('sort_keys', False)
         kwargs['content_type'] = 'application/json'
-        return super(JSONResponse, self).__init__(json.dumps(data), *args, **kwargs)
+        body = jsonlib.dumps(data, indent=indent, sort_keys=sort_keys)
+        return super(JSONResponse, self).__init__(body, *args, **kwargs)
+
+
+class JSONStreamResponse(Response):
+    """
+    Response that streams an iterable of records as JSON, serializing them one
+    at a time, so the whole body is never held in memory.
+
+    By default the records are sent as a single JSON array.  With
+    `ndjson=True`, each record is sent as a line of newline-delimited JSON,
+    with the application/x-ndjson content type.
+
+    Records are sent in chunks of about `chunk_size` bytes.
+    """
+    chunk_size = 16 * 1024
+
+    def __init__(self, records, ndjson=False, chunk_size=None, *args,
+                 **kwargs):
+        self.ndjson = ndjson
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        kwargs['content_type'] = ('application/x-ndjson' if ndjson else
+                                  'application/json')
+        super(JSONStreamResponse, self).__init__(self.iter_json(records),
+                                                 *args, **kwargs)
+
+    def iter_json(self, records):
+        if self.ndjson:
+            start, separator, end = b'', b'\n', b'\n'
+        else:
+            start, separator, end = b'[', b',', b']'
+
+        dumps = jsonlib.dumps
+        chunk_size = self.chunk_size
+        buf, buffered = [start], len(start)
+        first = True
+        try:
+            for record in records:
+                if first:
+                    first = False
+                else:
+                    buf.append(separator)
+                data = dumps(record)
+                buf.append(data)
+                buffered += len(data) + 1
+                if buffered >= chunk_size:
+                    yield b''.join(buf)
+                    buf, buffered = [], 0
+            if not (self.ndjson and first):
+                buf.append(end)
+            yield b''.join(buf)
+        finally:
+            if hasattr(records, 'close'):
+                records.close()
 
 
 JSON_TYPES = set([
@@ -20,7 +80,8 @@ JSON_TYPES = set([
 
 class Request(WRequest):
     """
-    Request with an extra .json() method.
+    Request with an extra .json() method, and cookies shared with spa's
+    middlewares through spa.cookies.get_cookies().
     """
     # This is copied from
     # http://werkzeug.pocoo.org/docs/0.10/request_data/#how-to-extend-parsing,
@@ -30,11 +91,13 @@ class Request(WRequest):
     # accept up to 4MB of transmitted data.
     max_content_length = 1024 * 1024 * 4
 
+    @cached_property
+    def cookies(self):
+        return self.dict_storage_class(get_cookies(self.environ))
+
     def json(self):
         if self.headers.get('content-type', '').lower() in JSON_TYPES:
-            if six.PY3:
-                return json.loads(self.data.decode())
-            return json.loads(self.data)
+            return jsonlib.loads(self.get_data(cache=True))
         else:
             from spa.exceptions import JSONBadRequest
             raise JSONBadRequest('Expected Content-Type application/json, not %s'
@@ -1,3 +1,5 @@
+import json
+
 from werkzeug.test import Client
 
 import spa
@@ -69,7 +71,7 @@ def test_json_response():
     ))
     c = Client(app, spa.Response)
     resp = c.get('/')
-    assert resp.data == b'{"a": 1}'
+    assert json.loads(resp.data.decode('utf-8')) == {'a': 1}
     assert resp.headers['Content-Type'] == "application/json"
 
 
@@ -107,5 +109,155 @@ def test_json_handler():
     ))
     c = Client(app, spa.Response)
     resp = c.get('/')
-    assert resp.data == b'{"a": 1}'
+    assert json.loads(resp.data.decode('utf-8')) == {'a': 1}
     assert resp.headers['Content-Type'] == "application/json"
+
+
+def test_router_static_and_dynamic_routes():
+    class Hello(spa.Handler):
+        def get(self, name=None):
+            return spa.Response('hello %s' % (name or self.route_name))
+
+    app = spa.App((
+        ('/', 'index', Hello),
+        ('/about/', 'about', Hello),
+        ('/users/<name>/', 'user', Hello),
+    ))
+    assert app.router.static_routes == {'/': 'index', '/about/': 'about'}
+
+    c = Client(app, spa.Response)
+    assert c.get('/about/').data == b'hello about'
+    assert c.get('/users/bob/').data == b'hello bob'
+    assert c.get('/nope/').status_code == 404
+
+    stats = app.router.stats()
+    assert stats['static_matches'] == 1
+    assert stats['dynamic_matches'] == 1
+    assert stats['failed_matches'] == 1
+    assert stats['cached_adapters'] == 1
+
+
+def test_router_keeps_trailing_slash_redirects():
+    class Hello(spa.Handler):
+        def get(self):
+            return spa.Response('hello')
+
+    app = spa.App((
+        ('/about/', 'about', Hello),
+    ))
+    c = Client(app, spa.Response)
+    resp = c.get('/about?x=1')
+    assert resp.status_code in (301, 308)
+    assert resp.headers['Location'] == 'http://localhost/about/?x=1'
+
+
+def test_router_adapters_per_host():
+    class Hello(spa.Handler):
+        def get(self, name):
+            return spa.Response(name)
+
+    app = spa.App((
+        ('/users/<name>/', 'user', Hello),
+    ))
+    c = Client(app, spa.Response)
+    c.get('/users/a/', base_url='http://one.example.com/')
+    c.get('/users/b/', base_url='http://two.example.com/')
+    c.get('/users/c/', base_url='http://two.example.com/')
+    assert app.router.stats()['cached_adapters'] == 2
+
+
+def test_unmatched_requests_skip_request_construction():
+    made = []
+
+    class CountingRequest(spa.Request):
+        def __init__(self, environ, *args, **kwargs):
+            made.append(environ['PATH_INFO'])
+            super(CountingRequest, self).__init__(environ, *args, **kwargs)
+
+    class Hello(spa.Handler):
+        def get(self):
+            return spa.Response('hello')
+
+    app = spa.App((
+        ('/', 'hello', Hello),
+    ), request_class=CountingRequest)
+    c = Client(app, spa.Response)
+    assert c.get('/wp-login.php').status_code == 404
+    assert c.get('/').status_code == 200
+    assert made == ['/']
+
+
+def test_not_found_page_is_reused():
+    from werkzeug.exceptions import NotFound
+
+    app = spa.App((
+        ('/', 'hello', spa.Handler),
+    ))
+    c = Client(app, spa.Response)
+    expected = Client(NotFound(), spa.Response).get('/')
+    for path in ('/a', '/b'):
+        resp = c.get(path)
+        assert resp.status == expected.status
+        assert resp.data == expected.data
+        assert resp.headers['Content-Length'] == str(len(expected.data))
+
+    resp = c.head('/c')
+    assert resp.status_code == 404
+    assert resp.data == b''
+
+
+def test_json_handler_streams_generators():
+    class A(spa.JSONHandler):
+        def get(self):
+            return ({'n': n} for n in range(3))
+
+    app = spa.App((
+        ('/', 'a', A),
+    ))
+    c = Client(app, spa.Response)
+    resp = c.get('/')
+    assert json.loads(resp.data.decode('utf-8')) == [{'n': 0}, {'n': 1},
+                                                      {'n': 2}]
+    assert resp.headers['Content-Type'] == "application/json"
+    assert 'Content-Length' not in resp.headers
+
+
+def test_json_handler_streams_ndjson():
+    class A(spa.JSONHandler):
+        json_stream_format = 'ndjson'
+
+        def get(self):
+            return iter([{'n': 0}, {'n': 1}])
+
+    app = spa.App((
+        ('/', 'a', A),
+    ))
+    c = Client(app, spa.Response)
+    resp = c.get('/')
+    lines = resp.data.decode('utf-8').split('\n')
+    assert [json.loads(l) for l in lines if l] == [{'n': 0}, {'n': 1}]
+    assert resp.data.endswith(b'\n')
+    assert resp.headers['Content-Type'] == "application/x-ndjson"
+
+
+def test_json_stream_response_chunks_and_closes():
+    closed = []
+
+    def records():
+        try:
+            for n in range(100):
+                yield {'n': n}
+        finally:
+            closed.append(True)
+
+    resp = spa.JSONStreamResponse(records(), chunk_size=64)
+    chunks = list(resp.response)
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) < 64 + 20
+    assert json.loads(b''.join(chunks).decode('utf-8')) == [
+        {'n': n} for n in range(100)]
+    assert closed == [True]
+
+    assert b''.join(spa.JSONStreamResponse(iter([])).response) == b'[]'
+    assert b''.join(spa.JSONStreamResponse(iter([]), ndjson=True)
+                    .response) == b''
@@ -0,0 +1,314 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+from werkzeug.exceptions import Forbidden, NotFound
+
+import spa
+from spa import heartbeat as heartbeat_module
+from spa.asgi import ASGIApp, wait_for
+from spa.heartbeat import Heartbeat, TimerWheel
+from spa.metrics import UNMATCHED, Metrics
+from spa.jwtcookie import JWTSessionMiddleware
+from spa.middlewares import (ApiCSRFMiddleware, GzipMiddleware, Middleware,
+                             Pipeline)
+from spa.static import Static
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def _run(coro):
+    # asyncio.run() needs Python 3.7.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def _request(app, path, method='GET', headers=(), body=b''):
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': b'',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in headers],
+        'server': ('testserver', 80),
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    _run(app(scope, receive, send))
+    start = sent[0]
+    headers = dict((k.decode(), v.decode()) for k, v in start['headers'])
+    body = b''.join(m.get('body', b'') for m in sent[1:])
+    assert sent[-1].get('more_body') is not True
+    return start['status'], headers, body
+
+
+class SyncHello(spa.Handler):
+    def get(self):
+        return spa.Response('hello sync')
+
+    def post(self):
+        return spa.Response(self.request.data)
+
+
+class AsyncHello(spa.Handler):
+    async def get(self, name):
+        await asyncio.sleep(0)
+        return spa.Response('hello %s' % name)
+
+
+class AsyncJSON(spa.JSONHandler):
+    async def get(self):
+        return {'async': True}
+
+
+class AsyncErrors(spa.Handler):
+    async def get(self):
+        raise NotFound()
+
+    async def post(self):
+        raise Forbidden()
+
+
+def _app():
+    return spa.App((
+        ('/', 'sync', SyncHello),
+        ('/hello/<name>/', 'async', AsyncHello),
+        ('/json/', 'json', AsyncJSON),
+        ('/errors/', 'errors', AsyncErrors),
+        ('/static/<path:filepath>', 'static',
+         Static(os.path.join(here, 'static'))),
+    ))
+
+
+def test_sync_and_async_handlers():
+    app = ASGIApp(_app())
+    assert _request(app, '/')[2] == b'hello sync'
+    assert _request(app, '/hello/bob/')[2] == b'hello bob'
+    status, headers, body = _request(app, '/json/')
+    assert json.loads(body.decode()) == {'async': True}
+    assert headers['content-type'] == 'application/json'
+    assert _request(app, '/', method='POST', body=b'data')[2] == b'data'
+    assert _request(app, '/nope/')[0] == 404
+
+
+def test_async_handler_http_exceptions():
+    app = ASGIApp(_app())
+    assert _request(app, '/errors/')[0] == 404
+    assert _request(app, '/errors/', method='POST')[0] == 403
+    assert _request(app, '/errors/', method='PUT')[0] == 405
+
+
+def test_async_handlers_are_measured():
+    metrics = Metrics()
+    app = ASGIApp(spa.App((('/hello/<name>/', 'async', AsyncHello),
+                           ('/errors/', 'errors', AsyncErrors)),
+                          metrics=metrics))
+    assert _request(app, '/hello/dave/')[2] == b'hello dave'
+    assert _request(app, '/errors/')[0] == 404
+    assert _request(app, '/nope/')[0] == 404
+
+    route = metrics.routes['async']
+    assert route.handler.count == 1
+    assert route.bytes.sum == len(b'hello dave')
+    assert metrics.routes['errors'].handler.count == 1
+    assert metrics.routes[UNMATCHED].match.count == 1
+
+
+def test_static_files():
+    status, headers, body = _request(ASGIApp(_app()), '/static/css/test.css')
+    assert status == 200
+    with open(os.path.join(here, 'static', 'css', 'test.css'), 'rb') as f:
+        assert body == f.read()
+
+
+def test_async_handler_behind_middleware():
+    app = spa.App((('/hello/<name>/', 'async', AsyncHello),))
+    asgi_app = ASGIApp(ApiCSRFMiddleware(app))
+    status, headers, body = _request(asgi_app, '/hello/alice/')
+    assert body == b'hello alice'
+    assert 'api_csrf=' in headers['set-cookie']
+
+
+class ThreadName(spa.Handler):
+    async def get(self):
+        return spa.Response(threading.current_thread().name)
+
+
+def test_async_handler_behind_middleware_runs_on_loop():
+    app = spa.App((('/', 'thread', ThreadName),))
+    asgi_app = ASGIApp(Pipeline(app, [ApiCSRFMiddleware()]))
+    status, headers, body = _request(asgi_app, '/')
+    assert body == threading.current_thread().name.encode()
+    assert 'api_csrf=' in headers['set-cookie']
+
+    # The hooks can still turn requests away.
+    status, headers, body = _request(asgi_app, '/', method='POST')
+    assert status == 403
+
+
+def test_async_handler_under_wsgi():
+    from werkzeug.test import Client
+    c = Client(_app(), spa.Response)
+    assert c.get('/hello/carol/').data == b'hello carol'
+
+
+def test_wait_for_without_loop():
+    async def answer():
+        return 42
+    assert wait_for({}, answer()) == 42
+
+
+class AsyncEcho(spa.Handler):
+    async def websocket(self):
+        while True:
+            message = await self.ws.receive()
+            if message is None:
+                break
+            await self.ws.send('echo ' + message)
+
+
+class SyncEcho(spa.Handler):
+    def websocket(self):
+        message = self.ws.receive()
+        self.ws.send('sync ' + message)
+        self.ws.close()
+
+
+class ManualWheel(TimerWheel):
+    def start(self):
+        pass
+
+
+def inline(func, *args):
+    func(*args)
+
+
+class Quiet(spa.Handler):
+    heartbeat = Heartbeat(interval=1, timeout=2, wheel=ManualWheel(),
+                          spawn=inline)
+
+    async def websocket(self):
+        while await self.ws.receive() is not None:
+            pass
+
+
+def test_websocket_heartbeat(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(heartbeat_module.time, 'time', lambda: now[0])
+    heartbeat = Quiet.heartbeat
+    scope = {'type': 'websocket', 'path': '/ws/', 'headers': [],
+             'query_string': b'', 'scheme': 'ws'}
+    messages = [
+        {'type': 'websocket.connect'},
+        {'type': 'websocket.receive', 'text': 'a'},
+    ]
+    sent = []
+
+    async def receive():
+        if messages:
+            now[0] += 1.5
+            return messages.pop(0)
+        # Receiving counted as activity.
+        ws, last_seen = list(heartbeat._sockets.values())[0]
+        assert last_seen == 1003.0
+        sent.append('idle')
+        # Time out, and let the close scheduled from the "wheel's thread"
+        # run on the loop.
+        now[0] += 3
+        heartbeat.wheel.advance()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        return {'type': 'websocket.disconnect', 'code': 1001}
+
+    async def send(message):
+        sent.append(message)
+
+    app = ASGIApp(spa.App((('/ws/', 'ws', Quiet),)))
+    _run(app(scope, receive, send))
+    assert sent == [{'type': 'websocket.accept'}, 'idle',
+                    {'type': 'websocket.close', 'code': 1001}]
+    assert heartbeat.reaped == 1
+    assert heartbeat.watching() == 0
+
+
+def _websocket(app, path, incoming):
+    scope = {'type': 'websocket', 'path': path, 'headers': [],
+             'query_string': b'', 'scheme': 'ws'}
+    messages = [{'type': 'websocket.connect'}]
+    messages += [{'type': 'websocket.receive', 'text': m} for m in incoming]
+    messages.append({'type': 'websocket.disconnect', 'code': 1000})
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    _run(app(scope, receive, send))
+    return sent
+
+
+@pytest.mark.parametrize('handler,expected', [
+    (AsyncEcho, ['echo a', 'echo b']),
+    (SyncEcho, ['sync a']),
+])
+def test_websockets(handler, expected):
+    app = ASGIApp(spa.App((('/ws/', 'ws', handler),)))
+    sent = _websocket(app, '/ws/', ['a', 'b'])
+    assert sent[0] == {'type': 'websocket.accept'}
+    assert [m['text'] for m in sent if m['type'] == 'websocket.send'] == \
+        expected
+
+
+def test_sync_websocket_is_closed():
+    app = ASGIApp(spa.App((('/ws/', 'ws', SyncEcho),)))
+    sent = _websocket(app, '/ws/', ['a'])
+    assert sent[-1] == {'type': 'websocket.close', 'code': 1000}
+
+
+def test_websocket_not_found():
+    app = ASGIApp(spa.App((('/ws/', 'ws', AsyncEcho),)))
+    sent = _websocket(app, '/other/', [])
+    assert sent == [{'type': 'websocket.close', 'code': 1000}]
+
+
+class Reject(Middleware):
+    def process_request(self, environ):
+        return Forbidden()
+
+
+def test_websocket_behind_middleware():
+    app = spa.App((('/ws/', 'ws', AsyncEcho),))
+    asgi_app = ASGIApp(JWTSessionMiddleware(ApiCSRFMiddleware(app),
+                                            secret_key='secret'))
+    sent = _websocket(asgi_app, '/ws/', ['a'])
+    assert sent[0]['type'] == 'websocket.accept'
+    cookies = [v for k, v in sent[0]['headers'] if k == b'set-cookie']
+    assert len(cookies) == 2
+    assert [m['text'] for m in sent if m['type'] == 'websocket.send'] == \
+        ['echo a']
+
+
+def test_websocket_behind_other_middleware():
+    app = spa.App((('/ws/', 'ws', AsyncEcho),))
+    sent = _websocket(ASGIApp(GzipMiddleware(app)), '/ws/', ['a'])
+    assert sent[0] == {'type': 'websocket.accept'}
+
+
+def test_websocket_rejected_by_middleware():
+    app = spa.App((('/ws/', 'ws', AsyncEcho),))
+    sent = _websocket(ASGIApp(Reject(app)), '/ws/', ['a'])
+    assert sent == [{'type': 'websocket.close', 'code': 1008}]
@@ -0,0 +1,114 @@
+import os
+import time
+
+from spa.broadcast import (LocalBackend, UnixSocketBackend, decode_packet,
+                           default_backend, encode_packet)
+from spa.hub import Hub, Message
+
+from test_hub import FakeSocket
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_packet_roundtrip():
+    message = Message({'a': 1})
+    channel, decoded = decode_packet(encode_packet(u'tick\xe9r', message))
+    assert channel == u'tick\xe9r'
+    assert decoded.payload == message.payload
+    assert decoded.opcode == message.opcode
+
+
+def test_local_backend():
+    hub = Hub(backend=LocalBackend())
+    ws = FakeSocket()
+    sub = hub.subscribe(ws, 'ch')
+    assert hub.publish('ch', u'hi') == 1
+    sub.send_pending()
+    assert ws.sent == [u'hi']
+
+
+def test_unix_socket_backend_between_hubs(tmpdir):
+    # Two backends on one directory stand in for two worker processes.
+    backends = [UnixSocketBackend(str(tmpdir)) for _ in range(2)]
+    hubs = [Hub(backend=backend) for backend in backends]
+    sockets = [FakeSocket() for _ in hubs]
+    subs = [hub.subscribe(ws, 'ch') for hub, ws in zip(hubs, sockets)]
+    try:
+        hubs[0].publish('ch', {'n': 1})
+
+        def delivered():
+            for sub in subs:
+                sub.send_pending()
+            return all(ws.sent for ws in sockets)
+        _wait_for(delivered)
+        assert sockets[0].sent == sockets[1].sent == [u'{"n":1}']
+        assert backends[0].sent == 1
+        assert backends[1].received == 1
+    finally:
+        for backend in backends:
+            backend.close()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_unix_socket_backend_forgets_dead_workers(tmpdir):
+    backend = UnixSocketBackend(str(tmpdir))
+    dead = tmpdir.join('1-dead.sock')
+    dead.write('')
+    try:
+        backend.publish('ch', Message(u'x'))
+        assert not dead.exists()
+    finally:
+        backend.close()
+
+
+def test_unix_socket_backend_without_directory(monkeypatch):
+    monkeypatch.delenv('SPA_BROADCAST_DIR', raising=False)
+    hub = Hub(backend=default_backend())
+    ws = FakeSocket()
+    sub = hub.subscribe(ws, 'ch')
+    hub.publish('ch', u'local')
+    sub.send_pending()
+    assert ws.sent == [u'local']
+    hub.backend.close()
+
+
+def test_setup_broadcast_dir(monkeypatch):
+    from spa.utils import setup_broadcast_dir
+    monkeypatch.delenv('SPA_BROADCAST_DIR', raising=False)
+    setup_broadcast_dir()
+    path = os.environ['SPA_BROADCAST_DIR']
+    assert os.path.isdir(path)
+    os.rmdir(path)
+
+
+class FakeGunicornApplication(object):
+    def __init__(self, *args):
+        pass
+
+    def run(self):
+        pass
+
+
+def test_run_only_sets_up_broadcast_dir_when_wanted(monkeypatch):
+    import spa
+    from spa import broadcast
+    monkeypatch.setattr('spa.server.SpaGunicornApplication',
+                        FakeGunicornApplication)
+    monkeypatch.delenv('SPA_BROADCAST_DIR', raising=False)
+    app = spa.App(())
+
+    monkeypatch.setattr(broadcast, '_directory_wanted', False)
+    UnixSocketBackend('/some/dir')
+    spa.run(app)
+    assert 'SPA_BROADCAST_DIR' not in os.environ
+
+    UnixSocketBackend()
+    spa.run(app)
+    path = os.environ['SPA_BROADCAST_DIR']
+    assert os.path.isdir(path)
+    os.rmdir(path)
@@ -0,0 +1,241 @@
+import logging
+import threading
+
+import pytest
+from gwebsocket.websocket import WebSocket
+
+from spa.websocket import BufferedWebSocket
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.written = []
+        self.write = self.written.append
+        self.read = lambda n: b''
+
+
+class ManualScheduler(object):
+    def __init__(self):
+        self.calls = []
+
+    def call_later(self, delay, func):
+        self.calls.append((delay, func))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for delay, func in calls:
+            func()
+
+
+class FakeHandler(object):
+    logger = logging.getLogger('test')
+
+
+def make_socket(stream=None, **kwargs):
+    stream = stream or FakeStream()
+    ws = BufferedWebSocket(WebSocket({}, stream, FakeHandler()), **kwargs)
+    return ws, stream
+
+
+def test_coalesces_messages_in_window():
+    scheduler = ManualScheduler()
+    ws, stream = make_socket(window=0.05, scheduler=scheduler)
+    ws.send(u'one')
+    ws.send(b'\x00\x01')
+    ws.send(u'caf\xe9')
+    assert stream.written == []
+    assert len(scheduler.calls) == 1
+    assert scheduler.calls[0][0] == 0.05
+
+    scheduler.run()
+    assert stream.written == [b'\x81\x03one' b'\x82\x02\x00\x01'
+                              b'\x81\x05caf\xc3\xa9']
+    stats = ws.stats()
+    assert stats['messages'] == 3
+    assert stats['writes'] == 1
+    assert stats['bytes_sent'] == len(stream.written[0])
+    assert stats['queued_bytes'] == 0
+
+
+def test_no_window_writes_immediately():
+    ws, stream = make_socket(window=0)
+    ws.send(u'a')
+    ws.send(u'b')
+    assert stream.written == [b'\x81\x01a', b'\x81\x01b']
+
+
+def test_flushes_at_max_batch_bytes():
+    scheduler = ManualScheduler()
+    ws, stream = make_socket(window=1, max_batch_bytes=10,
+                             scheduler=scheduler)
+    ws.send(u'12345')
+    assert stream.written == []
+    ws.send(u'67890')
+    assert stream.written == [b'\x81\x0512345\x81\x0567890']
+
+
+def test_write_frame_from_hub():
+    from spa.hub import Hub
+    scheduler = ManualScheduler()
+    ws, stream = make_socket(scheduler=scheduler)
+    hub = Hub()
+    sub = hub.subscribe(ws, 'ch')
+    hub.publish('ch', u'hi')
+    hub.publish('ch', u'there')
+    sub.send_pending()
+    scheduler.run()
+    assert stream.written == [b'\x81\x02hi\x81\x05there']
+
+
+def test_high_water_drop():
+    scheduler = ManualScheduler()
+    ws, stream = make_socket(high_water=8, overflow='drop',
+                             scheduler=scheduler)
+    assert ws.send(u'12345')
+    assert ws.send(u'67890')
+    assert not ws.send(u'dropped')
+    assert ws.stats()['dropped'] == 1
+    assert ws.stats()['max_queued_bytes'] == 14
+    scheduler.run()
+    assert stream.written == [b'\x81\x0512345\x81\x0567890']
+
+
+def test_high_water_block_waits_for_write():
+    scheduler = ManualScheduler()
+    ws, stream = make_socket(high_water=8, scheduler=scheduler)
+    ws.send(u'12345')
+    ws.send(u'67890')
+    # Over the mark, so this send writes out the backlog first.
+    assert ws.send(u'abc')
+    assert stream.written == [b'\x81\x0512345\x81\x0567890']
+    scheduler.run()
+    assert stream.written[1] == b'\x81\x03abc'
+    assert ws.stats()['dropped'] == 0
+
+
+def test_close_flushes():
+    ws, stream = make_socket(scheduler=ManualScheduler())
+    ws.send(u'bye')
+    ws.close()
+    assert stream.written[0] == b'\x81\x03bye'
+    assert ws.closed
+    assert not ws.send(u'too late')
+
+
+def test_default_scheduler_flushes():
+    stream = FakeStream()
+    done = threading.Event()
+    stream.write = lambda data: (stream.written.append(data), done.set())
+    ws, stream = make_socket(stream, window=0.01)
+    ws.send(u'later')
+    assert done.wait(2)
+    assert stream.written == [b'\x81\x05later']
+
+
+def test_passes_messages_through_to_other_sockets():
+    from test_hub import FakeSocket
+    fake = FakeSocket()
+    ws = BufferedWebSocket(fake)
+    ws.send(u'a')
+    assert fake.sent == [u'a']
+    assert ws.stats()['writes'] == 1
+    with pytest.raises(TypeError):
+        ws.write_frame(b'\x81\x01a')
+
+    from spa.hub import Hub
+    hub = Hub()
+    hub.subscribe(ws, 'ch')
+    hub.publish('ch', {'b': 1})
+    hub.subscribe(ws).send_pending()
+    assert fake.sent == [u'a', u'{"b":1}']
+
+
+def test_bad_overflow():
+    with pytest.raises(ValueError):
+        make_socket(overflow='explode')
+
+
+def test_handler_websocket_buffering():
+    import spa
+    from werkzeug.test import EnvironBuilder
+
+    seen = []
+
+    class Ticker(spa.Handler):
+        websocket_buffering = {'window': 0}
+
+        def websocket(self):
+            seen.append(self.ws)
+            self.ws.send(u'tick')
+            return spa.Response('')
+
+    app = spa.App((('/', 'ticker', Ticker),))
+    stream = FakeStream()
+    environ = EnvironBuilder('/').get_environ()
+    environ['wsgi.websocket'] = WebSocket(environ, stream, FakeHandler())
+    app(environ, lambda status, headers: None)
+    assert isinstance(seen[0], BufferedWebSocket)
+    assert stream.written == [b'\x81\x04tick']
+
+
+class StuckStream(FakeStream):
+    """A stream whose first write doesn't return until released."""
+
+    def __init__(self):
+        super(StuckStream, self).__init__()
+        self.stuck = threading.Event()
+        self.release = threading.Event()
+        self.write = self.stuck_write
+
+    def stuck_write(self, data):
+        if not self.stuck.is_set():
+            self.stuck.set()
+            self.release.wait(5)
+        self.written.append(data)
+
+
+def test_drop_never_waits_for_stuck_write():
+    stream = StuckStream()
+    ws, stream = make_socket(stream, window=0.001, max_batch_bytes=100,
+                             high_water=1000, overflow='drop')
+    # Written by the scheduler's thread, which gets stuck.
+    ws.send(u'x')
+    assert stream.stuck.wait(2)
+
+    done = threading.Event()
+
+    def produce():
+        for _ in range(200):
+            ws.send(u'y' * 50)
+        done.set()
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    assert done.wait(2)
+    stats = ws.stats()
+    assert stats['dropped'] > 0
+    assert stats['queued_bytes'] <= 1000 + 52
+
+    stream.release.set()
+    for _ in range(200):
+        if ws.stats()['queued_bytes'] == 0:
+            break
+        threading.Event().wait(0.01)
+    assert ws.stats()['queued_bytes'] == 0
+    sent = 200 - stats['dropped']
+    assert b''.join(stream.written).count(b'y' * 50) == sent
+
+
+def test_dead_socket_raises_gwebsocket_error():
+    import socket
+    from gwebsocket.exceptions import SocketDeadError
+
+    def broken_write(data):
+        raise socket.error('Broken pipe')
+
+    stream = FakeStream()
+    stream.write = broken_write
+    ws, stream = make_socket(stream, window=0)
+    with pytest.raises(SocketDeadError):
+        ws.send(u'hello')
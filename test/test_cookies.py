@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from werkzeug.test import EnvironBuilder
+
+import spa
+from spa.cookies import get_cookies, parse_cookie_header
+
+
+def test_parse_cookie_header():
+    header = 'a=1; b="quoted \\"value\\""; junk; c = 3 ;a=2; d='
+    assert parse_cookie_header(header) == {
+        'a': '1',
+        'b': 'quoted "value"',
+        'c': '3',
+        'd': '',
+    }
+
+
+def test_get_cookies_parses_once():
+    environ = {'HTTP_COOKIE': 'session=abc; api_csrf=xyz'}
+    cookies = get_cookies(environ)
+    assert cookies == {'session': 'abc', 'api_csrf': 'xyz'}
+    assert get_cookies(environ) is cookies
+
+    # A changed header is parsed again.
+    environ['HTTP_COOKIE'] = 'session=def'
+    assert get_cookies(environ) == {'session': 'def'}
+    assert get_cookies({}) == {}
+
+
+def test_get_cookies_decodes_utf8():
+    value = u'zażółć'.encode('utf-8').decode('latin-1')
+    assert get_cookies({'HTTP_COOKIE': 'name=' + value}) == {
+        'name': u'zażółć'}
+
+
+def test_request_cookies_share_parse():
+    environ = EnvironBuilder('/', headers={'Cookie': 'a=1; b=2'}).get_environ()
+    cookies = get_cookies(environ)
+    req = spa.Request(environ)
+    assert req.cookies['a'] == '1'
+    assert dict(req.cookies) == cookies
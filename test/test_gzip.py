@@ -0,0 +1,134 @@
+import zlib
+
+import pytest
+from werkzeug.test import Client
+
+import spa
+from spa import gzip_util
+from spa.encoders import GzipEncoder
+from spa.middlewares import CompressionMiddleware, GzipMiddleware
+
+
+def _gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def test_compress_coalesces_output():
+    chunks = [b'chunk %d ' % i for i in range(1000)]
+    out = list(gzip_util.compress(chunks, 6))
+    # Small input, so the header, body and trailer all come out together.
+    assert len(out) == 1
+    assert _gunzip(b''.join(out)) == b''.join(chunks)
+
+
+def test_compress_flush_size():
+    chunks = [b'a' * 100 for i in range(10)]
+    out = list(gzip_util.compress(chunks, 6, flush_size=300))
+    # flushes after the 3rd, 6th and 9th chunks, then the end of the stream.
+    assert len(out) == 4
+    assert _gunzip(b''.join(out)) == b''.join(chunks)
+
+    # Each flushed piece can be decompressed as soon as it arrives.
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(out[0]) == b'a' * 300
+
+
+def test_gzip_compressor():
+    compressor = GzipEncoder().compressor(6)
+    out = [compressor.compress(b'a' * 100), compressor.flush()]
+    # The header goes out with the first output, so flushed output can be
+    # decompressed as soon as it arrives.
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(b''.join(out)) == b'a' * 100
+    out.append(compressor.finish())
+    assert _gunzip(b''.join(out)) == b'a' * 100
+
+    assert _gunzip(GzipEncoder().compress_bytes(b'')) == b''
+
+
+def _gzip_app(body, **kwargs):
+    class A(spa.Handler):
+        def get(self):
+            return spa.Response(body, content_type='application/json')
+    return GzipMiddleware(spa.App((('/', 'a', A),)), **kwargs)
+
+
+def test_gzip_middleware():
+    body = '{"a": "%s"}' % ('x' * 1000)
+    c = Client(_gzip_app(body), spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in resp.headers
+    assert _gunzip(resp.data) == body.encode('utf-8')
+
+
+def test_gzip_middleware_skips_small_responses():
+    c = Client(_gzip_app('{"a": 1}'), spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == b'{"a": 1}'
+
+    c = Client(_gzip_app('{"a": 1}', min_size=0), spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+
+
+def _compression_app(body, **kwargs):
+    class A(spa.Handler):
+        def get(self):
+            return spa.Response(body, content_type='application/json')
+    return CompressionMiddleware(spa.App((('/', 'a', A),)), **kwargs)
+
+
+def test_compression_middleware_falls_back_to_gzip():
+    body = '{"a": "%s"}' % ('x' * 1000)
+    app = _compression_app(body, encoders=[GzipEncoder()])
+    c = Client(app, spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'br, gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert _gunzip(resp.data) == body.encode('utf-8')
+
+
+def test_compression_middleware_brotli():
+    brotli = pytest.importorskip('brotli')
+    body = '{"a": "%s"}' % ('x' * 1000)
+    c = Client(_compression_app(body), spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip, br'})
+    assert resp.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(resp.data) == body.encode('utf-8')
+
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+
+
+def test_compression_middleware_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    body = '{"a": "%s"}' % ('x' * 1000)
+    c = Client(_compression_app(body), spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'zstd'})
+    assert resp.headers['Content-Encoding'] == 'zstd'
+    decompressor = zstandard.ZstdDecompressor()
+    assert decompressor.decompressobj().decompress(resp.data) == body.encode('utf-8')
+
+
+def test_encoder_min_size():
+    app = _compression_app('{"a": 1}', encoders=[GzipEncoder(min_size=100)])
+    c = Client(app, spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+
+
+def test_gzip_middleware_streamed_ndjson():
+    class A(spa.JSONHandler):
+        json_stream_format = 'ndjson'
+
+        def get(self):
+            return ({'n': n} for n in range(1000))
+
+    app = GzipMiddleware(spa.App((('/', 'a', A),)))
+    c = Client(app, spa.Response)
+    resp = c.get('/', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    lines = _gunzip(resp.data).decode('utf-8').splitlines()
+    assert len(lines) == 1000
+    assert lines[-1] == '{"n":999}'
@@ -0,0 +1,20 @@
+from spa import gzip_util
+
+
+def test_parse_encoding_header():
+    encodings = gzip_util.parse_encoding_header('deflate, gzip;q=0.5, br; q=0.8')
+    assert encodings == {
+        'identity': 1.0,
+        'deflate': 1,
+        'gzip': 0.5,
+        'br': 0.8,
+    }
+
+
+def test_choose_encoding():
+    assert gzip_util.choose_encoding('gzip, br', ('br', 'gzip')) == 'br'
+    assert gzip_util.choose_encoding('gzip, br;q=0.5', ('br', 'gzip')) == 'gzip'
+    assert gzip_util.choose_encoding('deflate', ('br', 'gzip')) is None
+    assert gzip_util.choose_encoding('*', ('br', 'gzip')) == 'br'
+    assert gzip_util.choose_encoding('gzip;q=0', ('gzip',)) is None
+    assert gzip_util.choose_encoding('', ('gzip',)) is None
@@ -0,0 +1,314 @@
+import logging
+import socket
+import threading
+
+import pytest
+from gwebsocket.websocket import WebSocket
+
+from spa import heartbeat as heartbeat_module
+from spa.heartbeat import (PING_FRAME, FrameWriter, Heartbeat, TimerWheel,
+                           TrackedWebSocket)
+from spa.websocket import BufferedWebSocket, encode_frame
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.shut_down = False
+
+    def shutdown(self, how):
+        self.shut_down = True
+
+
+class FakeHandler(object):
+    logger = logging.getLogger('test')
+
+    def __init__(self):
+        self.socket = FakeConn()
+
+
+class FakeStream(object):
+    def __init__(self, frames=b''):
+        self.written = []
+        self.write = self.written.append
+        self.data = frames
+
+    def read(self, n):
+        data, self.data = self.data[:n], self.data[n:]
+        return data
+
+
+class SlowStream(FakeStream):
+    """A stream whose writes get stuck halfway until released."""
+
+    def __init__(self):
+        super(SlowStream, self).__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.write = self.slow_write
+
+    def slow_write(self, data):
+        half = len(data) // 2
+        self.written.append(data[:half])
+        self.started.set()
+        self.release.wait(5)
+        self.written.append(data[half:])
+
+
+def inline(func, *args):
+    func(*args)
+
+
+class ManualWheel(TimerWheel):
+    """A wheel that only turns when told to."""
+
+    def start(self):
+        pass
+
+    def run_for(self, seconds):
+        for _ in range(int(seconds / self.tick)):
+            self.advance()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(heartbeat_module.time, 'time', clock.time)
+    return clock
+
+
+def make_socket(frames=b''):
+    stream = FakeStream(frames)
+    return WebSocket({}, stream, FakeHandler()), stream
+
+
+def test_wheel_fires_in_order():
+    wheel = ManualWheel(tick=1, slots=4)
+    fired = []
+    wheel.call_later(1, lambda: fired.append('a'))
+    wheel.call_later(2.5, lambda: fired.append('b'))
+    # More than a turn of the wheel away.
+    wheel.call_later(10, lambda: fired.append('c'))
+    cancelled = wheel.call_later(2, lambda: fired.append('x'))
+    cancelled.cancel()
+    assert len(wheel) == 4
+
+    wheel.advance()
+    assert fired == ['a']
+    wheel.run_for(2)
+    assert fired == ['a', 'b']
+    wheel.run_for(6)
+    assert fired == ['a', 'b']
+    wheel.advance()
+    assert fired == ['a', 'b', 'c']
+    assert len(wheel) == 0
+    assert wheel.fired == 3
+
+
+def test_wheel_survives_broken_callback():
+    wheel = ManualWheel(tick=1)
+    fired = []
+    wheel.call_later(1, lambda: 1 / 0)
+    wheel.call_later(1, lambda: fired.append(1))
+    wheel.advance()
+    assert fired == [1]
+
+
+def test_wheel_thread_runs_timers():
+    wheel = TimerWheel(tick=0.01)
+    done = threading.Event()
+    wheel.call_later(0.02, done.set)
+    assert done.wait(2)
+
+
+def test_ping_then_reap(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    ws, stream = make_socket()
+    closed = []
+    ws.add_close_callback(lambda: closed.append(True))
+    conn = ws.handler.socket
+    hb.watch(ws)
+    assert isinstance(ws, TrackedWebSocket)
+    assert hb.watching() == 1
+
+    clock.now += 10
+    wheel.run_for(10)
+    assert stream.written == [b'\x89\x00']
+    assert hb.pings == 1
+
+    clock.now += 10
+    wheel.run_for(10)
+    assert hb.pings == 2
+    assert not closed
+
+    clock.now += 5
+    wheel.run_for(5)
+    assert closed == [True]
+    assert ws.closed
+    assert conn.shut_down
+    assert hb.reaped == 1
+    assert hb.watching() == 0
+    # Sent a 1001 close frame.
+    assert stream.written[-1][:4] == b'\x88\x0e\x03\xe9'
+
+
+def test_received_frames_count_as_activity(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    # A masked pong, as a client would send.
+    ws, stream = make_socket(b'\x8a\x80abcd')
+    hb.watch(ws)
+
+    clock.now += 9
+    ws.read_frame()
+    clock.now += 1
+    wheel.run_for(10)
+    # Heard from it a second ago, so no ping yet.
+    assert stream.written == []
+    clock.now += 9
+    wheel.run_for(9)
+    assert stream.written == [b'\x89\x00']
+
+
+def test_touch(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    ws, stream = make_socket()
+    hb.watch(ws)
+    for _ in range(5):
+        clock.now += 9
+        wheel.run_for(9)
+        hb.touch(ws)
+    assert hb.pings == 0
+    assert not ws.closed
+
+
+def test_close_unwatches(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    ws, stream = make_socket()
+    hb.watch(ws)
+    ws.close()
+    assert hb.watching() == 0
+    clock.now += 30
+    wheel.run_for(30)
+    assert hb.reaped == 0
+    assert len(wheel) == 0
+
+
+def test_buffered_socket(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    raw, stream = make_socket()
+    ws = BufferedWebSocket(raw, window=0)
+    hb.watch(ws)
+    assert isinstance(raw, TrackedWebSocket)
+    clock.now += 10
+    wheel.run_for(10)
+    assert stream.written == [b'\x89\x00']
+    clock.now += 5
+    wheel.run_for(5)
+    hb.touch(raw)
+    clock.now += 5
+    wheel.run_for(5)
+    assert hb.pings == 1
+
+
+def test_handler_heartbeat(clock):
+    import spa
+    from werkzeug.test import EnvironBuilder
+
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel, spawn=inline)
+    closed = []
+
+    class Chat(spa.Handler):
+        heartbeat = hb
+
+        def websocket(self):
+            return spa.Response('')
+
+        def websocket_close(self):
+            closed.append(True)
+
+    app = spa.App((('/', 'chat', Chat),))
+    environ = EnvironBuilder('/').get_environ()
+    ws, stream = make_socket()
+    environ['wsgi.websocket'] = ws
+    app(environ, lambda status, headers: None)
+    assert hb.watching() == 1
+
+    clock.now += 25
+    wheel.run_for(25)
+    assert closed == [True]
+
+
+def test_ping_waits_for_frame_being_sent(clock):
+    wheel = ManualWheel(tick=1)
+    spawned = []
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel,
+                   spawn=lambda func, *args: spawned.append(func))
+    stream = SlowStream()
+    ws = WebSocket({}, stream, FakeHandler())
+    hb.watch(ws)
+    assert isinstance(ws.raw_write, FrameWriter)
+
+    sender = threading.Thread(target=ws.send, args=('x' * 100,))
+    sender.start()
+    assert stream.started.wait(5)
+    clock.now += 10
+    # The wheel doesn't wait for the stuck send.
+    wheel.run_for(10)
+    assert hb.pings == 1
+    # The sender sends the ping once it's done.
+    assert spawned == []
+
+    stream.release.set()
+    sender.join(5)
+    assert b''.join(stream.written) == encode_frame('x' * 100) + PING_FRAME
+
+
+def test_pings_are_dropped_while_one_is_waiting(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=100, wheel=wheel,
+                   spawn=lambda func, *args: None)
+    ws, stream = make_socket()
+    hb.watch(ws)
+    clock.now += 30
+    wheel.run_for(30)
+    assert hb.pings == 1
+    assert ws.raw_write.pending == [PING_FRAME]
+
+
+def test_reap_cuts_off_stuck_write(clock):
+    wheel = ManualWheel(tick=1)
+    hb = Heartbeat(interval=10, timeout=25, wheel=wheel)
+    stream = SlowStream()
+    ws = WebSocket({}, stream, FakeHandler())
+    # Shutting down the connection makes the stuck write return.
+    ws.handler.socket.shutdown = lambda how: stream.release.set()
+    closed = threading.Event()
+    ws.add_close_callback(closed.set)
+    hb.watch(ws)
+
+    sender = threading.Thread(target=ws.send, args=('x' * 100,))
+    sender.start()
+    assert stream.started.wait(5)
+    clock.now += 25
+    wheel.run_for(25)
+    assert hb.reaped == 1
+    assert closed.wait(5)
+    sender.join(5)
+
+
+def test_timeout_must_exceed_interval():
+    with pytest.raises(ValueError):
+        Heartbeat(interval=10, timeout=10)
@@ -73,3 +73,16 @@ def test_homepage_extra():
     resp = c.get('/')
     assert b'<!-- extra header stuff -->' in resp.data
     assert b'<!-- extra footer stuff -->' in resp.data
+
+
+def test_app_warm_renders_homepage():
+    static_handler = SmartStatic(directory=static_folder)
+    home_page = HomePage(static_url, static_handler, scripts=['js/test1.js'])
+    app = spa.App((
+        ('/', 'home', home_page),
+        (static_url + '<path:filepath>', 'static', static_handler),
+    ))
+    assert home_page.rendered is None
+    app.warm()
+    assert 'test1.5475b9391ae5.js' in home_page.rendered
+    assert static_handler.hash_cache.path_hashes
@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+from gwebsocket.websocket import WebSocket
+
+from spa.hub import Hub, Message
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        self.close_code = None
+        self.callbacks = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def close(self, code=1000, message=''):
+        self.closed = True
+        self.close_code = code
+        for cb in self.callbacks:
+            cb()
+
+    def add_close_callback(self, cb):
+        self.callbacks.append(cb)
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.written = []
+        self.write = self.written.append
+        self.read = lambda n: b''
+
+
+def test_publish_fans_out():
+    hub = Hub()
+    a, b, c = FakeSocket(), FakeSocket(), FakeSocket()
+    subs = [hub.subscribe(a, 'ticker'), hub.subscribe(b, 'ticker', 'news'),
+            hub.subscribe(c, 'news')]
+    assert hub.publish('ticker', {'price': 1}) == 2
+    assert hub.publish('news', u'hello') == 2
+    assert hub.publish('nobody', 'x') == 0
+    for sub in subs:
+        sub.send_pending()
+    assert a.sent == [u'{"price":1}']
+    assert b.sent == [u'{"price":1}', u'hello']
+    assert c.sent == [u'hello']
+
+
+def test_message_encoded_once():
+    hub = Hub()
+    streams = [FakeStream() for _ in range(3)]
+    subs = [hub.subscribe(WebSocket({}, stream, None), 'ch')
+            for stream in streams]
+    hub.publish('ch', u'caf\xe9')
+    for sub in subs:
+        sub.send_pending()
+    frames = [stream.written[0] for stream in streams]
+    assert frames[0] == b'\x81\x05caf\xc3\xa9'
+    assert frames[0] is frames[1] is frames[2]
+
+
+@pytest.mark.parametrize('overflow,expected', [
+    ('drop_oldest', [u'3', u'4']),
+    ('drop_newest', [u'1', u'2']),
+])
+def test_overflow_drops(overflow, expected):
+    hub = Hub(queue_size=2, overflow=overflow)
+    ws = FakeSocket()
+    sub = hub.subscribe(ws, 'ch')
+    for n in range(1, 5):
+        hub.publish('ch', u'%d' % n)
+    sub.send_pending()
+    assert ws.sent == expected
+    assert sub.dropped == 2
+
+
+def test_overflow_close():
+    hub = Hub(queue_size=1, overflow='close')
+    ws = FakeSocket()
+    sub = hub.subscribe(ws, 'ch')
+    hub.publish('ch', u'1')
+    hub.publish('ch', u'2')
+    assert sub.send_pending() is False
+    assert ws.closed and ws.close_code == 1008
+    assert hub.subscriber_count() == 0
+
+
+def test_unsubscribe_on_close():
+    hub = Hub()
+    ws = FakeSocket()
+    hub.subscribe(ws, 'a', 'b')
+    hub.unsubscribe(ws, 'a')
+    assert hub.subscriber_count('a') == 0
+    assert hub.subscriber_count('b') == 1
+    ws.close()
+    assert hub.subscriber_count() == 0
+    assert hub.publish('b', u'x') == 0
+
+
+def test_run_sends_until_closed():
+    hub = Hub()
+    ws = FakeSocket()
+    sub = hub.subscribe(ws, 'ch')
+    t = threading.Thread(target=sub.run)
+    t.start()
+    hub.publish('ch', u'one')
+    hub.publish('ch', u'two')
+    while len(ws.sent) < 2:
+        t.join(0.01)
+    ws.close()
+    t.join(5)
+    assert not t.is_alive()
+    assert ws.sent == [u'one', u'two']
+
+
+def test_message_types():
+    assert Message(b'\x00\x01').opcode == 0x02
+    assert Message(u'text').data == u'text'
+    assert Message([1, 2]).payload == b'[1,2]'
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import spa
+
+root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+
+def test_public_names():
+    from spa.app import App
+    from spa.wrappers import JSONStreamResponse
+    assert spa.App is App
+    assert spa.JSONStreamResponse is JSONStreamResponse
+    assert 'StaticHandler' in dir(spa)
+    with pytest.raises(AttributeError):
+        spa.NoSuchThing
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='needs module __getattr__')
+def test_import_is_lazy():
+    code = ('import sys, spa; '
+            'spa.App, spa.run, spa.StaticHandler; '
+            'print(" ".join(m for m in ("gunicorn", "pkg_resources") '
+            'if m in sys.modules))')
+    env = dict(os.environ, PYTHONPATH=root)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    assert output.strip() == b''
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='needs module __getattr__')
+def test_submodule_import_errors_are_raised(monkeypatch):
+    class FakeImportlib(object):
+        @staticmethod
+        def import_module(name):
+            # Like a submodule that needs something that isn't installed.
+            raise ImportError('No module named somedep', name='somedep')
+
+    monkeypatch.setattr(spa, 'importlib', FakeImportlib)
+    with pytest.raises(ImportError):
+        spa.somesubmodule
+
+
+def test_old_import_locations():
+    from spa.utils import SpaGunicornApplication
+    from spa.server import SpaGunicornApplication as server_class
+    assert SpaGunicornApplication is server_class
+    assert spa.static.Static is not None
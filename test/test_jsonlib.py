@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from werkzeug.test import Client, EnvironBuilder
+
+import spa
+from spa import jsonlib
+
+
+@pytest.fixture(params=jsonlib.available_backends())
+def backend(request):
+    old = jsonlib.get_backend()
+    jsonlib.set_backend(request.param)
+    yield request.param
+    jsonlib.set_backend(old)
+
+
+def test_roundtrip(backend):
+    data = {'name': u'Zażółć', 'items': [1, 2.5, None, True], 'nested': {}}
+    out = jsonlib.dumps(data)
+    assert isinstance(out, bytes)
+    assert json.loads(out.decode('utf-8')) == data
+    assert jsonlib.loads(out) == data
+    assert jsonlib.loads(out.decode('utf-8')) == data
+
+
+def test_compact_by_default(backend):
+    assert jsonlib.dumps({'a': [1, 2]}) == b'{"a":[1,2]}'
+
+
+def test_sort_keys(backend):
+    out = jsonlib.dumps({'b': 1, 'a': 2}, sort_keys=True)
+    assert out.index(b'"a"') < out.index(b'"b"')
+
+
+def test_invalid_json_raises_value_error(backend):
+    with pytest.raises(ValueError):
+        jsonlib.loads(b'{"a":')
+
+
+def test_request_json(backend):
+    body = u'{"name": "Zażółć"}'.encode('utf-8')
+    req = spa.Request(EnvironBuilder('/', method='POST', data=body,
+                                     content_type='application/json')
+                      .get_environ())
+    assert req.json() == {'name': u'Zażółć'}
+
+
+def test_json_response_indent(backend):
+    app = spa.App((
+        ('/', 'a', type('A', (spa.Handler,), {
+            'get': lambda self: spa.JSONResponse({'b': 1, 'a': 2}, indent=2,
+                                                 sort_keys=True),
+        })),
+    ))
+    resp = Client(app, spa.Response).get('/')
+    assert resp.data.startswith(b'{\n  "a": 2')
+    assert resp.headers['Content-Type'] == 'application/json'
+
+
+def test_set_backend_rejects_unknown():
+    with pytest.raises(ValueError):
+        jsonlib.set_backend('simplejson')
@@ -0,0 +1,135 @@
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import spa
+from spa.metrics import (Histogram, Metrics, MetricsHandler,
+                         PrometheusExporter, SamplingProfiler, UNMATCHED)
+
+
+class Hello(spa.Handler):
+    def get(self):
+        return spa.Response('hello')
+
+
+class Stream(spa.Handler):
+    def get(self):
+        return spa.Response(iter([b'', b'abc', b'defg']))
+
+
+class Broken(spa.Handler):
+    def get(self):
+        raise ValueError('oops')
+
+
+def make_app(**kwargs):
+    metrics = Metrics(**kwargs)
+    app = spa.App((
+        ('/', 'hello', Hello),
+        ('/stream/', 'stream', Stream),
+        ('/broken/', 'broken', Broken),
+        ('/metrics', 'metrics', MetricsHandler),
+    ), metrics=metrics)
+    return app, metrics
+
+
+def test_histogram():
+    h = Histogram((1, 5, 10))
+    for value in (0.5, 1, 3, 7, 100):
+        h.observe(value)
+    assert h.counts == [2, 1, 1, 1]
+    assert h.count == 5
+    assert h.sum == 111.5
+    assert h.cumulative() == [(1, 2), (5, 3), (10, 4), (float('inf'), 5)]
+
+
+def test_routes_preallocated():
+    app, metrics = make_app()
+    assert set(metrics.routes) == {'hello', 'stream', 'broken', 'metrics',
+                                   UNMATCHED}
+
+
+def test_records_per_route():
+    app, metrics = make_app()
+    c = Client(app, BaseResponse)
+    assert c.get('/').data == b'hello'
+    assert c.get('/').data == b'hello'
+    hello = metrics.routes['hello']
+    assert hello.match.count == 2
+    assert hello.handler.count == 2
+    assert hello.ttfb.count == 2
+    assert hello.bytes.count == 2
+    assert hello.bytes.sum == 10
+    assert metrics.routes['stream'].match.count == 0
+
+
+def test_streamed_body():
+    app, metrics = make_app()
+    c = Client(app, BaseResponse)
+    assert c.get('/stream/').data == b'abcdefg'
+    stream = metrics.routes['stream']
+    assert stream.ttfb.count == 1
+    assert stream.bytes.sum == 7
+
+
+def test_unmatched_and_errors():
+    app, metrics = make_app()
+    c = Client(app, BaseResponse)
+    assert c.get('/nope').status_code == 404
+    assert metrics.routes[UNMATCHED].match.count == 1
+    assert metrics.routes[UNMATCHED].bytes.count == 1
+
+    try:
+        c.get('/broken/')
+    except ValueError:
+        pass
+    assert metrics.routes['broken'].errors == 1
+
+
+def test_prometheus_export():
+    app, metrics = make_app(time_buckets=(0.5, 1.0), size_buckets=(10,))
+    c = Client(app, BaseResponse)
+    assert c.get('/').data == b'hello'
+    resp = c.get('/metrics')
+    assert resp.headers['Content-Type'] == PrometheusExporter.content_type
+    lines = resp.data.decode('utf-8').splitlines()
+    assert '# TYPE spa_handler_seconds histogram' in lines
+    assert 'spa_handler_seconds_bucket{route="hello",le="+Inf"} 1' in lines
+    assert 'spa_response_bytes_bucket{route="hello",le="10"} 1' in lines
+    assert 'spa_response_bytes_sum{route="hello"} 5' in lines
+    assert 'spa_response_bytes_count{route="stream"} 0' in lines
+    assert 'spa_handler_errors_total{route="hello"} 0' in lines
+
+
+def test_custom_exporter():
+    class CountExporter(object):
+        content_type = 'text/plain'
+
+        def export(self, metrics):
+            return '%d\n' % metrics.routes['hello'].handler.count
+
+    app, metrics = make_app(exporter=CountExporter())
+    c = Client(app, BaseResponse)
+    c.get('/')
+    assert c.get('/metrics').data == b'1\n'
+
+
+def test_metrics_handler_without_metrics():
+    app = spa.App((('/metrics', 'metrics', MetricsHandler),))
+    c = Client(app, BaseResponse)
+    assert c.get('/metrics').status_code == 404
+
+
+def test_sampling_profiler():
+    profiler = SamplingProfiler(rate=1)
+    app, metrics = make_app(profiler=profiler)
+    c = Client(app, BaseResponse)
+    c.get('/')
+    c.get('/')
+    assert profiler.samples == {'hello': 2}
+    assert 'get' in profiler.report('hello')
+    assert profiler.report('stream') == ''
+
+    never = SamplingProfiler(rate=0)
+    app, metrics = make_app(profiler=never)
+    Client(app, BaseResponse).get('/')
+    assert never.samples == {}
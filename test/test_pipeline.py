@@ -0,0 +1,102 @@
+import jwt
+from werkzeug.test import Client
+
+import spa
+from spa.jwtcookie import JWTSessionMiddleware
+from spa.middlewares import ApiCSRFMiddleware, Middleware, Pipeline
+
+
+class Hello(spa.Handler):
+    def get(self, path=''):
+        session = self.request.environ.get('jwtsession')
+        if session is not None:
+            session['path'] = path
+        return spa.Response('hello')
+
+    post = get
+
+
+def _app():
+    return spa.App((
+        ('/', 'index', Hello),
+        ('/<path:path>', 'hello', Hello),
+    ))
+
+
+class Recorder(Middleware):
+    def __init__(self, name, calls, **kwargs):
+        super(Recorder, self).__init__(**kwargs)
+        self.name = name
+        self.calls = calls
+
+    def process_request(self, environ):
+        self.calls.append(('request', self.name))
+
+    def process_response(self, environ, status, headers):
+        self.calls.append(('response', self.name))
+        headers.append(('X-Layer', self.name))
+
+
+def test_pipeline_hook_order():
+    calls = []
+    app = Pipeline(_app(), [
+        Recorder('outer', calls),
+        Recorder('inner', calls, exclude_pattern='^/static/'),
+    ])
+    c = Client(app, spa.Response)
+
+    resp = c.get('/')
+    assert calls == [('request', 'outer'), ('request', 'inner'),
+                     ('response', 'inner'), ('response', 'outer')]
+    assert resp.headers.getlist('X-Layer') == ['inner', 'outer']
+
+    del calls[:]
+    c.get('/static/app.js')
+    assert calls == [('request', 'outer'), ('response', 'outer')]
+
+
+def test_pipeline_caches_plans_per_path():
+    app = Pipeline(_app(), [
+        Recorder('a', [], include_pattern='^/api/'),
+    ])
+    c = Client(app, spa.Response)
+    c.get('/api/x')
+    c.get('/api/x')
+    c.get('/other')
+    assert len(app._plans) == 2
+    assert app._plans['/other'] == ()
+    (layer, on_request, on_response), = app._plans['/api/x']
+    assert on_request and on_response
+
+
+def test_pipeline_short_circuit():
+    calls = []
+    app = Pipeline(_app(), [
+        Recorder('outer', calls),
+        ApiCSRFMiddleware(),
+        Recorder('inner', calls),
+    ])
+    c = Client(app, spa.Response)
+    resp = c.post('/')
+    assert resp.status_code == 403
+    # The CSRF layer responded, so the inner layer never ran, but the outer
+    # one still saw the response.
+    assert calls == [('request', 'outer'), ('response', 'outer')]
+
+
+def test_pipeline_session_and_csrf():
+    app = Pipeline(_app(), [
+        JWTSessionMiddleware(secret_key='foobar', exclude_pattern='^/static/'),
+        ApiCSRFMiddleware(exclude_pattern='^/static/'),
+    ])
+    c = Client(app, spa.Response)
+    resp = c.get('/some/page')
+    cookies = {ck.name: ck.value for ck in c.cookie_jar}
+    assert jwt.decode(cookies['session'], 'foobar')['path'] == 'some/page'
+    assert cookies['api_csrf']
+
+    resp = c.post('/form', headers={'X-Api-CSRF': cookies['api_csrf']})
+    assert resp.status_code == 200
+
+    resp = Client(app, spa.Response).get('/static/app.js')
+    assert 'Set-Cookie' not in resp.headers
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
+import calendar
 import datetime
+import time
 
 from werkzeug.test import Client
 import jwt
@@ -8,7 +10,8 @@ import pytest
 import utc
 
 import spa
-from spa.jwtcookie import JWTSessionMiddleware, JWTSessionParamMiddleware
+from spa.jwtcookie import (JWTCookie, JWTSessionMiddleware,
+                           JWTSessionParamMiddleware, TokenCache)
 
 def test_read_session_cookie():
     class A(spa.Handler):
@@ -139,3 +142,134 @@ def test_jwtsession_expire_days():
         # will have been dropped when the middleware saw that its 'iat'
         # timestamp was too old.
         c.get('/')
+
+
+def _session_app(**kwargs):
+    class A(spa.Handler):
+        def get(self):
+            session = self.request.environ['jwtsession']
+            foo = session.get('foo', 'missing')
+            session['scratch'] = 'changed'
+            return spa.Response(foo)
+
+    return JWTSessionMiddleware(spa.App((('/', 'a', A),)), secret_key='foobar',
+                                **kwargs)
+
+
+def test_token_cache_skips_decoding(monkeypatch):
+    cache = TokenCache()
+    app = _session_app(token_cache=cache)
+    decodes = []
+    real_decode = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        decodes.append(1)
+        return real_decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, 'decode', counting_decode)
+
+    c = Client(app, spa.Response)
+    tok = jwt.encode({'foo': 'bar', 'iat': utc.now()}, 'foobar')
+    for _ in range(3):
+        c.set_cookie('localhost', 'session', tok)
+        assert c.get('/').data == b'bar'
+
+    assert len(decodes) == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_token_cache_respects_expiry():
+    cache = TokenCache()
+    app = _session_app(token_cache=cache, expire_days=1)
+    c = Client(app, spa.Response)
+
+    tok = jwt.encode({'foo': 'bar', 'iat': utc.now()}, 'foobar')
+    c.set_cookie('localhost', 'session', tok)
+    assert c.get('/').data == b'bar'
+    cache.set(tok.decode('utf-8'), {'foo': 'bar'}, expires_at=time.time() - 1)
+    c.set_cookie('localhost', 'session', tok)
+    # The stale entry is dropped, and the token verified again.
+    assert c.get('/').data == b'bar'
+    assert cache.misses == 2
+
+    exp = utc.now() + datetime.timedelta(hours=1)
+    tok = jwt.encode({'foo': 'bar', 'iat': utc.now(), 'exp': exp}, 'foobar')
+    c.set_cookie('localhost', 'session', tok)
+    c.get('/')
+    assert (cache._entries[tok.decode('utf-8')][2] <=
+            calendar.timegm(exp.utctimetuple()))
+
+
+def test_expired_token_gives_empty_session():
+    app = _session_app(token_cache=TokenCache())
+    c = Client(app, spa.Response)
+    tok = jwt.encode({'foo': 'bar', 'iat': utc.now(),
+                      'exp': utc.now() - datetime.timedelta(seconds=1)},
+                     'foobar')
+    c.set_cookie('localhost', 'session', tok)
+    assert c.get('/').data == b'missing'
+
+
+def test_token_cache_returns_copies_and_evicts():
+    cache = TokenCache(max_size=2)
+    cache.set('a', {'foo': 'bar', 'roles': ['admin']})
+    claims = cache.get('a')
+    claims['roles'].append('root')
+    claims['foo'] = 'baz'
+    assert cache.get('a') == {'foo': 'bar', 'roles': ['admin']}
+
+    cache.set('b', {})
+    cache.set('c', {})
+    assert len(cache) == 2
+    assert cache.get('a') is None
+
+
+def test_anonymous_cookie_is_reused(monkeypatch):
+    class A(spa.Handler):
+        def get(self):
+            return spa.Response()
+
+    app = JWTSessionMiddleware(spa.App((('/', 'a', A),)), secret_key='foobar')
+    serialized = []
+    real_serialize = JWTCookie.serialize
+
+    def counting_serialize(self, *args, **kwargs):
+        serialized.append(1)
+        return real_serialize(self, *args, **kwargs)
+
+    monkeypatch.setattr(JWTCookie, 'serialize', counting_serialize)
+
+    first = Client(app, spa.Response).get('/').headers['Set-Cookie']
+    second = Client(app, spa.Response).get('/').headers['Set-Cookie']
+    assert first == second
+    assert len(serialized) == 1
+
+    app.anonymous_cookie_ttl = 0
+    Client(app, spa.Response).get('/')
+    assert len(serialized) == 2
+
+
+def test_unchanged_session_keeps_cookie():
+    class A(spa.Handler):
+        def get(self):
+            # Setting a value to what it already was isn't a change.
+            self.request.environ['jwtsession']['foo'] = 'bar'
+            return spa.Response()
+
+    app = JWTSessionMiddleware(spa.App((('/', 'a', A),)), secret_key='foobar',
+                               refresh_days=0.5)
+    c = Client(app, spa.Response)
+    tok = jwt.encode({'foo': 'bar', 'iat': utc.now()}, 'foobar')
+    c.set_cookie('localhost', 'session', tok)
+    assert 'Set-Cookie' not in c.get('/').headers
+
+    # Once the token is older than refresh_days, it's re-signed.
+    old = utc.now() - datetime.timedelta(hours=13)
+    tok = jwt.encode({'foo': 'bar', 'iat': old}, 'foobar')
+    c.set_cookie('localhost', 'session', tok)
+    resp = c.get('/')
+    assert 'Set-Cookie' in resp.headers
+    cookie = next(ck for ck in c.cookie_jar if ck.name == 'session')
+    session = jwt.decode(cookie.value, 'foobar')
+    assert session['foo'] == 'bar'
+    assert session['iat'] > calendar.timegm(old.utctimetuple())
@@ -1,10 +1,15 @@
+import mimetypes
 import os
+import zlib
 
+import pytest
 from werkzeug.test import Client
 
 import spa
-from spa.static import StaticHandler
-from spa.static.smart import SmartStatic, get_hash
+from spa import encoders
+from spa.static import FileCache, Static, StaticHandler
+from spa.static import manifest
+from spa.static.smart import SmartStatic, build_manifest, get_hash
 
 
 here = os.path.dirname(os.path.realpath(__file__))
@@ -38,6 +43,24 @@ def test_smart_static_handler():
     assert resp.headers['Content-Type'] == 'text/css'
 
 
+def test_smart_static_route_kwargs():
+    """
+    Route kwargs meant for the handler, rather than its StaticConfig, should
+    be passed on to it.
+    """
+    routes = (
+        ('/<path:filepath>', 's', SmartStatic(static_folder),
+         {'static_url_root': '/assets/'}),
+        ('/plain/<path:filepath>', 'plain', SmartStatic(static_folder),
+         {'hash_paths': False, 'cache': False}),
+    )
+    c = Client(spa.App(routes), spa.Response)
+    assert c.get('/css/nothere.css').status_code == 404
+    resp = c.get('/plain/css/test.css')
+    assert resp.status_code == 200
+    assert resp.headers['Cache-Control'] == 'public'
+
+
 def test_smart_static_css():
     """
     Contents of CSS files served by SmartStatic should have url(), @import and
@@ -70,3 +93,340 @@ def test_smart_static_css():
 
     # css-relative url with query string
     assert b'url("../img/background.fb32250cea28.png?foo=bar")' in resp.data
+
+
+def test_build_manifest():
+    manifest = build_manifest(static_folder)
+
+    css_path = os.path.join(static_folder, 'css', 'test.css')
+    with open(css_path, 'rb') as f:
+        css_hash = get_hash(f)
+
+    assert manifest['/css/test.css'] == css_hash
+    assert '/js/test1.js' in manifest
+
+
+def test_smart_static_manifest():
+    """
+    When SmartStatic is given a manifest, the hashes in it should be trusted
+    instead of computing new ones.
+    """
+    handler = SmartStatic(directory=static_folder,
+                          manifest={'/js/test1.js': 'aaaaaaaaaaaa'})
+    routes = (
+        ('/<path:filepath>', 'test', handler),
+    )
+
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+    resp = c.get('/js/test1.aaaaaaaaaaaa.js')
+    assert resp.status_code == 200
+
+    with open(os.path.join(static_folder, 'js', 'test1.js'), 'rb') as f:
+        real_hash = get_hash(f)
+    resp = c.get('/js/test1.%s.js' % real_hash)
+    assert resp.status_code == 404
+
+
+def test_smart_static_manifest_file(tmpdir):
+    manifest_path = str(tmpdir.join('manifest.json'))
+    manifest.main([static_folder, '-o', manifest_path])
+
+    handler = SmartStatic(directory=static_folder, manifest=manifest_path)
+    assert handler.hash_cache.path_hashes == build_manifest(static_folder)
+
+
+def test_file_cache_serves_from_memory(tmpdir):
+    tmpdir.join('hello.txt').write('hello')
+    cache = FileCache(check_interval=None)
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir), file_cache=cache)),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    resp = c.get('/hello.txt')
+    assert resp.data == b'hello'
+    assert len(cache) == 1
+
+    # With check_interval=None, changes on disk aren't noticed.
+    tmpdir.join('hello.txt').write('goodbye')
+    resp = c.get('/hello.txt')
+    assert resp.data == b'hello'
+    assert resp.headers['Content-Length'] == '5'
+    assert cache.hits == 1
+
+
+def test_file_cache_notices_changes(tmpdir):
+    tmpdir.join('hello.txt').write('hello')
+    cache = FileCache(check_interval=0)
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir), file_cache=cache)),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    assert c.get('/hello.txt').data == b'hello'
+    tmpdir.join('hello.txt').write('goodbye')
+    assert c.get('/hello.txt').data == b'goodbye'
+
+
+def test_file_cache_lru_eviction(tmpdir):
+    for name in 'abc':
+        tmpdir.join(name).write('x' * 10)
+    cache = FileCache(max_bytes=25, check_interval=None)
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir), file_cache=cache)),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    c.get('/a')
+    c.get('/b')
+    c.get('/a')
+    c.get('/c')
+    assert str(tmpdir.join('a')) in cache
+    assert str(tmpdir.join('b')) not in cache
+    assert str(tmpdir.join('c')) in cache
+    assert cache.size == 20
+    assert cache.evictions == 1
+
+
+def test_precompressed_sibling(tmpdir):
+    tmpdir.join('app.js').write('var a = 1;')
+    tmpdir.join('app.js.gz').write_binary(
+        encoders.compress_bytes(b'var a = 1;', 'gzip'))
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir),
+                                            precompressed=('gzip',))),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    resp = c.get('/app.js', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert resp.headers['Content-Type'] == mimetypes.guess_type('app.js')[0]
+    assert resp.headers['Content-Length'] == str(len(resp.data))
+    assert zlib.decompress(resp.data, 16 + zlib.MAX_WBITS) == b'var a = 1;'
+
+    resp = c.get('/app.js')
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == b'var a = 1;'
+
+
+def test_precompressed_in_memory(tmpdir):
+    tmpdir.join('app.css').write('body {}')
+    cache = FileCache()
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir), file_cache=cache,
+                                            precompressed=('gzip',))),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    resp = c.get('/app.css', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert zlib.decompress(resp.data, 16 + zlib.MAX_WBITS) == b'body {}'
+    assert (str(tmpdir.join('app.css')), 'gzip') in cache
+    assert not tmpdir.join('app.css.gz').exists()
+
+    resp = c.get('/app.css', headers={'Accept-Encoding': 'gzip'})
+    assert zlib.decompress(resp.data, 16 + zlib.MAX_WBITS) == b'body {}'
+    assert len(cache) == 2
+
+
+def test_precompressed_in_memory_not_served_by_name(tmpdir):
+    """
+    Compressed copies made in memory mustn't be served for requests for the
+    file name they would have on disk.
+    """
+    tmpdir.join('app.css').write('body {}')
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir), file_cache=FileCache(),
+                                            precompressed=('gzip',))),
+    )
+    c = Client(spa.App(routes), spa.Response)
+
+    assert c.get('/app.css.gz').status_code == 404
+    resp = c.get('/app.css', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert c.get('/app.css.gz').status_code == 404
+
+
+def test_precompressed_stale_sibling_ignored(tmpdir):
+    tmpdir.join('app.js.gz').write_binary(
+        encoders.compress_bytes(b'old', 'gzip'))
+    tmpdir.join('app.js').write('new')
+    os.utime(str(tmpdir.join('app.js.gz')), (0, 0))
+    routes = (
+        ('/<path:filepath>', 'test', Static(str(tmpdir),
+                                            precompressed=('gzip',))),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    resp = c.get('/app.js', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == b'new'
+
+
+def test_smart_static_css_precompressed():
+    routes = (
+        ('/<path:filepath>', 'test', SmartStatic(directory=static_folder,
+                                                 precompressed=('gzip',))),
+    )
+
+    css_path = os.path.join(static_folder, 'css', 'test.css')
+    with open(css_path, 'rb') as f:
+        css_hash = get_hash(f)
+
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+    resp = c.get('/css/test.%s.css' % css_hash,
+                 headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Content-Length'] == str(len(resp.data))
+    body = zlib.decompress(resp.data, 16 + zlib.MAX_WBITS)
+    assert b'url("blah.c9a8f43433e4.css")' in body
+
+
+def test_static_factory_shares_config():
+    factory = Static(static_folder, disallow='*.png')
+    routes = (
+        ('/<path:filepath>', 'test', factory),
+    )
+    app = spa.App(routes)
+    c = Client(app, spa.Response)
+
+    assert c.get('/css/test.css').status_code == 200
+    assert c.get('/img/background.png').status_code == 404
+
+    req = spa.Request({})
+    first = factory(app, req, {'filepath': 'a'}, 'test')
+    second = factory(app, req, {'filepath': 'b'}, 'test')
+    assert first.config is second.config is factory.config
+
+
+def _range_app(**kwargs):
+    routes = (
+        ('/<path:filepath>', 'test', Static(static_folder, **kwargs)),
+    )
+    return spa.App(routes)
+
+
+def _css_contents():
+    with open(os.path.join(static_folder, 'css', 'test.css'), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'file_cache': FileCache()}])
+def test_single_range(kwargs):
+    contents = _css_contents()
+    c = Client(_range_app(**kwargs), spa.Response)
+
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=10-19'})
+    assert resp.status_code == 206
+    assert resp.data == contents[10:20]
+    assert resp.headers['Content-Length'] == '10'
+    assert resp.headers['Content-Range'] == 'bytes 10-19/%d' % len(contents)
+
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=-5'})
+    assert resp.status_code == 206
+    assert resp.data == contents[-5:]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'file_cache': FileCache()}])
+def test_multiple_ranges(kwargs):
+    contents = _css_contents()
+    c = Client(_range_app(**kwargs), spa.Response)
+
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=0-4,10-14'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Type'].startswith('multipart/byteranges')
+    assert resp.headers['Content-Length'] == str(len(resp.data))
+    boundary = resp.headers['Content-Type'].split('boundary=')[1]
+    parts = resp.data.split(b'--' + boundary.encode('ascii'))
+    assert parts[1].endswith(b'\r\n\r\n' + contents[0:5] + b'\r\n')
+    assert parts[2].endswith(b'\r\n\r\n' + contents[10:15] + b'\r\n')
+    assert parts[3] == b'--\r\n'
+
+
+def test_unsatisfiable_range():
+    contents = _css_contents()
+    c = Client(_range_app(), spa.Response)
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=100000-'})
+    assert resp.status_code == 416
+    assert resp.headers['Content-Range'] == 'bytes */%d' % len(contents)
+
+
+def test_stale_if_range_sends_whole_file():
+    contents = _css_contents()
+    c = Client(_range_app(), spa.Response)
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=0-4',
+                                           'If-Range': '"not-the-etag"'})
+    assert resp.status_code == 200
+    assert resp.data == contents
+
+    etag = resp.headers['Etag']
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=0-4',
+                                           'If-Range': etag})
+    assert resp.status_code == 206
+    assert resp.data == contents[:5]
+
+
+def _file_wrapper(wrapped):
+    # Like wsgiref's, this sends everything up to the end of the file.
+    def file_wrapper(handle, block_size):
+        wrapped.append(handle.tell())
+        return iter(lambda: handle.read(block_size), b'')
+    return file_wrapper
+
+
+def test_file_wrapper_gets_whole_files():
+    """
+    When the server provides wsgi.file_wrapper, it should be handed the open
+    file for whole-file responses.
+    """
+    wrapped = []
+    c = Client(_range_app(), spa.Response)
+    resp = c.get('/css/test.css',
+                 environ_overrides={'wsgi.file_wrapper': _file_wrapper(wrapped)})
+    assert wrapped == [0]
+    assert resp.data == _css_contents()
+
+
+def test_range_body_matches_content_length():
+    """
+    A file wrapper would send the rest of the file after a range, so ranges
+    mustn't use one.
+    """
+    wrapped = []
+    c = Client(_range_app(), spa.Response)
+    resp = c.get('/css/test.css', headers={'Range': 'bytes=0-3'},
+                 environ_overrides={'wsgi.file_wrapper': _file_wrapper(wrapped)})
+    assert resp.status_code == 206
+    assert len(resp.data) == int(resp.headers['Content-Length']) == 4
+    assert resp.data == _css_contents()[:4]
+    assert wrapped == []
+
+
+def test_head():
+    c = Client(_range_app(), spa.Response)
+    resp = c.head('/css/test.css')
+    assert resp.status_code == 200
+    assert resp.data == b''
+    assert resp.headers['Content-Length'] == str(len(_css_contents()))
+
+
+def test_smart_static_warm_builds_manifest():
+    static = SmartStatic(static_folder)
+    assert static.hash_cache.path_hashes == {}
+    static.warm()
+    assert (static.hash_cache.path_hashes ==
+            build_manifest(static_folder))
+
+    # A given manifest is left as it is.
+    static = SmartStatic(static_folder, manifest={'/css/test.css': 'abc'})
+    static.warm()
+    assert static.hash_cache.path_hashes == {'/css/test.css': 'abc'}
@@ -0,0 +1,147 @@
+import os
+
+import pytest
+
+import spa
+from spa.middlewares import GzipMiddleware
+from spa.static import Static
+from spa.server import SpaGunicornApplication
+from spa.utils import (GWEBSOCKET_WORKER, cgroup_cpu_quota, choose_profile,
+                       cpu_count, route_mix, worker_config)
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+
+def write(path, text):
+    if not path.dirpath().check():
+        path.dirpath().ensure(dir=True)
+    path.write(text)
+
+
+def test_cgroup_v2_quota(tmpdir):
+    write(tmpdir.join('cpu.max'), '200000 100000\n')
+    proc = tmpdir.join('proc_cgroup')
+    proc.write('0::/\n')
+    assert cgroup_cpu_quota(str(tmpdir), str(proc)) == 2.0
+
+
+def test_cgroup_v2_nested(tmpdir):
+    write(tmpdir.join('cpu.max'), 'max 100000\n')
+    write(tmpdir.join('pods', 'web', 'cpu.max'), '150000 100000\n')
+    proc = tmpdir.join('proc_cgroup')
+    proc.write('0::/pods/web\n')
+    assert cgroup_cpu_quota(str(tmpdir), str(proc)) == 1.5
+
+
+def test_cgroup_v2_unlimited(tmpdir):
+    write(tmpdir.join('cpu.max'), 'max 100000\n')
+    assert cgroup_cpu_quota(str(tmpdir), str(tmpdir.join('nope'))) is None
+
+
+def test_cgroup_v1_quota(tmpdir):
+    write(tmpdir.join('cpu', 'cpu.cfs_quota_us'), '50000\n')
+    write(tmpdir.join('cpu', 'cpu.cfs_period_us'), '100000\n')
+    assert cgroup_cpu_quota(str(tmpdir), str(tmpdir.join('nope'))) == 0.5
+
+    write(tmpdir.join('cpu', 'cpu.cfs_quota_us'), '-1\n')
+    assert cgroup_cpu_quota(str(tmpdir), str(tmpdir.join('nope'))) is None
+
+
+def test_cpu_count_uses_quota(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(64)),
+                        raising=False)
+    monkeypatch.setattr('spa.utils.cgroup_cpu_quota', lambda: 1.5)
+    assert cpu_count() == 2
+    monkeypatch.setattr('spa.utils.cgroup_cpu_quota', lambda: 0.25)
+    assert cpu_count() == 1
+
+
+class Api(spa.Handler):
+    def get(self):
+        return spa.Response('hi')
+
+
+class Socket(spa.Handler):
+    def websocket(self):
+        pass
+
+
+def make_app(*handlers):
+    return spa.App(tuple(('/%d/' % i, 'r%d' % i, handler)
+                         for i, handler in enumerate(handlers)))
+
+
+def test_route_mix():
+    static = Static(os.path.join(here, 'static'))
+    app = GzipMiddleware(make_app(Api, Api, Socket, static))
+    assert route_mix(app) == {'sync': 2, 'websocket': 1, 'static': 1}
+
+
+def test_choose_profile():
+    static = Static(os.path.join(here, 'static'))
+    assert choose_profile(make_app(Api, Socket)) == 'websocket'
+    assert choose_profile(make_app(static)) == 'static'
+    assert choose_profile(make_app(Api, static, static)) == 'static'
+    assert choose_profile(make_app(Api, static)) == 'sync'
+    assert choose_profile(make_app(Api, Api, static)) == 'sync'
+    # Without a spa.App to look at, play it safe.
+    assert choose_profile(lambda environ, start_response: []) == 'websocket'
+
+
+def test_worker_config():
+    assert worker_config('websocket', cpus=2) == {
+        'worker_class': GWEBSOCKET_WORKER, 'workers': 2,
+        'worker_connections': 10000}
+    assert worker_config('sync', cpus=2)['workers'] == 5
+    assert worker_config('auto', make_app(Api), cpus=4)['worker_class'] == \
+        'sync'
+    with pytest.raises(ValueError):
+        worker_config('turbo')
+
+
+def test_gunicorn_config_precedence(monkeypatch):
+    monkeypatch.setattr('spa.utils.cpu_count', lambda: 2)
+    app = make_app(Api)
+
+    default = SpaGunicornApplication(app)
+    assert default.gunicorn_config['worker_class'] == GWEBSOCKET_WORKER
+    assert isinstance(default.gunicorn_config['workers'], int)
+
+    tuned = SpaGunicornApplication(app, profile='auto')
+    assert tuned.gunicorn_config['worker_class'] == 'sync'
+    assert tuned.gunicorn_config['workers'] == 5
+
+    monkeypatch.setenv('GUNICORN_WORKER_COUNT', '3')
+    overridden = SpaGunicornApplication(app, profile='auto')
+    assert overridden.gunicorn_config['workers'] == 3
+    assert overridden.cfg.workers == 3
+
+    explicit = SpaGunicornApplication(app, gunicorn_config={'workers': 7},
+                                      profile='auto')
+    assert explicit.gunicorn_config['workers'] == 7
+
+    monkeypatch.setenv('SPA_WORKER_PROFILE', 'websocket')
+    from_env = SpaGunicornApplication(app)
+    assert from_env.gunicorn_config['worker_class'] == GWEBSOCKET_WORKER
+    assert from_env.gunicorn_config['worker_connections'] == 10000
+
+
+def test_preload_warms_through_middlewares(monkeypatch):
+    from spa import utils
+    warmed = []
+
+    class Warmable(object):
+        def warm(self):
+            warmed.append(self)
+
+        def __call__(self, app, req, params, route_name):
+            return Api(app, req, params, route_name)
+
+    handler = Warmable()
+    app = make_app(Api, handler)
+    frozen = []
+    monkeypatch.setattr(utils.gc, 'freeze', lambda: frozen.append(True),
+                        raising=False)
+    utils.preload(GzipMiddleware(app))
+    assert warmed == [handler]
+    assert frozen == [True]